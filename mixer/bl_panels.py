@@ -236,6 +236,7 @@ def draw_advanced_settings_ui(layout: bpy.types.UILayout):
     layout.prop(mixer_prefs, "ignore_version_check")
     layout.prop(mixer_prefs, "log_level")
     layout.prop(mixer_prefs, "show_server_console")
+    layout.prop(mixer_prefs, "commands_time_budget")
     layout.prop(mixer_prefs, "vrtist_protocol")
 
 
@@ -245,7 +246,6 @@ def draw_developer_settings_ui(layout: bpy.types.UILayout):
     layout.prop(mixer_prefs, "no_start_server", text="Do not start server on connect")
     layout.prop(mixer_prefs, "send_base_meshes", text="Send Base Meshes")
     layout.prop(mixer_prefs, "send_baked_meshes", text="Send Baked Meshes")
-    layout.prop(mixer_prefs, "commands_send_interval")
     layout.prop(mixer_prefs, "display_own_gizmos")
     layout.prop(mixer_prefs, "display_ids_gizmos")
 
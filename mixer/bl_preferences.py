@@ -122,6 +122,10 @@ class MixerPreferences(bpy.types.AddonPreferences):
 
     show_server_console: bpy.props.BoolProperty(name="Show Server Console", default=False)
 
+    # Time spent applying the received commands at each run of the network timer, so that Blender stays responsive
+    # while a large room is joined
+    commands_time_budget: bpy.props.IntProperty(name="Commands Time Budget (ms)", default=20, min=1)
+
     VRtist: bpy.props.StringProperty(
         name="VRtist", default=os.environ.get("VRTIST_EXE", "D:/unity/VRtist/Build/VRtist.exe"), subtype="FILE_PATH"
     )
@@ -151,12 +155,6 @@ class MixerPreferences(bpy.types.AddonPreferences):
     display_selections_gizmos: bpy.props.BoolProperty(default=True, name="Display Selection Gizmos")
     display_selections_names_gizmos: bpy.props.BoolProperty(default=True, name="Display Selection User Names")
 
-    commands_send_interval: bpy.props.FloatProperty(
-        name="Command Send Interval",
-        description="Debug tool to specify a number of seconds to wait between each command emission toward the server.",
-        default=0,
-    )
-
     def draw(self, context):
         draw_preferences_ui(self, context)
 
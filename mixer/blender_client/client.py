@@ -33,12 +33,13 @@ The main function in this file is BlenderClient.network_consumer, which is the f
 we register.
 """
 
+import collections
 import logging
 import os
 import struct
 import time
 import traceback
-from typing import Dict, Tuple, Optional
+from typing import Callable, Deque, Dict, List, Tuple, Optional
 from enum import IntEnum
 
 import bpy
@@ -135,7 +136,8 @@ class BlenderClient(Client):
     """
 
     def __init__(self, host=common.DEFAULT_HOST, port=common.DEFAULT_PORT):
-        super(BlenderClient, self).__init__(host, port)
+        # the socket is read and written by a network thread, so that the timer is not blocked by the network
+        super(BlenderClient, self).__init__(host, port, background_io=True)
 
         # To know if we have to tag messages as synced time messages
         # Is set to True for messages emitted from a frame change event
@@ -148,12 +150,21 @@ class BlenderClient(Client):
         # affect blender data and will trigger a depsgraph update; in that case we want to ignore it
         # because it will produce some kind of infinite recursive update
         self.block_signals = False
-        # block_signals is set to True when our timer transforms received commands into scene updates
+        # block_signals is set to True when our timer transforms received commands into scene updates, and between
+        # the runs of the timer while a room is joined or a command group is open, since the scene is partly updated
 
         self._joining: bool = False
         self._joining_room_name: Optional[str] = None
         self._received_command_count: int = 0
         self._received_byte_size: int = 0
+        self.resume_deadline: Optional[float] = None  # time.monotonic() until which the connection is attempted again
+
+        # The received commands are applied within a time budget at each run of network_consumer(), so the state of
+        # the processing is kept between the runs
+        self._received_commands: Deque[common.Command] = collections.deque()
+        self._command_groups: List[float] = []  # time.monotonic() of the GROUP_BEGIN without their GROUP_END yet
+        self._delayed_messages: List[Callable] = []
+        self._data_dirty: bool = False
 
         self.command_pack = None
 
@@ -494,9 +505,9 @@ class BlenderClient(Client):
         channel_index, index = common.decode_int(data, index)
         if not hasattr(ob, channel):
             ob = ob.data
-        frames, index = common.decode_int_array(data, index)
-        values, index = common.decode_float_array(data, index)
-        interpolations, index = common.decode_int_array(data, index)
+        frames, index = common.decode_typed_array(data, index, "I")
+        values, index = common.decode_typed_array(data, index, "f")
+        interpolations, index = common.decode_typed_array(data, index, "I")
 
         animation_data = ob.animation_data
         if animation_data:
@@ -593,26 +604,26 @@ class BlenderClient(Client):
             if len(obj.modifiers) > 0:
                 mesh_name = obj.name_full + "_" + mesh_name
 
-        binary_buffer = common.encode_string(path) + common.encode_string(mesh_name)
+        writer = common.BufferWriter()
+        writer.write_string(path)
+        writer.write_string(mesh_name)
 
-        binary_buffer += mesh_api.encode_mesh(
-            obj, get_mixer_prefs().send_base_meshes, get_mixer_prefs().send_baked_meshes
-        )
+        mesh_api.encode_mesh(writer, obj, get_mixer_prefs().send_base_meshes, get_mixer_prefs().send_baked_meshes)
 
         # For now include material slots in the same message, but maybe it should be a separated message
         # like Transform
         material_link_dict = {"OBJECT": 0, "DATA": 1}
         material_links = [material_link_dict[slot.link] for slot in obj.material_slots]
         assert len(material_links) == len(obj.data.materials)
-        binary_buffer += struct.pack(f"{len(material_links)}I", *material_links)
+        writer.write_struct(f"{len(material_links)}I", *material_links)
 
         for slot in obj.material_slots:
             if slot.link == "DATA":
-                binary_buffer += common.encode_string("")
+                writer.write_string("")
             else:
-                binary_buffer += common.encode_string(slot.material.name if slot.material is not None else "")
+                writer.write_string(slot.material.name if slot.material is not None else "")
 
-        self.add_command(common.Command(MessageType.MESH, binary_buffer, 0))
+        self.add_command(common.Command(MessageType.MESH, writer.getvalue(), 0))
 
     def build_mesh(self, command_data):
         index = 0
@@ -887,19 +898,23 @@ class BlenderClient(Client):
         # Documentation to update if you change "blender_windows": doc/protocol.md
         return {"blender_windows": windows, common.ClientAttributes.USERSCENES: scene_attributes}
 
-    def network_consumer(self):
+    def network_consumer(self) -> bool:
         """
         This method can be considered the entry point of this class. It is meant to be called regularly to send
         pending commands to the server, and receive then process new ones.
 
         Pending commands are accumulated with add_command(), most calls originate from handlers function.
 
-        Incoming commands are read from the socket and directly processed here to update Blender's data. This can
-        be costly and a possible optimization in the future would be to split the processing accross several timer
-        run. This can be challenging because we need to keep the current update state. Maybe this can be solved
-        naturally with coroutines.
+        Incoming commands are received and parsed by the network thread of the client, see Client, and processed
+        here to update Blender's data. Processing stops when the commands_time_budget preference is spent, so that
+        Blender can redraw while a large room is joined, and resumes at the next call. The command groups, the
+        joining progress and the updates deferred until the end of the groups are kept between the calls, and the
+        signals remain blocked between the calls until the room is joined and the groups are closed, so that the
+        handlers do not send the diff of a partly updated scene.
 
         We call it from the timer registered by the addon.
+
+        Returns True if received commands remain to be processed.
         """
 
         from mixer.bl_panels import redraw as redraw_panels, update_ui_lists
@@ -908,258 +923,267 @@ class BlenderClient(Client):
 
         set_draw_handlers()
 
-        # Loop remains infinite while we have GROUP_BEGIN commands without their corresponding GROUP_END received
-        # todo Change this -> probably not a good idea because the sending client might disconnect before GROUP_END occurs
-        # or it needs to be guaranteed by the server
-        groups = []
-        while True:
-            received_commands = self.fetch_commands(get_mixer_prefs().commands_send_interval)
-
-            set_dirty = True
-            delayed_messages = []
-            # Process all received commands
-            for command in received_commands:
-                if self._joining and command.type.value > common.MessageType.COMMAND.value:
-                    self._received_byte_size += command.byte_size()
-                    self._received_command_count += 1
-                    if self._joining_room_name in self.rooms_attributes:
-                        get_mixer_props().joining_percentage = (
-                            self._received_byte_size
-                            / self.rooms_attributes[self._joining_room_name][RoomAttributes.BYTE_SIZE]
-                        )
-                        redraw_panels()
-
-                if command.type == MessageType.GROUP_BEGIN:
-                    groups.append(time.monotonic())
+        received_commands = self._received_commands
+        received_commands.extend(self.fetch_commands())
+
+        groups = self._command_groups
+        delayed_messages = self._delayed_messages
+        start = time.monotonic()
+        budget = get_mixer_prefs().commands_time_budget / 1000
+        # Process the received commands until the time budget is spent, the remaining ones at the next call
+        while received_commands and time.monotonic() - start < budget:
+            command = received_commands.popleft()
+            if self._joining and command.type.value > common.MessageType.COMMAND.value:
+                self._received_byte_size += command.byte_size()
+                self._received_command_count += 1
+
+            if command.type == MessageType.GROUP_BEGIN:
+                groups.append(time.monotonic())
+                continue
+
+            if command.type == MessageType.GROUP_END:
+                if not groups:
+                    logger.warning("GROUP_END received without GROUP_BEGIN, ignored")
                     continue
+                elapse = time.monotonic() - groups.pop()
+                group_id = len(groups)
+                share_data.receive_sanity_check()
+                logger.warning(f"Command group {group_id} processed in {elapse:.1f} seconds")
+                continue
 
-                if command.type == MessageType.GROUP_END:
-                    elapse = time.monotonic() - groups.pop()
-                    group_id = len(groups)
-                    share_data.receive_sanity_check()
-                    logger.warning(f"Command group {group_id} processed in {elapse:.1f} seconds")
-                    continue
+            if self.has_default_handler(command.type):
+                if command.type == MessageType.JOIN_ROOM and self._joining:
+                    self._joining = False
+                    get_mixer_props().joining_percentage = 1
 
-                if self.has_default_handler(command.type):
-                    if command.type == MessageType.JOIN_ROOM and self._joining:
-                        self._joining = False
-                        get_mixer_props().joining_percentage = 1
+                update_ui_lists()
+                self.block_signals = False  # todo investigate why we should but this to false here
+                continue
 
-                    update_ui_lists()
-                    self.block_signals = False  # todo investigate why we should but this to false here
-                    continue
+            if not self._data_dirty:
+                share_data.set_dirty()
+                self._data_dirty = True
+
+            self.block_signals = True
 
-                if set_dirty:
-                    share_data.set_dirty()
-                    set_dirty = False
-
-                self.block_signals = True
-
-                try:
-                    # manage wrapped commands with this blender id
-                    # time synced command for now
-                    # Consume messages with its client_id to receive commands from other clients
-                    # like play/pause. Ignore all other client_id.
-                    if command.type == MessageType.CLIENT_ID_WRAPPER:
-                        id, index = common.decode_string(command.data, 0)
-                        if id != share_data.client.client_id:
-                            continue
-                        command_type, index = common.decode_int(command.data, index)
-                        command_data = command.data[index:]
-                        command = common.Command(command_type, command_data)
-
-                    if command.type == MessageType.CONTENT:
-                        # The server asks for scene content (at room creation)
-                        try:
-                            assert share_data.client.current_room is not None
-                            self.set_room_attributes(
-                                share_data.client.current_room,
-                                {"vrtist_protocol": get_mixer_prefs().vrtist_protocol},
-                            )
-                            send_scene_content()
-                            # Inform end of content
-                            self.add_command(common.Command(MessageType.CONTENT))
-                        except Exception as e:
-                            raise SendSceneContentFailed() from e
+            try:
+                # manage wrapped commands with this blender id
+                # time synced command for now
+                # Consume messages with its client_id to receive commands from other clients
+                # like play/pause. Ignore all other client_id.
+                if command.type == MessageType.CLIENT_ID_WRAPPER:
+                    id, index = common.decode_string(command.data, 0)
+                    if id != share_data.client.client_id:
                         continue
+                    command_type, index = common.decode_int(command.data, index)
+                    command_data = command.data[index:]
+                    command = common.Command(command_type, command_data)
+
+                if command.type == MessageType.CONTENT:
+                    # The server asks for scene content (at room creation)
+                    try:
+                        assert share_data.client.current_room is not None
+                        self.set_room_attributes(
+                            share_data.client.current_room,
+                            {"vrtist_protocol": get_mixer_prefs().vrtist_protocol},
+                        )
+                        send_scene_content()
+                        # Inform end of content
+                        self.add_command(common.Command(MessageType.CONTENT))
+                    except Exception as e:
+                        raise SendSceneContentFailed() from e
+                    continue
 
-                    # Put this to true by default
-                    # todo Check build commands that do not trigger depsgraph update
-                    # because it can lead to ignoring real updates when a false positive is encountered
-                    command_triggers_depsgraph_update = True
-
-                    if command.type == MessageType.GREASE_PENCIL_MESH:
-                        grease_pencil_api.build_grease_pencil_mesh(command.data)
-                    elif command.type == MessageType.GREASE_PENCIL_MATERIAL:
-                        grease_pencil_api.build_grease_pencil_material(command.data)
-                    elif command.type == MessageType.GREASE_PENCIL_CONNECTION:
-                        grease_pencil_api.build_grease_pencil_connection(command.data)
-
-                    elif command.type == MessageType.CLEAR_CONTENT:
-                        clear_scene_content()
-                        self._joining = True
-                        self._received_command_count = 0
-                        self._received_byte_size = 0
-                        get_mixer_props().joining_percentage = 0
-                        redraw_panels()
-                    elif command.type == MessageType.MESH:
-                        self.build_mesh(command.data)
-                    elif command.type == MessageType.TRANSFORM:
-                        self.build_transform(command.data)
-                    elif command.type == MessageType.MATERIAL:
-                        material_api.build_material(command.data)
-                    elif command.type == MessageType.ASSIGN_MATERIAL:
-                        material_api.build_assign_material(command.data)
-                    elif command.type == MessageType.DELETE:
-                        self.build_delete(command.data)
-                    elif command.type == MessageType.CAMERA:
-                        camera_api.build_camera(command.data)
-                    elif command.type == MessageType.LIGHT:
-                        light_api.build_light(command.data)
-                    elif command.type == MessageType.RENAME:
-                        self.build_rename(command.data)
-                    elif command.type == MessageType.DUPLICATE:
-                        self.build_duplicate(command.data)
-                    elif command.type == MessageType.SEND_TO_TRASH:
-                        self.build_send_to_trash(command.data)
-                    elif command.type == MessageType.RESTORE_FROM_TRASH:
-                        self.build_restore_from_trash(command.data)
-                    elif command.type == MessageType.TEXTURE:
-                        self.build_texture_file(command.data)
-
-                    elif command.type == MessageType.COLLECTION:
-                        collection_api.build_collection(command.data)
-                    elif command.type == MessageType.COLLECTION_REMOVED:
-                        collection_api.build_collection_removed(command.data)
-
-                    elif command.type == MessageType.INSTANCE_COLLECTION:
-                        collection_api.build_collection_instance(command.data)
-
-                    elif command.type == MessageType.ADD_COLLECTION_TO_COLLECTION:
-                        collection_api.build_collection_to_collection(command.data)
-                    elif command.type == MessageType.REMOVE_COLLECTION_FROM_COLLECTION:
-                        collection_api.build_remove_collection_from_collection(command.data)
-                    elif command.type == MessageType.ADD_OBJECT_TO_COLLECTION:
-                        collection_api.build_add_object_to_collection(command.data)
-                    elif command.type == MessageType.REMOVE_OBJECT_FROM_COLLECTION:
-                        collection_api.build_remove_object_from_collection(command.data)
-
-                    elif command.type == MessageType.ADD_COLLECTION_TO_SCENE:
-                        scene_api.build_collection_to_scene(command.data)
-                    elif command.type == MessageType.REMOVE_COLLECTION_FROM_SCENE:
-                        scene_api.build_remove_collection_from_scene(command.data)
-                    elif command.type == MessageType.ADD_OBJECT_TO_SCENE:
-                        scene_api.build_add_object_to_scene(command.data)
-                    elif command.type == MessageType.REMOVE_OBJECT_FROM_SCENE:
-                        scene_api.build_remove_object_from_scene(command.data)
-
-                    elif command.type == MessageType.SCENE:
-                        scene_api.build_scene(command.data)
-
-                    elif command.type == MessageType.OBJECT_VISIBILITY:
-                        object_api.build_object_visibility(command.data)
-
-                    elif command.type == MessageType.FRAME:
-                        self.build_frame(command.data)
-                    elif command.type == MessageType.QUERY_CURRENT_FRAME:
-                        self.query_current_frame()
-                    elif command.type == MessageType.FRAME_START_END:
-                        self.build_start_end_frame(command.data)
-
-                    elif command.type == MessageType.PLAY:
-                        self.build_play(command.data)
-                    elif command.type == MessageType.PAUSE:
-                        self.build_pause(command.data)
-                    elif command.type == MessageType.ADD_KEYFRAME:
-                        self.build_add_keyframe(command.data)
-                    elif command.type == MessageType.REMOVE_KEYFRAME:
-                        self.build_remove_keyframe(command.data)
-                    elif command.type == MessageType.MOVE_KEYFRAME:
-                        self.build_move_keyframe(command.data)
-                    elif command.type == MessageType.ANIMATION:
-                        self.build_add_animation(command.data)
-                    elif command.type == MessageType.QUERY_ANIMATION_DATA:
-                        self.build_query_animation_data(command.data)
-
-                    elif command.type == MessageType.CLEAR_ANIMATIONS:
-                        self.build_clear_animations(command.data)
-                    elif command.type == MessageType.SHOT_MANAGER_MONTAGE_MODE:
-                        self.build_montage_mode(command.data)
-                    elif command.type == MessageType.SHOT_MANAGER_ACTION:
-                        shot_manager.build_shot_manager_action(command.data)
-
-                    elif command.type == MessageType.ADD_CONSTRAINT:
-                        constraint_api.build_add_constraint(command.data)
-                    elif command.type == MessageType.REMOVE_CONSTRAINT:
-                        constraint_api.build_remove_constraint(command.data)
-                    elif command.type == MessageType.ASSET_BANK:
-                        delayed_messages.append(delayed_message_call(asset_bank.receive_message, command.data))
-                    elif command.type == MessageType.SAVE:
-                        self.build_save(command.data)
-
-                    elif command.type == MessageType.BLENDER_DATA_UPDATE:
-                        data_api.build_data_update(command.data)
-                    elif command.type == MessageType.BLENDER_DATA_REMOVE:
-                        data_api.build_data_remove(command.data)
-                    elif command.type == MessageType.BLENDER_DATA_CREATE:
-                        data_api.build_data_create(command.data)
-                    elif command.type == MessageType.BLENDER_DATA_RENAME:
-                        data_api.build_data_rename(command.data)
-                    elif command.type == MessageType.BLENDER_DATA_MEDIA:
-                        data_api.build_data_media(command.data)
-
-                    else:
-                        # Command is ignored, so no depsgraph update can be triggered
-                        command_triggers_depsgraph_update = False
-
-                    if command_triggers_depsgraph_update:
-                        self.skip_next_depsgraph_update = True
-
-                except Exception as e:
-                    logger.warning(f"Exception during processing of message {str(command.type)}")
-                    for line in traceback.format_exc().splitlines():
-                        logger.warning(line)
-
-                    if isinstance(e, SendSceneContentFailed):
-                        raise
-
-                finally:
-                    self.block_signals = False
-
-            if not groups:
-                break
-
-        if not set_dirty:
-            share_data.update_current_data()
-
-        # Some messages must change the scene and send an update
-        previous_skip_next = self.skip_next_depsgraph_update
-        for delayed_message in delayed_messages:
-            self.skip_next_depsgraph_update = False
-            delayed_message()
-        self.skip_next_depsgraph_update = previous_skip_next
-
-        # Some objects may have been obtained before their parent
-        # In that case we resolve parenting here
-        # todo Parenting strategy should be changed: we should store the name of the parent in the command instead of
-        # having a path as name
-        if len(share_data.pending_parenting) > 0:
-            remaining_parentings = set()
-            for path in share_data.pending_parenting:
-                path_elem = path.split("/")
-                ob = None
-                parent = None
-                for elem in path_elem:
-                    ob = share_data.blender_objects.get(elem)
-                    if not ob:
-                        remaining_parentings.add(path)
-                        break
-                    if ob.parent != parent:  # do it only if needed, otherwise it resets matrix_parent_inverse
-                        ob.parent = parent
-                    parent = ob
-            share_data.pending_parenting = remaining_parentings
+                # Put this to true by default
+                # todo Check build commands that do not trigger depsgraph update
+                # because it can lead to ignoring real updates when a false positive is encountered
+                command_triggers_depsgraph_update = True
+
+                if command.type == MessageType.GREASE_PENCIL_MESH:
+                    grease_pencil_api.build_grease_pencil_mesh(command.data)
+                elif command.type == MessageType.GREASE_PENCIL_MATERIAL:
+                    grease_pencil_api.build_grease_pencil_material(command.data)
+                elif command.type == MessageType.GREASE_PENCIL_CONNECTION:
+                    grease_pencil_api.build_grease_pencil_connection(command.data)
+
+                elif command.type == MessageType.CLEAR_CONTENT:
+                    clear_scene_content()
+                    # the groups left open by the content that was cleared will not be closed
+                    groups.clear()
+                    self._joining = True
+                    self._received_command_count = 0
+                    self._received_byte_size = 0
+                    get_mixer_props().joining_percentage = 0
+                    redraw_panels()
+                elif command.type == MessageType.MESH:
+                    self.build_mesh(command.data)
+                elif command.type == MessageType.TRANSFORM:
+                    self.build_transform(command.data)
+                elif command.type == MessageType.MATERIAL:
+                    material_api.build_material(command.data)
+                elif command.type == MessageType.ASSIGN_MATERIAL:
+                    material_api.build_assign_material(command.data)
+                elif command.type == MessageType.DELETE:
+                    self.build_delete(command.data)
+                elif command.type == MessageType.CAMERA:
+                    camera_api.build_camera(command.data)
+                elif command.type == MessageType.LIGHT:
+                    light_api.build_light(command.data)
+                elif command.type == MessageType.RENAME:
+                    self.build_rename(command.data)
+                elif command.type == MessageType.DUPLICATE:
+                    self.build_duplicate(command.data)
+                elif command.type == MessageType.SEND_TO_TRASH:
+                    self.build_send_to_trash(command.data)
+                elif command.type == MessageType.RESTORE_FROM_TRASH:
+                    self.build_restore_from_trash(command.data)
+                elif command.type == MessageType.TEXTURE:
+                    self.build_texture_file(command.data)
+
+                elif command.type == MessageType.COLLECTION:
+                    collection_api.build_collection(command.data)
+                elif command.type == MessageType.COLLECTION_REMOVED:
+                    collection_api.build_collection_removed(command.data)
+
+                elif command.type == MessageType.INSTANCE_COLLECTION:
+                    collection_api.build_collection_instance(command.data)
+
+                elif command.type == MessageType.ADD_COLLECTION_TO_COLLECTION:
+                    collection_api.build_collection_to_collection(command.data)
+                elif command.type == MessageType.REMOVE_COLLECTION_FROM_COLLECTION:
+                    collection_api.build_remove_collection_from_collection(command.data)
+                elif command.type == MessageType.ADD_OBJECT_TO_COLLECTION:
+                    collection_api.build_add_object_to_collection(command.data)
+                elif command.type == MessageType.REMOVE_OBJECT_FROM_COLLECTION:
+                    collection_api.build_remove_object_from_collection(command.data)
+
+                elif command.type == MessageType.ADD_COLLECTION_TO_SCENE:
+                    scene_api.build_collection_to_scene(command.data)
+                elif command.type == MessageType.REMOVE_COLLECTION_FROM_SCENE:
+                    scene_api.build_remove_collection_from_scene(command.data)
+                elif command.type == MessageType.ADD_OBJECT_TO_SCENE:
+                    scene_api.build_add_object_to_scene(command.data)
+                elif command.type == MessageType.REMOVE_OBJECT_FROM_SCENE:
+                    scene_api.build_remove_object_from_scene(command.data)
+
+                elif command.type == MessageType.SCENE:
+                    scene_api.build_scene(command.data)
+
+                elif command.type == MessageType.OBJECT_VISIBILITY:
+                    object_api.build_object_visibility(command.data)
+
+                elif command.type == MessageType.FRAME:
+                    self.build_frame(command.data)
+                elif command.type == MessageType.QUERY_CURRENT_FRAME:
+                    self.query_current_frame()
+                elif command.type == MessageType.FRAME_START_END:
+                    self.build_start_end_frame(command.data)
+
+                elif command.type == MessageType.PLAY:
+                    self.build_play(command.data)
+                elif command.type == MessageType.PAUSE:
+                    self.build_pause(command.data)
+                elif command.type == MessageType.ADD_KEYFRAME:
+                    self.build_add_keyframe(command.data)
+                elif command.type == MessageType.REMOVE_KEYFRAME:
+                    self.build_remove_keyframe(command.data)
+                elif command.type == MessageType.MOVE_KEYFRAME:
+                    self.build_move_keyframe(command.data)
+                elif command.type == MessageType.ANIMATION:
+                    self.build_add_animation(command.data)
+                elif command.type == MessageType.QUERY_ANIMATION_DATA:
+                    self.build_query_animation_data(command.data)
+
+                elif command.type == MessageType.CLEAR_ANIMATIONS:
+                    self.build_clear_animations(command.data)
+                elif command.type == MessageType.SHOT_MANAGER_MONTAGE_MODE:
+                    self.build_montage_mode(command.data)
+                elif command.type == MessageType.SHOT_MANAGER_ACTION:
+                    shot_manager.build_shot_manager_action(command.data)
+
+                elif command.type == MessageType.ADD_CONSTRAINT:
+                    constraint_api.build_add_constraint(command.data)
+                elif command.type == MessageType.REMOVE_CONSTRAINT:
+                    constraint_api.build_remove_constraint(command.data)
+                elif command.type == MessageType.ASSET_BANK:
+                    delayed_messages.append(delayed_message_call(asset_bank.receive_message, command.data))
+                elif command.type == MessageType.SAVE:
+                    self.build_save(command.data)
+
+                elif command.type == MessageType.BLENDER_DATA_UPDATE:
+                    data_api.build_data_update(command.data)
+                elif command.type == MessageType.BLENDER_DATA_REMOVE:
+                    data_api.build_data_remove(command.data)
+                elif command.type == MessageType.BLENDER_DATA_CREATE:
+                    data_api.build_data_create(command.data)
+                elif command.type == MessageType.BLENDER_DATA_RENAME:
+                    data_api.build_data_rename(command.data)
+                elif command.type == MessageType.BLENDER_DATA_MEDIA:
+                    data_api.build_data_media(command.data)
+
+                else:
+                    # Command is ignored, so no depsgraph update can be triggered
+                    command_triggers_depsgraph_update = False
+
+                if command_triggers_depsgraph_update:
+                    self.skip_next_depsgraph_update = True
+
+            except Exception as e:
+                logger.warning(f"Exception during processing of message {str(command.type)}")
+                for line in traceback.format_exc().splitlines():
+                    logger.warning(line)
+
+                if isinstance(e, SendSceneContentFailed):
+                    raise
+
+            finally:
+                self.block_signals = False
+
+        if self._joining and self._joining_room_name in self.rooms_attributes:
+            get_mixer_props().joining_percentage = (
+                self._received_byte_size / self.rooms_attributes[self._joining_room_name][RoomAttributes.BYTE_SIZE]
+            )
+            redraw_panels()
+
+        if not groups:
+            # Do not work on the data of incomplete command groups
+            if self._data_dirty:
+                share_data.update_current_data()
+                self._data_dirty = False
+
+            # Some messages must change the scene and send an update
+            previous_skip_next = self.skip_next_depsgraph_update
+            for delayed_message in delayed_messages:
+                self.skip_next_depsgraph_update = False
+                delayed_message()
+            delayed_messages.clear()
+            self.skip_next_depsgraph_update = previous_skip_next
+
+            # Some objects may have been obtained before their parent
+            # In that case we resolve parenting here
+            # todo Parenting strategy should be changed: we should store the name of the parent in the command instead
+            # of having a path as name
+            if len(share_data.pending_parenting) > 0:
+                remaining_parentings = set()
+                for path in share_data.pending_parenting:
+                    path_elem = path.split("/")
+                    ob = None
+                    parent = None
+                    for elem in path_elem:
+                        ob = share_data.blender_objects.get(elem)
+                        if not ob:
+                            remaining_parentings.add(path)
+                            break
+                        if ob.parent != parent:  # do it only if needed, otherwise it resets matrix_parent_inverse
+                            ob.parent = parent
+                        parent = ob
+                share_data.pending_parenting = remaining_parentings
+
+        # The scene is partly updated until the room is joined and the groups are closed
+        self.block_signals = self._joining or bool(groups)
 
         self.set_client_attributes(self.compute_client_custom_attributes())
+        return bool(received_commands)
 
 
 def update_params(obj):
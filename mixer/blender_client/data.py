@@ -23,7 +23,7 @@ from __future__ import annotations
 import itertools
 import logging
 import traceback
-from typing import List, TYPE_CHECKING
+from typing import List, Optional, TYPE_CHECKING
 
 from mixer.blender_data.json_codec import Codec, DecodeError, EncodeError
 from mixer.blender_data.messages import (
@@ -32,8 +32,10 @@ from mixer.blender_data.messages import (
     BlenderRemoveMessage,
     BlenderRenamesMessage,
 )
-from mixer.broadcaster.common import Command, MessageType
-from mixer.local_data import get_local_or_create_cache_file
+from mixer.blender_data.proxy import DeltaReplace, DeltaUpdate, Proxy
+from mixer.blender_data.struct_proxy import StructProxy
+from mixer.broadcaster.common import Command, MessageType, make_coalescing_key
+from mixer.local_data import write_local_or_cache_file_block
 from mixer.share_data import share_data
 
 if TYPE_CHECKING:
@@ -47,11 +49,13 @@ logger = logging.getLogger(__name__)
 
 
 def send_media_creations(proxy: DatablockProxy):
-    bytes_ = BlenderMediaMessage.encode(proxy)
-    if bytes_ and proxy._media:
-        logger.info("send_media_creations %s: %d bytes", proxy._media[0], len(bytes_))
-        command = Command(MessageType.BLENDER_DATA_MEDIA, bytes_, 0)
-        share_data.client.add_command(command)
+    if not proxy._media:
+        return
+    logger.info("send_media_creations %s", proxy._media[0])
+    key = make_coalescing_key(proxy.mixer_uuid)
+    # the media stored by the server are sent as references
+    blocks = BlenderMediaMessage.encode_blocks(proxy, share_data.client.server_media_hashes)
+    share_data.client.add_command_stream(Command(MessageType.BLENDER_DATA_MEDIA, block, 0, key) for block in blocks)
 
 
 def build_data_media(buffer: bytes):
@@ -59,9 +63,17 @@ def build_data_media(buffer: bytes):
     # The packed data with be saved to file, not a problem
     message = BlenderMediaMessage()
     message.decode(buffer)
-    logger.info("build_data_media %s: %d bytes", message.path, len(message.bytes_))
+    logger.debug(
+        "build_data_media %s: %d bytes at %d of %d",
+        message.path,
+        len(message.bytes_),
+        message.offset,
+        message.total_size,
+    )
     # TODO this does not overwrite outdated local files
-    get_local_or_create_cache_file(message.path, message.bytes_)
+    write_local_or_cache_file_block(
+        message.path, message.content_hash, message.offset, message.total_size, message.bytes_
+    )
 
 
 def send_data_creations(proxies: CreationChangeset):
@@ -86,10 +98,53 @@ def send_data_creations(proxies: CreationChangeset):
             return
 
         buffer = BlenderDataMessage.encode(datablock_proxy, encoded_proxy)
-        command = Command(MessageType.BLENDER_DATA_CREATE, buffer, 0)
+        # the key lets the server drop the whole lifecycle of the datablock when it is removed
+        command = Command(MessageType.BLENDER_DATA_CREATE, buffer, 0, make_coalescing_key(datablock_proxy.mixer_uuid))
         share_data.client.add_command(command)
 
 
+def _leaf_paths(struct_diff: StructProxy, prefix: str) -> Optional[List[str]]:
+    paths = []
+    for name, delta in struct_diff._data.items():
+        path = f"{prefix}{name}"
+        value = delta.value
+        if isinstance(delta, (DeltaUpdate, DeltaReplace)) and not isinstance(value, Proxy):
+            paths.append(path)
+        elif isinstance(delta, DeltaUpdate) and type(value) is StructProxy:
+            sub_paths = _leaf_paths(value, path + ".")
+            if sub_paths is None:
+                return None
+            paths.extend(sub_paths)
+        else:
+            # collections, references and other partial updates are not superseded by a later update
+            # of the same attribute
+            return None
+    return paths
+
+
+def _update_field_group(datablock_diff: DatablockProxy) -> Optional[str]:
+    """
+    Return the field group of the coalescing key of an update, or None if the update must not be coalesced.
+
+    An update can only supersede a previous update that sets exactly the same fields, and only if it completely
+    replaces their values, which is checked conservatively.
+    """
+    if datablock_diff._media is not None:
+        return None
+
+    paths = _leaf_paths(datablock_diff, "")
+    if paths is None:
+        return None
+
+    paths.extend(f"soa:{'.'.join(str(item) for item in path)}" for path in datablock_diff._soas.keys())
+    paths.extend(f"arrays:{name}" for name in datablock_diff.arrays.keys())
+    custom_properties = datablock_diff._custom_properties
+    if custom_properties is not None and (custom_properties._dict or custom_properties._rna_ui):
+        paths.append("custom_properties")
+
+    return ",".join(sorted(paths))
+
+
 def send_data_updates(updates: UpdateChangeset):
     if share_data.use_vrtist_protocol():
         return
@@ -107,7 +162,9 @@ def send_data_updates(updates: UpdateChangeset):
             continue
 
         buffer = BlenderDataMessage.encode(update.value, encoded_update)
-        command = Command(MessageType.BLENDER_DATA_UPDATE, buffer, 0)
+        field_group = _update_field_group(update.value)
+        coalescing_key = make_coalescing_key(update.value.mixer_uuid, field_group)
+        command = Command(MessageType.BLENDER_DATA_UPDATE, buffer, 0, coalescing_key)
         share_data.client.add_command(command)
 
 
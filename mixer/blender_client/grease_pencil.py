@@ -15,8 +15,6 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
-import struct
-
 from mixer.blender_client.misc import get_or_create_object_data, get_object_path
 from mixer.broadcaster import common
 from mixer.broadcaster.client import Client
@@ -24,9 +22,9 @@ from mixer.share_data import share_data
 import bpy
 
 
-def send_grease_pencil_stroke(stroke):
-    buffer = common.encode_int(stroke.material_index)
-    buffer += common.encode_int(stroke.line_width)
+def send_grease_pencil_stroke(writer: common.BufferWriter, stroke):
+    writer.write_int(stroke.material_index)
+    writer.write_int(stroke.line_width)
 
     points = list()
 
@@ -35,26 +33,22 @@ def send_grease_pencil_stroke(stroke):
         points.append(point.pressure)
         points.append(point.strength)
 
-    binary_points_buffer = common.int_to_bytes(len(stroke.points), 4) + struct.pack(f"{len(points)}f", *points)
-    buffer += binary_points_buffer
-    return buffer
+    writer.write_struct(f"1I{len(points)}f", len(stroke.points), *points)
 
 
-def send_grease_pencil_frame(frame):
-    buffer = common.encode_int(frame.frame_number)
-    buffer += common.encode_int(len(frame.strokes))
+def send_grease_pencil_frame(writer: common.BufferWriter, frame):
+    writer.write_int(frame.frame_number)
+    writer.write_int(len(frame.strokes))
     for stroke in frame.strokes:
-        buffer += send_grease_pencil_stroke(stroke)
-    return buffer
+        send_grease_pencil_stroke(writer, stroke)
 
 
-def send_grease_pencil_layer(layer, name):
-    buffer = common.encode_string(name)
-    buffer += common.encode_bool(layer.hide)
-    buffer += common.encode_int(len(layer.frames))
+def send_grease_pencil_layer(writer: common.BufferWriter, layer, name):
+    writer.write_string(name)
+    writer.write_bool(layer.hide)
+    writer.write_int(len(layer.frames))
     for frame in layer.frames:
-        buffer += send_grease_pencil_frame(frame)
-    return buffer
+        send_grease_pencil_frame(writer, frame)
 
 
 def send_grease_pencil_time_offset(client: Client, obj):
@@ -82,21 +76,22 @@ def send_grease_pencil_time_offset(client: Client, obj):
 
 def send_grease_pencil_mesh(client: Client, obj):
     grease_pencil = obj.data
-    buffer = common.encode_string(grease_pencil.name_full)
+    writer = common.BufferWriter()
+    writer.write_string(grease_pencil.name_full)
 
-    buffer += common.encode_int(len(grease_pencil.materials))
+    writer.write_int(len(grease_pencil.materials))
     for material in grease_pencil.materials:
         if not material:
             material_name = "Default"
         else:
             material_name = material.name_full
-        buffer += common.encode_string(material_name)
+        writer.write_string(material_name)
 
-    buffer += common.encode_int(len(grease_pencil.layers))
+    writer.write_int(len(grease_pencil.layers))
     for name, layer in grease_pencil.layers.items():
-        buffer += send_grease_pencil_layer(layer, name)
+        send_grease_pencil_layer(writer, layer, name)
 
-    client.add_command(common.Command(common.MessageType.GREASE_PENCIL_MESH, buffer, 0))
+    client.add_command(common.Command(common.MessageType.GREASE_PENCIL_MESH, writer.getvalue(), 0))
 
     send_grease_pencil_time_offset(client, obj)
 
@@ -111,16 +106,17 @@ def send_grease_pencil_material(client: Client, material):
     fill_enable = gp_material.show_fill
     fill_style = gp_material.fill_style
     fill_color = gp_material.fill_color
-    gp_material_buffer = common.encode_string(material.name_full)
-    gp_material_buffer += common.encode_bool(stroke_enable)
-    gp_material_buffer += common.encode_string(stroke_mode)
-    gp_material_buffer += common.encode_string(stroke_style)
-    gp_material_buffer += common.encode_color(stroke_color)
-    gp_material_buffer += common.encode_bool(stroke_overlap)
-    gp_material_buffer += common.encode_bool(fill_enable)
-    gp_material_buffer += common.encode_string(fill_style)
-    gp_material_buffer += common.encode_color(fill_color)
-    client.add_command(common.Command(common.MessageType.GREASE_PENCIL_MATERIAL, gp_material_buffer, 0))
+    writer = common.BufferWriter()
+    writer.write_string(material.name_full)
+    writer.write_bool(stroke_enable)
+    writer.write_string(stroke_mode)
+    writer.write_string(stroke_style)
+    writer.write_color(stroke_color)
+    writer.write_bool(stroke_overlap)
+    writer.write_bool(fill_enable)
+    writer.write_string(fill_style)
+    writer.write_color(fill_color)
+    client.add_command(common.Command(common.MessageType.GREASE_PENCIL_MATERIAL, writer.getvalue(), 0))
 
 
 def send_grease_pencil_connection(client: Client, obj):
@@ -136,10 +132,10 @@ def build_grease_pencil_connection(data):
     get_or_create_object_data(path, gp)
 
 
-def decode_grease_pencil_stroke(grease_pencil_frame, stroke_index, data, index):
-    material_index, index = common.decode_int(data, index)
-    line_width, index = common.decode_int(data, index)
-    points, index = common.decode_array(data, index, "5f", 5 * 4)
+def decode_grease_pencil_stroke(grease_pencil_frame, stroke_index, reader: common.BufferReader):
+    material_index = reader.read_int()
+    line_width = reader.read_int()
+    points = reader.read_struct_array("5f")
 
     if stroke_index >= len(grease_pencil_frame.strokes):
         stroke = grease_pencil_frame.strokes.new()
@@ -162,11 +158,10 @@ def decode_grease_pencil_stroke(grease_pencil_frame, stroke_index, data, index):
         p[i].co = (point[0], point[1], point[2])
         p[i].pressure = point[3]
         p[i].strength = point[4]
-    return index
 
 
-def decode_grease_pencil_frame(grease_pencil_layer, data, index):
-    grease_pencil_frame, index = common.decode_int(data, index)
+def decode_grease_pencil_frame(grease_pencil_layer, reader: common.BufferReader):
+    grease_pencil_frame = reader.read_int()
     frame = None
     for f in grease_pencil_layer.frames:
         if f.frame_number == grease_pencil_frame:
@@ -174,26 +169,25 @@ def decode_grease_pencil_frame(grease_pencil_layer, data, index):
             break
     if not frame:
         frame = grease_pencil_layer.frames.new(grease_pencil_frame)
-    stroke_count, index = common.decode_int(data, index)
+    stroke_count = reader.read_int()
     for stroke_index in range(stroke_count):
-        index = decode_grease_pencil_stroke(frame, stroke_index, data, index)
-    return index
+        decode_grease_pencil_stroke(frame, stroke_index, reader)
 
 
-def decode_grease_pencil_layer(grease_pencil, data, index):
-    grease_pencil_layer_name, index = common.decode_string(data, index)
+def decode_grease_pencil_layer(grease_pencil, reader: common.BufferReader):
+    grease_pencil_layer_name = reader.read_string()
     layer = grease_pencil.get(grease_pencil_layer_name)
     if not layer:
         layer = grease_pencil.layers.new(grease_pencil_layer_name)
-    layer.hide, index = common.decode_bool(data, index)
-    frame_count, index = common.decode_int(data, index)
+    layer.hide = reader.read_bool()
+    frame_count = reader.read_int()
     for _ in range(frame_count):
-        index = decode_grease_pencil_frame(layer, data, index)
-    return index
+        decode_grease_pencil_frame(layer, reader)
 
 
 def build_grease_pencil_mesh(data):
-    grease_pencil_name, index = common.decode_string(data, 0)
+    reader = common.BufferReader(data)
+    grease_pencil_name = reader.read_string()
 
     grease_pencil = share_data.blender_grease_pencils.get(grease_pencil_name)
     if not grease_pencil:
@@ -201,15 +195,15 @@ def build_grease_pencil_mesh(data):
         share_data._blender_grease_pencils[grease_pencil.name_full] = grease_pencil
 
     grease_pencil.materials.clear()
-    material_count, index = common.decode_int(data, index)
+    material_count = reader.read_int()
     for _ in range(material_count):
-        material_name, index = common.decode_string(data, index)
+        material_name = reader.read_string()
         material = share_data.blender_materials.get(material_name)
         grease_pencil.materials.append(material)
 
-    layer_count, index = common.decode_int(data, index)
+    layer_count = reader.read_int()
     for _ in range(layer_count):
-        index = decode_grease_pencil_layer(grease_pencil, data, index)
+        decode_grease_pencil_layer(grease_pencil, reader)
 
 
 def build_grease_pencil_material(data):
@@ -15,6 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import itertools
 import logging
 import struct
 import array
@@ -112,7 +113,7 @@ def decode_bmesh_layer(data, index, layer_collection, element_seq, decode_layer_
     return index
 
 
-def encode_bmesh_layer(layer_collection, element_seq, extract_layer_tuple_func):
+def encode_bmesh_layer(writer: common.BufferWriter, layer_collection, element_seq, extract_layer_tuple_func):
     buffer = []
     count = 0
     for i in range(len(layer_collection)):
@@ -121,10 +122,9 @@ def encode_bmesh_layer(layer_collection, element_seq, extract_layer_tuple_func):
             buffer.extend(extract_layer_tuple_func(elt, layer))
             count += 1
 
-    binary_buffer = struct.pack("1I", len(layer_collection))
+    writer.write_struct("1I", len(layer_collection))
     if len(layer_collection) > 0:
-        binary_buffer += struct.pack(extract_layer_tuple_func.struct * count, *buffer)
-    return binary_buffer
+        writer.write_struct(extract_layer_tuple_func.struct * count, *buffer)
 
 
 # We cannot iterate directly over bm.loops, so we use a generator
@@ -195,38 +195,28 @@ def encode_baked_mesh(obj):
         original_bm.to_mesh(mesh)
         original_bm.free()
 
+    item_count = len(vertices) + len(normals) + len(uvs) + len(material_indices) + len(indices)
+    writer = common.BufferWriter(4 * (5 + item_count))
+
     # Vericex count + binary vertices buffer
-    size = len(vertices) // 3
-    binary_vertices_buffer = common.int_to_bytes(size, 4) + struct.pack(f"{len(vertices)}f", *vertices)
+    writer.write_struct(f"1I{len(vertices)}f", len(vertices) // 3, *vertices)
 
     # Normals count + binary normals buffer
-    size = len(normals) // 3
-    binary_normals_buffer = common.int_to_bytes(size, 4) + struct.pack(f"{len(normals)}f", *normals)
+    writer.write_struct(f"1I{len(normals)}f", len(normals) // 3, *normals)
 
     # UVs count + binary uvs buffer
-    size = len(uvs) // 2
-    binary_uvs_buffer = common.int_to_bytes(size, 4) + struct.pack(f"{len(uvs)}f", *uvs)
+    writer.write_struct(f"1I{len(uvs)}f", len(uvs) // 2, *uvs)
 
     # material indices + binary material indices buffer
-    size = len(material_indices)
-    binary_material_indices_buffer = common.int_to_bytes(size, 4) + struct.pack(
-        f"{len(material_indices)}I", *material_indices
-    )
+    writer.write_struct(f"1I{len(material_indices)}I", len(material_indices), *material_indices)
 
     # triangle indices count + binary triangle indices buffer
-    size = len(indices) // 3
-    binary_indices_buffer = common.int_to_bytes(size, 4) + struct.pack(f"{len(indices)}I", *indices)
+    writer.write_struct(f"1I{len(indices)}I", len(indices) // 3, *indices)
 
-    return (
-        binary_vertices_buffer
-        + binary_normals_buffer
-        + binary_uvs_buffer
-        + binary_material_indices_buffer
-        + binary_indices_buffer
-    )
+    return writer.getvalue()
 
 
-def encode_base_mesh_geometry(mesh_data):
+def encode_base_mesh_geometry(writer: common.BufferWriter, mesh_data):
 
     # We do not synchronize "select" and "hide" state of mesh elements
     # because we consider them user specific.
@@ -234,8 +224,6 @@ def encode_base_mesh_geometry(mesh_data):
     bm = bmesh.new()
     bm.from_mesh(mesh_data)
 
-    binary_buffer = bytes()
-
     logger.debug("Writing %d vertices", len(bm.verts))
     bm.verts.ensure_lookup_table()
 
@@ -243,7 +231,7 @@ def encode_base_mesh_geometry(mesh_data):
     for vert in bm.verts:
         verts_array.extend((*vert.co,))
 
-    binary_buffer += struct.pack(f"1I{len(verts_array)}f", len(bm.verts), *verts_array)
+    writer.write_struct(f"1I{len(verts_array)}f", len(bm.verts), *verts_array)
 
     # Vertex layers
     # Ignored layers for now:
@@ -253,7 +241,7 @@ def encode_base_mesh_geometry(mesh_data):
     # Other ignored layers:
     # - shape: shape keys are handled with Shape Keys at the mesh and object level
     # - float, int, string: don't really know their role
-    binary_buffer += encode_bmesh_layer(bm.verts.layers.bevel_weight, bm.verts, extract_layer_float)
+    encode_bmesh_layer(writer, bm.verts.layers.bevel_weight, bm.verts, extract_layer_float)
 
     logger.debug("Writing %d edges", len(bm.edges))
     bm.edges.ensure_lookup_table()
@@ -262,15 +250,15 @@ def encode_base_mesh_geometry(mesh_data):
     for edge in bm.edges:
         edges_array.extend((edge.verts[0].index, edge.verts[1].index, edge.smooth, edge.seam))
 
-    binary_buffer += struct.pack(f"1I{len(edges_array)}I", len(bm.edges), *edges_array)
+    writer.write_struct(f"1I{len(edges_array)}I", len(bm.edges), *edges_array)
 
     # Edge layers
     # Ignored layers for now: None
     # Other ignored layers:
     # - freestyle: of type NotImplementedType, maybe reserved for future dev
     # - float, int, string: don't really know their role
-    binary_buffer += encode_bmesh_layer(bm.edges.layers.bevel_weight, bm.edges, extract_layer_float)
-    binary_buffer += encode_bmesh_layer(bm.edges.layers.crease, bm.edges, extract_layer_float)
+    encode_bmesh_layer(writer, bm.edges.layers.bevel_weight, bm.edges, extract_layer_float)
+    encode_bmesh_layer(writer, bm.edges.layers.crease, bm.edges, extract_layer_float)
 
     logger.debug("Writing %d faces", len(bm.faces))
     bm.faces.ensure_lookup_table()
@@ -280,27 +268,25 @@ def encode_base_mesh_geometry(mesh_data):
         faces_array.extend((face.material_index, face.smooth, len(face.verts)))
         faces_array.extend((vert.index for vert in face.verts))
 
-    binary_buffer += struct.pack(f"1I{len(faces_array)}I", len(bm.faces), *faces_array)
+    writer.write_struct(f"1I{len(faces_array)}I", len(bm.faces), *faces_array)
 
     # Face layers
     # Ignored layers for now: None
     # Other ignored layers:
     # - freestyle: of type NotImplementedType, maybe reserved for future dev
     # - float, int, string: don't really know their role
-    binary_buffer += encode_bmesh_layer(bm.faces.layers.face_map, bm.faces, extract_layer_int)
+    encode_bmesh_layer(writer, bm.faces.layers.face_map, bm.faces, extract_layer_int)
 
     # Loops layers
     # A loop is an edge attached to a face (so each edge of a manifold can have 2 loops at most).
     # Ignored layers for now: None
     # Other ignored layers:
     # - float, int, string: don't really know their role
-    binary_buffer += encode_bmesh_layer(bm.loops.layers.uv, loops_iterator(bm), extract_layer_uv)
-    binary_buffer += encode_bmesh_layer(bm.loops.layers.color, loops_iterator(bm), extract_layer_color)
+    encode_bmesh_layer(writer, bm.loops.layers.uv, loops_iterator(bm), extract_layer_uv)
+    encode_bmesh_layer(writer, bm.loops.layers.color, loops_iterator(bm), extract_layer_color)
 
     bm.free()
 
-    return binary_buffer
-
 
 def encode_base_mesh(obj):
 
@@ -312,25 +298,26 @@ def encode_base_mesh(obj):
         # This is temporary, when curves will be fully implemented we will encode something
         return bytes()
 
-    binary_buffer = encode_base_mesh_geometry(mesh_data)
+    writer = common.BufferWriter()
+    encode_base_mesh_geometry(writer, mesh_data)
 
     # Shape keys
     # source https://blender.stackexchange.com/questions/111661/creating-shape-keys-using-python
     if mesh_data.shape_keys is None:
-        binary_buffer += common.encode_int(0)  # Indicate 0 key blocks
+        writer.write_int(0)  # Indicate 0 key blocks
     else:
         logger.debug("Writing %d shape keys", len(mesh_data.shape_keys.key_blocks))
 
-        binary_buffer += common.encode_int(len(mesh_data.shape_keys.key_blocks))
+        writer.write_int(len(mesh_data.shape_keys.key_blocks))
         # Encode names
         for key_block in mesh_data.shape_keys.key_blocks:
-            binary_buffer += common.encode_string(key_block.name)
+            writer.write_string(key_block.name)
         # Encode vertex group names
         for key_block in mesh_data.shape_keys.key_blocks:
-            binary_buffer += common.encode_string(key_block.vertex_group)
+            writer.write_string(key_block.vertex_group)
         # Encode relative key names
         for key_block in mesh_data.shape_keys.key_blocks:
-            binary_buffer += common.encode_string(key_block.relative_key.name)
+            writer.write_string(key_block.relative_key.name)
         # Encode data
         shape_keys_buffer = []
         fmt_str = ""
@@ -341,9 +328,9 @@ def encode_base_mesh(obj):
             fmt_str += f"1I1f1f1f1I{(3 * len(key_block.data))}f"
             for i in range(len(key_block.data)):
                 shape_keys_buffer.extend(key_block.data[i].co)
-        binary_buffer += struct.pack(f"{fmt_str}", *shape_keys_buffer)
+        writer.write_struct(fmt_str, *shape_keys_buffer)
 
-        binary_buffer += common.encode_bool(mesh_data.shape_keys.use_relative)
+        writer.write_bool(mesh_data.shape_keys.use_relative)
 
     # Vertex Groups
     verts_per_group = {}
@@ -355,69 +342,64 @@ def encode_base_mesh(obj):
             if weighted_vertices:
                 weighted_vertices.append((vert.index, vg.weight))
 
-    binary_buffer += common.encode_int(len(obj.vertex_groups))
+    writer.write_int(len(obj.vertex_groups))
     for vertex_group in obj.vertex_groups:
-        binary_buffer += common.encode_string(vertex_group.name)
-        binary_buffer += common.encode_bool(vertex_group.lock_weight)
-        binary_buffer += common.encode_int(len(verts_per_group[vertex_group.index]))
-        for vg_elmt in verts_per_group[vertex_group.index]:
-            binary_buffer += common.encode_int(vg_elmt[0])
-            binary_buffer += common.encode_float(vg_elmt[1])
+        writer.write_string(vertex_group.name)
+        writer.write_bool(vertex_group.lock_weight)
+        weighted_vertices = verts_per_group[vertex_group.index]
+        writer.write_int(len(weighted_vertices))
+        writer.write_struct("if" * len(weighted_vertices), *itertools.chain.from_iterable(weighted_vertices))
 
     # Normals
-    binary_buffer += common.encode_bool(mesh_data.use_auto_smooth)
-    binary_buffer += common.encode_float(mesh_data.auto_smooth_angle)
-    binary_buffer += common.encode_bool(mesh_data.has_custom_normals)
+    writer.write_bool(mesh_data.use_auto_smooth)
+    writer.write_float(mesh_data.auto_smooth_angle)
+    writer.write_bool(mesh_data.has_custom_normals)
 
     if mesh_data.has_custom_normals:
         mesh_data.calc_normals_split()  # Required otherwise all normals are (0, 0, 0)
         normals = []
         for loop in mesh_data.loops:
             normals.extend((*loop.normal,))
-        binary_buffer += struct.pack(f"{len(normals)}f", *normals)
+        writer.write_struct(f"{len(normals)}f", *normals)
 
     # UV Maps
     for uv_layer in mesh_data.uv_layers:
-        binary_buffer += common.encode_string(uv_layer.name)
-        binary_buffer += common.encode_bool(uv_layer.active_render)
+        writer.write_string(uv_layer.name)
+        writer.write_bool(uv_layer.active_render)
 
     # Vertex Colors
     for vertex_colors in mesh_data.vertex_colors:
-        binary_buffer += common.encode_string(vertex_colors.name)
-        binary_buffer += common.encode_bool(vertex_colors.active_render)
+        writer.write_string(vertex_colors.name)
+        writer.write_bool(vertex_colors.active_render)
 
     if obj.type != "MESH":
         obj.to_mesh_clear()
 
-    return binary_buffer
-
+    return writer.getvalue()
 
-def encode_mesh(obj, do_encode_base_mesh, do_encode_baked_mesh):
-    binary_buffer = bytes()
 
+def encode_mesh(writer: common.BufferWriter, obj, do_encode_base_mesh, do_encode_baked_mesh):
     if do_encode_base_mesh:
         logger.info("encode_base_mesh %s", obj.name_full)
         mesh_buffer = encode_base_mesh(obj)
-        binary_buffer += common.encode_int(len(mesh_buffer))
-        binary_buffer += mesh_buffer
+        writer.write_int(len(mesh_buffer))
+        writer.write_bytes(mesh_buffer)
     else:
-        binary_buffer += common.encode_int(0)
+        writer.write_int(0)
 
     if do_encode_baked_mesh:
         logger.info("encode_baked_mesh %s", obj.name_full)
         mesh_buffer = encode_baked_mesh(obj)
-        binary_buffer += common.encode_int(len(mesh_buffer))
-        binary_buffer += mesh_buffer
+        writer.write_int(len(mesh_buffer))
+        writer.write_bytes(mesh_buffer)
     else:
-        binary_buffer += common.encode_int(0)
+        writer.write_int(0)
 
     # Materials
     materials = []
     for material in obj.data.materials:
         materials.append(material.name_full if material is not None else "")
-    binary_buffer += common.encode_string_array(materials)
-
-    return binary_buffer
+    writer.write_string_array(materials)
 
 
 def decode_baked_mesh(obj: Optional[bpy.types.Object], data, index):
@@ -430,7 +412,7 @@ def decode_baked_mesh(obj: Optional[bpy.types.Object], data, index):
     positions, index = common.decode_vector3_array(data, index)
     normals, index = common.decode_vector3_array(data, index)
     uvs, index = common.decode_vector2_array(data, index)
-    material_indices, index = common.decode_int_array(data, index)
+    material_indices, index = common.decode_typed_array(data, index, "I")
     triangles, index = common.decode_int3_array(data, index)
 
     if obj is not None:
@@ -485,11 +467,10 @@ def decode_baked_mesh(obj: Optional[bpy.types.Object], data, index):
 def decode_base_mesh(client, obj: bpy.types.Object, mesh: bpy.types.Mesh, data, index):
     bm = bmesh.new()
 
-    position_count, index = common.decode_int(data, index)
-    logger.debug("Reading %d vertices", position_count)
+    positions, index = common.decode_vector3_array(data, index)
+    logger.debug("Reading %d vertices", len(positions))
 
-    for _pos_idx in range(position_count):
-        co, index = common.decode_vector3(data, index)
+    for co in positions:
         bm.verts.new(co)
 
     bm.verts.ensure_lookup_table()
@@ -556,10 +537,9 @@ def decode_base_mesh(client, obj: bpy.types.Object, mesh: bpy.types.Mesh, data,
             shape_key.value, index = common.decode_float(data, index)
             shape_key.slider_min, index = common.decode_float(data, index)
             shape_key.slider_max, index = common.decode_float(data, index)
-            shape_key_data_size, index = common.decode_int(data, index)
-            for i in range(shape_key_data_size):
-                shape_key.data[i].co = Vector(struct.unpack("3f", data[index : index + 3 * 4]))
-                index += 3 * 4
+            shape_key_positions, index = common.decode_vector3_array(data, index)
+            for i, co in enumerate(shape_key_positions):
+                shape_key.data[i].co = Vector(co)
         obj.data.shape_keys.use_relative, index = common.decode_bool(data, index)
 
     # Vertex Groups
@@ -569,10 +549,8 @@ def decode_base_mesh(client, obj: bpy.types.Object, mesh: bpy.types.Mesh, data,
         vg_name, index = common.decode_string(data, index)
         vertex_group = obj.vertex_groups.new(name=vg_name)
         vertex_group.lock_weight, index = common.decode_bool(data, index)
-        vg_size, index = common.decode_int(data, index)
-        for _elmt_idx in range(vg_size):
-            vert_idx, index = common.decode_int(data, index)
-            weight, index = common.decode_float(data, index)
+        vertex_weights, index = common.decode_struct_array(data, index, "if")
+        for vert_idx, weight in vertex_weights:
             vertex_group.add([vert_idx], weight, "REPLACE")
 
     # Normals
@@ -582,10 +560,7 @@ def decode_base_mesh(client, obj: bpy.types.Object, mesh: bpy.types.Mesh, data,
     has_custom_normal, index = common.decode_bool(data, index)
 
     if has_custom_normal:
-        normals = []
-        for _loop in mesh.loops:
-            normal, index = common.decode_vector3(data, index)
-            normals.append(normal)
+        normals, index = common.decode_struct_items(data, index, "3f", len(mesh.loops))
         mesh.normals_split_custom_set(normals)
 
     # UV Maps and Vertex Colors are added automatically based on layers in the bmesh
@@ -87,9 +87,9 @@ class DatablockProxy(StructProxy):
         Serialized as array"""
 
         # TODO move into _arrays
-        self._media: Optional[Tuple[str, bytes]] = None
-        """Media file data.
-        Serialized as array"""
+        self._media: Optional[Tuple[str, Union[bytes, str]]] = None
+        """Media file path, with the packed data or the absolute path of the file to read the data from.
+        Sent in BLENDER_DATA_MEDIA blocks"""
         self._is_in_shared_folder: Optional[bool] = None
         self._filepath_raw: Optional[str] = None
 
@@ -115,8 +115,7 @@ class DatablockProxy(StructProxy):
         super().clear_data()
         self._soas.clear()
         self._arrays.clear()
-        if self._media:
-            self._media.clear()
+        self._media = None
 
     @property
     def arrays(self):
@@ -307,15 +306,16 @@ class DatablockProxy(StructProxy):
             path = get_source_file_path(self._filepath_raw)
             try:
                 abspath = bpy.path.abspath(path)
-                with open(abspath, "rb") as data_file:
-                    data = data_file.read()
+                # the file is read block by block when it is sent
+                if not pathlib.Path(abspath).is_file():
+                    raise FileNotFoundError(abspath)
             except Exception as e:
                 logger.error(f"Error while loading {abspath!r} ...")
                 logger.error(f"... for {datablock!r}. Check shared folders ...")
                 logger.error(f"... {e!r}")
                 self._media = None
             else:
-                self._media = (path, data)
+                self._media = (path, abspath)
 
     @property
     def collection_name(self) -> str:
@@ -27,8 +27,9 @@ from __future__ import annotations
 import array
 import json
 import logging
+import os
 import traceback
-from typing import List, Optional, Tuple, TYPE_CHECKING, Union
+from typing import Container, Iterator, List, Optional, Tuple, TYPE_CHECKING, Union
 
 from mixer.blender_data.types import ArrayGroup, ArrayGroups, Soa
 
@@ -42,6 +43,13 @@ from mixer.broadcaster.common import (
     encode_string,
     encode_string_array,
 )
+from mixer.broadcaster.media_store import (
+    MEDIA_BLOCK_SIZE,
+    content_hash,
+    decode_media_block,
+    encode_media_block,
+    file_hash,
+)
 
 if TYPE_CHECKING:
     from mixer.blender_data.datablock_proxy import DatablockProxy
@@ -217,25 +225,71 @@ class BlenderRenamesMessage:
 
 
 class BlenderMediaMessage:
+    """
+    A block of a media file, or a reference to a media file that the receiver has in its cache.
+
+    A media file is sent in consecutive blocks read one at a time, so that the file never needs to be loaded in
+    memory, and the receiver writes each block to its cache file. The content hash of the file lets the server store
+    it once for all the rooms, see doc/protocol.md.
+    """
+
     def __init__(self):
         self.path: str = ""
+        self.content_hash: str = ""
+        self.offset: int = 0
+        self.total_size: int = 0
         self.bytes_: bytes = b""
 
     def __lt__(self, other):
         # for sorting by the tests
-        return self.path < other.path
+        return (self.path, self.offset) < (other.path, other.offset)
 
     def decode(self, buffer: bytes) -> int:
-        self.path, index = decode_string(buffer, 0)
+        self.path, self.content_hash, self.offset, self.total_size, index = decode_media_block(buffer)
         self.bytes_ = buffer[index:]
         return len(buffer)
 
     @staticmethod
-    def encode(datablock_proxy: DatablockProxy) -> bytes:
+    def encode(path: str, content_hash: str, offset: int, total_size: int, bytes_) -> bytes:
+        return encode_media_block(path, content_hash, offset, total_size, bytes_)
+
+    @staticmethod
+    def encode_blocks(datablock_proxy: DatablockProxy, known_hashes: Container[str] = ()) -> Iterator[bytes]:
+        """
+        Yield the encoded blocks of the media of datablock_proxy, read when they are requested, or only a reference
+        to the media if its content hash is in known_hashes.
+        """
         media_desc = getattr(datablock_proxy, "_media", None)
         if media_desc is None:
-            return b""
-
-        path, bytes_ = media_desc
-        items = [encode_string(path), bytes_]
-        return b"".join(items)
+            return
+
+        path, source = media_desc
+        if isinstance(source, str):
+            # the absolute path of the file
+            total_size = os.path.getsize(source)
+            hash_ = file_hash(source)
+            if total_size > 0 and hash_ in known_hashes:
+                yield BlenderMediaMessage.encode(path, hash_, 0, total_size, b"")
+                return
+            with open(source, "rb") as data_file:
+                offset = 0
+                while True:
+                    bytes_ = data_file.read(min(MEDIA_BLOCK_SIZE, total_size - offset))
+                    if not bytes_ and offset < total_size:
+                        logger.error(f"Media file {source!r} truncated while sent, at {offset} of {total_size} bytes")
+                        break
+                    yield BlenderMediaMessage.encode(path, hash_, offset, total_size, bytes_)
+                    offset += len(bytes_)
+                    if offset >= total_size:
+                        break
+        else:
+            # the packed data
+            data = memoryview(source)
+            total_size = len(data)
+            hash_ = content_hash(data)
+            if total_size > 0 and hash_ in known_hashes:
+                yield BlenderMediaMessage.encode(path, hash_, 0, total_size, b"")
+                return
+            for offset in range(0, max(total_size, 1), MEDIA_BLOCK_SIZE):
+                block = data[offset : offset + MEDIA_BLOCK_SIZE]
+                yield BlenderMediaMessage.encode(path, hash_, offset, total_size, block)
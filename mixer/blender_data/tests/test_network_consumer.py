@@ -0,0 +1,68 @@
+# GPLv3 License
+#
+# Copyright (C) 2020 Ubisoft
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+from unittest import mock
+
+import bpy
+
+from mixer.blender_client.client import BlenderClient
+from mixer.broadcaster import common
+from mixer.broadcaster.common import MessageType
+from mixer.handlers import handler_send_scene_data_to_server
+from mixer.share_data import share_data
+
+
+def ignored_command() -> common.Command:
+    # a command wrapped for another client, skipped by this one
+    return common.Command(MessageType.CLIENT_ID_WRAPPER, common.encode_string("other client"))
+
+
+class TestNetworkConsumer(unittest.TestCase):
+    def setUp(self):
+        self.client = BlenderClient()
+        self.received = []
+        self.sent = []
+        patches = [
+            mock.patch.object(self.client, "is_connected", return_value=True),
+            mock.patch.object(self.client, "fetch_commands", side_effect=self.fetch_commands),
+            mock.patch.object(self.client, "add_command", side_effect=self.sent.append),
+            mock.patch.object(self.client, "set_client_attributes"),
+            mock.patch("mixer.blender_client.client.set_draw_handlers"),
+            mock.patch.object(share_data, "client", self.client),
+            mock.patch.object(share_data, "update_current_data"),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def fetch_commands(self):
+        received, self.received = self.received, []
+        return received
+
+    def test_group_split_across_calls(self):
+        self.received = [common.Command(MessageType.GROUP_BEGIN), ignored_command()]
+        self.client.network_consumer()
+        self.assertTrue(self.client.block_signals)
+
+        # the handlers do not send the diff of the partly updated scene between the calls
+        handler_send_scene_data_to_server(bpy.context.scene, None)
+        self.assertEqual(self.sent, [])
+
+        self.received = [ignored_command(), common.Command(MessageType.GROUP_END)]
+        self.client.network_consumer()
+        self.assertFalse(self.client.block_signals)
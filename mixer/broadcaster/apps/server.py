@@ -30,20 +30,27 @@ from __future__ import annotations
 
 import logging
 import argparse
+import collections
+import itertools
 import select
+import selectors
 import threading
 import time
 import socket
-import queue
-from typing import List, Mapping, Dict, Optional, Any
+import uuid
+from typing import Any, BinaryIO, Callable, Deque, Dict, Iterator, List, Mapping, Optional, Set, Tuple, Union
 
 from mixer.broadcaster.cli_utils import init_logging, add_logging_cli_args
 import mixer.broadcaster.common as common
 from mixer.broadcaster.common import update_attributes_and_get_diff
+from mixer.broadcaster.command_queue import DEFAULT_HARD_LIMIT, DEFAULT_SOFT_LIMIT, CommandQueue
+from mixer.broadcaster.media_store import MediaBlocks, MediaStore, decode_media_block, is_media_reference
+from mixer.broadcaster.room_log import RoomLog, RoomLogWriter, recover_rooms
+from mixer.broadcaster.room_history import RoomHistory, dead_lifecycle_sequences
+from mixer.broadcaster.relay import RELAYED_REQUESTS, RelayPeers, RoomUplink, parse_address
+from mixer.broadcaster.server_workers import FrontPeers, Peers, WorkerPeers, is_supported as workers_supported
 from mixer.broadcaster.socket import Socket
 
-SHUTDOWN = False
-
 logger = logging.getLogger() if __name__ == "__main__" else logging.getLogger(__name__)
 _log_server_updates: bool = False
 
@@ -51,12 +58,56 @@ _log_server_updates: bool = False
 # client, then release the room mutex while broadcasting
 MAX_BROADCAST_COMMAND_COUNT = 64
 
+# A joining client receives the room log only if it is at most this many times the byte size of the room history,
+# since the log keeps the superseded commands until it is rewritten, see RoomLog._sync()
+SEND_LOG_MAX_RATIO = 1.25
+
+# Seconds between two passes of the background compaction of the room histories
+HISTORY_COMPACTION_INTERVAL = 10.0
+
+# Seconds between two broadcasts of the accumulated room and client updates
+STATUS_UPDATE_INTERVAL = 0.25
+
+# Seconds during which a client disconnected from a room can resume it, see Room.resume_client()
+RESUME_RETENTION = 60.0
+
+# Room attributes computed from the history of a room
+_HISTORY_ROOM_ATTRIBUTES = {common.RoomAttributes.COMMAND_COUNT, common.RoomAttributes.BYTE_SIZE}
+
+# Room attributes set by the server
+_SERVER_ROOM_ATTRIBUTES = {
+    common.RoomAttributes.NAME,
+    common.RoomAttributes.BLENDER_VERSION,
+    common.RoomAttributes.MIXER_VERSION,
+    common.RoomAttributes.IGNORE_VERSION_CHECK,
+    common.RoomAttributes.GENERIC_PROTOCOL,
+    common.RoomAttributes.KEEP_OPEN,
+    common.RoomAttributes.COMMAND_COUNT,
+    common.RoomAttributes.BYTE_SIZE,
+    common.RoomAttributes.JOINABLE,
+}
+
+
+def _room_scoped_attributes(attributes: Mapping[str, Any]) -> Dict[str, Any]:
+    return {key: value for key, value in attributes.items() if key in common.ROOM_SCOPED_CLIENT_ATTRIBUTES}
+
 
 class Connection:
     """ Represent a connection with a client """
 
-    def __init__(self, server: Server, sock: Socket, address):
+    def __init__(self, server: Server, sock: Socket, address, received_commands: Optional[List[common.Command]] = None):
         self.socket: Socket = sock
+        # optional features negotiated with the client, see common.Capabilities
+        self.capabilities: List[str] = []
+        self.compression = False  # the client accepts compressed commands
+        self.batch = False  # the client accepts BATCH messages
+        self.chunks = False  # the client accepts CHUNK messages
+        # the large command being sent in chunks, or the blocks of a stored media being sent
+        self._bulk: Optional[Union[common.FrameChunks, MediaBlocks]] = None
+        self.media_hashes: Set[str] = set()  # content hashes of the media that the client has, see MEDIA_HASHES
+        self._chunk_assembler = common.ChunkAssembler()  # the large command being received in chunks
+        self._reader = common.FrameReader(sock)
+        self._replay: Optional[RoomReplay] = None  # the room history being sent to the client, see replay()
         self.address = address
         self.room: Optional[Room] = None
 
@@ -64,8 +115,39 @@ class Connection:
 
         self.custom_attributes: Dict[str, Any] = {}  # custom attributes are used between clients, but not by the server
 
-        self._command_queue: queue.Queue = queue.Queue()  # Pending commands to send to the client
+        self._command_queue = CommandQueue(server.queue_soft_limit, server.queue_hard_limit)
+        # Pending commands to send to the client
+        self._lagging = False  # last lagging state broadcast to the clients
         self._server = server
+        self.latency: float = 0.0  # seconds
+
+        # commands received by another process of a multi-process server, before it passed the connection, ending
+        # with the chunks of a large command that it did not receive completely
+        self._received_commands: List[common.Command] = self._chunk_assembler.assemble(received_commands or [])
+        # JOIN_ROOM or RESUME for a room of another process of a multi-process server, see Server.hand_off()
+        self.hand_off_command: Optional[common.Command] = None
+        # the client is told the sequence number of the room commands it received, to resume the room after a
+        # disconnection, see Room.resume_client()
+        self.resumable = False
+        self._sent_sequence = 0  # last sequence number sent to the client
+
+        self._command_handlers = {
+            common.MessageType.JOIN_ROOM: self._join_room,
+            common.MessageType.LEAVE_ROOM: self._leave_room,
+            common.MessageType.RESUME: self._resume,
+            common.MessageType.LIST_ROOMS: self._list_rooms,
+            common.MessageType.DELETE_ROOM: self._delete_room,
+            common.MessageType.SEND_ERROR: self.broadcast_error,
+            common.MessageType.SET_ROOM_CUSTOM_ATTRIBUTES: self._set_room_custom_attributes,
+            common.MessageType.SET_ROOM_KEEP_OPEN: self._set_room_keep_open,
+            common.MessageType.LIST_CLIENTS: self._list_clients,
+            common.MessageType.SET_CLIENT_NAME: self._set_client_name,
+            common.MessageType.SET_CLIENT_CUSTOM_ATTRIBUTES: self._set_client_custom_attributes,
+            common.MessageType.CLIENT_ID: self._client_id,
+            common.MessageType.CAPABILITIES: self._capabilities,
+            common.MessageType.MEDIA_HASHES: self._media_hashes,
+            common.MessageType.CONTENT: self._content,
+        }
 
         self.thread: threading.Thread = threading.Thread(None, self.run)
 
@@ -79,133 +161,211 @@ class Connection:
             common.ClientAttributes.IP: self.address[0],
             common.ClientAttributes.PORT: self.address[1],
             common.ClientAttributes.ROOM: self.room.name if self.room is not None else None,
+            common.ClientAttributes.QUEUE_BYTE_SIZE: self._command_queue.byte_size,
+            common.ClientAttributes.LAGGING: self._command_queue.lagging,
         }
 
     def broadcast_error(self, command: common.Command):
         self._server.broadcast_to_all_clients(command)
 
-    def run(self):
-        def _send_error(s: str):
-            logger.error("Sending error %s", s)
-            self.send_command(common.Command(common.MessageType.SEND_ERROR, common.encode_string(s)))
+    def _send_error(self, s: str):
+        logger.error("Sending error %s", s)
+        self.send_command(common.Command(common.MessageType.SEND_ERROR, common.encode_string(s)))
 
-        def _join_room(command: common.Command):
-            if self.room is not None:
-                _send_error(f"Received join_room but room {self.room.name} is already joined")
-                return
-            room_name, index = common.decode_string(command.data, 0)
-            blender_version, index = common.decode_string(command.data, index)
-            mixer_version, index = common.decode_string(command.data, index)
-            ignore_version_check, index = common.decode_bool(command.data, index)
-            generic_protocol, _ = common.decode_bool(command.data, index)
-            try:
-                self._server.join_room(
-                    self, room_name, blender_version, mixer_version, ignore_version_check, generic_protocol
-                )
-            except Exception as e:
-                _send_error(f"{e!r}")
+    def _join_room(self, command: common.Command):
+        if self.room is not None:
+            self._send_error(f"Received join_room but room {self.room.name} is already joined")
+            return
+        room_name, index = common.decode_string(command.data, 0)
+        blender_version, index = common.decode_string(command.data, index)
+        mixer_version, index = common.decode_string(command.data, index)
+        ignore_version_check, index = common.decode_bool(command.data, index)
+        generic_protocol, index = common.decode_bool(command.data, index)
+        join_mode = common.JoinMode.DEFAULT
+        if index < len(command.data):
+            join_mode, index = common.decode_string(command.data, index)
+        if index < len(command.data):
+            self.resumable, _ = common.decode_bool(command.data, index)
+        peers = self._server.peers
+        if peers is not None and not peers.is_local_room(room_name):
+            # run() passes the connection to the process of the room
+            self.hand_off_command = command
+            return
+        try:
+            self._server.join_room(
+                self, room_name, blender_version, mixer_version, ignore_version_check, generic_protocol, join_mode
+            )
+        except Exception as e:
+            self._send_error(f"{e!r}")
 
-        def _leave_room(command: common.Command):
-            if self.room is None:
-                _send_error("Received leave_room but no room is joined")
-                return
-            _ = command.data.decode()  # todo remove room_name from protocol
-            self._server.leave_room(self)
-            self.send_command(common.Command(common.MessageType.LEAVE_ROOM))
+    def _resume(self, command: common.Command):
+        if self.room is not None:
+            self._send_error(f"Received resume but room {self.room.name} is already joined")
+            return
+        room_name, index = common.decode_string(command.data, 0)
+        token, index = common.decode_string(command.data, index)
+        sequence, _ = common.decode_uint64(command.data, index)
+        peers = self._server.peers
+        if peers is not None and not peers.is_local_room(room_name):
+            self.hand_off_command = command
+            return
+        self.resumable = True
+        try:
+            self._server.resume_room(self, room_name, token, sequence)
+        except Exception as e:
+            self._send_error(f"{e!r}")
 
-        def _list_rooms(command: common.Command):
-            self.send_command(self._server.get_list_rooms_command())
+    def _leave_room(self, command: common.Command):
+        if self.room is None:
+            self._send_error("Received leave_room but no room is joined")
+            return
+        _ = command.data.decode()  # todo remove room_name from protocol
+        self._server.leave_room(self)
+        self.send_command(common.Command(common.MessageType.LEAVE_ROOM))
+
+    def _list_rooms(self, command: common.Command):
+        self.send_command(self._server.get_list_rooms_command())
 
-        def _delete_room(command: common.Command):
-            self._server.delete_room(command.data.decode())
+    def _delete_room(self, command: common.Command):
+        self._server.delete_room(command.data.decode())
 
-        def _set_custom_attributes(custom_attributes: Mapping[str, Any]):
-            diff = update_attributes_and_get_diff(self.custom_attributes, custom_attributes)
-            self._server.broadcast_client_update(self, diff)
+    def _set_custom_attributes(self, custom_attributes: Mapping[str, Any]):
+        diff = update_attributes_and_get_diff(self.custom_attributes, custom_attributes)
+        self._server.broadcast_client_update(self, diff)
 
-        def _set_client_name(command: common.Command):
-            _set_custom_attributes({common.ClientAttributes.USERNAME: command.data.decode()})
+    def _set_client_name(self, command: common.Command):
+        self._set_custom_attributes({common.ClientAttributes.USERNAME: command.data.decode()})
 
-        def _list_clients(command: common.Command):
-            self.send_command(self._server.get_list_clients_command())
+    def _list_clients(self, command: common.Command):
+        self.send_command(self._server.get_list_clients_command(self))
 
-        def _set_client_custom_attributes(command: common.Command):
-            _set_custom_attributes(common.decode_json(command.data, 0)[0])
+    def _set_client_custom_attributes(self, command: common.Command):
+        self._set_custom_attributes(common.decode_json(command.data, 0)[0])
 
-        def _set_room_custom_attributes(command: common.Command):
-            room_name, offset = common.decode_string(command.data, 0)
-            custom_attributes, _ = common.decode_json(command.data, offset)
-            self._server.set_room_custom_attributes(room_name, custom_attributes)
+    def _set_room_custom_attributes(self, command: common.Command):
+        room_name, offset = common.decode_string(command.data, 0)
+        custom_attributes, _ = common.decode_json(command.data, offset)
+        self._server.set_room_custom_attributes(room_name, custom_attributes)
 
-        def _set_room_keep_open(command: common.Command):
-            room_name, offset = common.decode_string(command.data, 0)
-            value, _ = common.decode_bool(command.data, offset)
-            self._server.set_room_keep_open(room_name, value)
+    def _set_room_keep_open(self, command: common.Command):
+        room_name, offset = common.decode_string(command.data, 0)
+        value, _ = common.decode_bool(command.data, offset)
+        self._server.set_room_keep_open(room_name, value)
 
-        def _client_id(command: common.Command):
+    def _client_id(self, command: common.Command):
+        self.send_command(
+            common.Command(common.MessageType.CLIENT_ID, f"{self.address[0]}:{self.address[1]}".encode("utf8"))
+        )
+
+    def _capabilities(self, command: common.Command):
+        requested, _ = common.decode_string_array(command.data, 0)
+        self.enable_capabilities([name for name in requested if name in self._server.capabilities])
+        self.send_command(
+            common.Command(common.MessageType.CAPABILITIES, common.encode_string_array(self.capabilities))
+        )
+
+    def enable_capabilities(self, capabilities: List[str]):
+        self.capabilities = capabilities
+        self.compression = common.Capabilities.COMPRESSION in capabilities
+        self.batch = common.Capabilities.BATCH in capabilities
+        self.chunks = common.Capabilities.CHUNKS in capabilities
+
+    def _media_hashes(self, command: common.Command):
+        hashes, _ = common.decode_string_array(command.data, 0)
+        self.media_hashes.update(hashes)
+        media_store = self._server.media_store
+        if media_store is not None:
             self.send_command(
-                common.Command(common.MessageType.CLIENT_ID, f"{self.address[0]}:{self.address[1]}".encode("utf8"))
+                common.Command(common.MessageType.MEDIA_HASHES, common.encode_string_array(media_store.hashes()))
             )
 
-        def _content(command: common.Command):
-            if self.room is None:
-                _send_error("Unjoined client trying to set room joinable")
-                return
-            if self.room.joinable:
-                _send_error(f"Trying to set joinable room {self.room.name} which is already joinable")
-                return
-            self.room.joinable = True
-            self._server.broadcast_room_update(self.room, {common.RoomAttributes.JOINABLE: True})
-
-        command_handlers = {
-            common.MessageType.JOIN_ROOM: _join_room,
-            common.MessageType.LEAVE_ROOM: _leave_room,
-            common.MessageType.LIST_ROOMS: _list_rooms,
-            common.MessageType.DELETE_ROOM: _delete_room,
-            common.MessageType.SEND_ERROR: lambda x: self.broadcast_error(x),
-            common.MessageType.SET_ROOM_CUSTOM_ATTRIBUTES: _set_room_custom_attributes,
-            common.MessageType.SET_ROOM_KEEP_OPEN: _set_room_keep_open,
-            common.MessageType.LIST_CLIENTS: _list_clients,
-            common.MessageType.SET_CLIENT_NAME: _set_client_name,
-            common.MessageType.SET_CLIENT_CUSTOM_ATTRIBUTES: _set_client_custom_attributes,
-            common.MessageType.CLIENT_ID: _client_id,
-            common.MessageType.CONTENT: _content,
-        }
+    def _add_media(self, command: common.Command):
+        """
+        Write a media block to the media store, and add to the room the reference that replaces the media once it is
+        complete.
+        """
+        assert self.room is not None and self._server.media_store is not None
+        reference = self._server.media_store.add_block(command, self.unique_id)
+        if reference is None:
+            return
+        if reference is not command and not is_media_reference(command):
+            # the client does not need to upload this media again
+            hash_ = decode_media_block(reference.data)[1]
+            self.send_command(common.Command(common.MessageType.MEDIA_HASHES, common.encode_string_array([hash_])))
+        self.room.add_command(reference, self)
+
+    def _content(self, command: common.Command):
+        if self.room is None:
+            self._send_error("Unjoined client trying to set room joinable")
+            return
+        if self.room.joinable:
+            self._send_error(f"Trying to set joinable room {self.room.name} which is already joinable")
+            return
+        self.room.joinable = True
+        if self.room.uplink is not None:
+            self.room.uplink.send(command)
+        self._server.broadcast_room_update(self.room, {common.RoomAttributes.JOINABLE: True})
+
+    def handle_command(self, command: common.Command):
+        """
+        Process a command received from the client.
+        """
+        if _log_server_updates or command.type not in (common.MessageType.SET_CLIENT_CUSTOM_ATTRIBUTES,):
+            logger.debug("Received from %s - %s", self.unique_id, command.type)
+
+        if command.type in RELAYED_REQUESTS and isinstance(self._server.peers, RelayPeers):
+            self._server.peers.forward(command)
+
+        if command.type in self._command_handlers:
+            self._command_handlers[command.type](command)
+        elif command.type.value > common.MessageType.COMMAND.value:
+            if (
+                command.type == common.MessageType.BLENDER_DATA_MEDIA
+                and self.room is not None
+                and self.room.uplink is None
+                and self._server.media_store is not None
+            ):
+                self._add_media(command)
+            elif self.room is not None:
+                self.room.add_command(command, self)
+            else:
+                logger.warning(
+                    "%s:%s - %s received but no room was joined",
+                    self.address[0],
+                    self.address[1],
+                    command.type,
+                )
+        else:
+            logger.error("Command %s received but no handler for it on server", command.type)
 
+    def run(self):
         def _handle_incoming_commands():
-            received_commands = common.read_all_messages(self.socket)
+            received_commands = self._received_commands + self._chunk_assembler.assemble(
+                common.unpack_batches(self._reader.read())
+            )
+            self._received_commands = []
             count = len(received_commands)
             if count > 0:
                 # upstream
                 time.sleep(self.latency)
                 logger.debug("Received from %s - %d commands ", self.unique_id, count)
 
-            for command in received_commands:
-                if _log_server_updates or command.type not in (common.MessageType.SET_CLIENT_CUSTOM_ATTRIBUTES,):
-                    logger.debug("Received from %s - %s", self.unique_id, command.type)
-
-                if command.type in command_handlers:
-                    command_handlers[command.type](command)
-                elif command.type.value > common.MessageType.COMMAND.value:
-                    if self.room is not None:
-                        self.room.add_command(command, self)
-                    else:
-                        logger.warning(
-                            "%s:%s - %s received but no room was joined",
-                            self.address[0],
-                            self.address[1],
-                            command.type,
-                        )
-                else:
-                    logger.error("Command %s received but no handler for it on server", command.type)
+            for index, command in enumerate(received_commands):
+                self.handle_command(command)
+                if self.hand_off_command is not None:
+                    # the large command being received continues on the connection
+                    pending = self._chunk_assembler.pending()
+                    self._server.hand_off(self, [self.hand_off_command, *received_commands[index + 1 :], *pending])
+                    return
 
         def _handle_outgoing_commands():
             self.fetch_outgoing_commands()
 
-        global SHUTDOWN
-        while not SHUTDOWN:
+        while not self._server.shutting_down:
             try:
                 _handle_incoming_commands()
+                if self.hand_off_command is not None:
+                    return
                 _handle_outgoing_commands()
             except common.ClientDisconnectedException:
                 break
@@ -217,32 +377,498 @@ class Connection:
         self._server.handle_client_disconnect(self)
 
     def fetch_outgoing_commands(self):
+        """
+        Send the queued commands, in batches written with a single system call when possible.
+        """
         while True:
-            try:
-                command = self._command_queue.get_nowait()
-            except queue.Empty:
+            self._check_queue()
+            buffers = self._next_buffers()
+            if not buffers:
                 break
+            common.write_buffers(self.socket, buffers)
 
-            self.send_command(command)
-            self._command_queue.task_done()
+    def _next_buffers(self) -> List[Any]:
+        """
+        Return the buffers of the next queued commands to write with a single system call, or an empty list if no
+        command is queued. Meant to be used by the thread that sends the commands.
 
-    def add_command(self, command: common.Command):
+        The frame of a large command is sent in CHUNK messages to the clients that accept them, a chunk per call.
+        Meanwhile, the interactive commands are sent between the chunks and the other commands wait in the queue.
+        A reference to a stored media is sent the same way, as the blocks of the media, unless the client has it.
+        """
+        command_queue = self._command_queue
+        commands: List[common.Command] = []
+        byte_size = 0
+        drained = False
+        while byte_size < common.SEND_BATCH_BYTE_SIZE and len(commands) < _SEND_COMMAND_COUNT:
+            command = command_queue.get(interactive_only=self._bulk is not None)
+            if command is None and self._bulk is None and self._replay is not None:
+                command = next(self._replay, None)
+                if command is None:
+                    # the end of the replay queued the last commands
+                    self._replay = None
+                    continue
+            if command is None:
+                drained = self._bulk is None
+                break
+            self._log_send(command)
+            if self.chunks and self._bulk is None and command.byte_size() > common.CHUNK_SIZE:
+                self._bulk = common.FrameChunks(command.frame_buffers(self.compression))
+                continue
+            if self._server.media_store is not None and is_media_reference(command):
+                self._bulk = self._media_blocks(command)
+                if self._bulk is not None:
+                    continue
+            commands.append(command)
+            byte_size += command.byte_size()
+
+        buffers = common.commands_buffers(commands, self.compression, self.batch)
+        if self._bulk is not None:
+            buffers.extend(self._bulk.next_chunk())
+            if self._bulk.done:
+                self._bulk = None
+        elif drained:
+            buffers.extend(self._sequence_buffers())
+        return buffers
+
+    def _media_blocks(self, reference: common.Command) -> Optional[MediaBlocks]:
+        """
+        Return the blocks to send in place of a reference to a stored media, or None if the client has the media.
+        """
+        assert self._server.media_store is not None
+        hash_ = decode_media_block(reference.data)[1]
+        if hash_ in self.media_hashes:
+            return None
+        self.media_hashes.add(hash_)
+        return self._server.media_store.blocks(reference)
+
+    def _sequence_buffers(self) -> Tuple[Any, ...]:
+        """
+        Return the frame buffers of the ROOM_SEQUENCE message that follows the room commands returned by the queue,
+        if the client must be told of a new sequence number. Meant to be used by the thread that sends the commands.
+        """
+        sequence = self._command_queue.sequence
+        if not self.resumable or sequence == self._sent_sequence:
+            return ()
+        self._sent_sequence = sequence
+        command = common.Command(common.MessageType.ROOM_SEQUENCE, common.encode_uint64(sequence))
+        self._log_send(command)
+        return command.frame_buffers()
+
+    def _check_queue(self):
+        """
+        Apply the slow consumer policy. Meant to be used by the thread that sends the commands.
+        Raise ClientDisconnectedException when the client must be disconnected.
+        """
+        command_queue = self._command_queue
+        if command_queue.overflowed:
+            message = (
+                f"Disconnected by the server: more than {command_queue.hard_limit} bytes waiting to be sent, "
+                "the network connection is too slow"
+            )
+            logger.error("%s: %s", self.unique_id, message)
+            self._send_overflow_error(common.Command(common.MessageType.SEND_ERROR, common.encode_string(message)))
+            raise common.ClientDisconnectedException()
+
+        lagging = command_queue.lagging
+        if lagging != self._lagging:
+            self._lagging = lagging
+            if lagging:
+                logger.warning("%s is lagging: %d bytes waiting to be sent", self.unique_id, command_queue.byte_size)
+            self._server.broadcast_client_update(
+                self,
+                {
+                    common.ClientAttributes.QUEUE_BYTE_SIZE: command_queue.byte_size,
+                    common.ClientAttributes.LAGGING: lagging,
+                },
+            )
+
+    def _send_overflow_error(self, command: common.Command):
+        # Best effort, without waiting for the client that does not read its socket
+        try:
+            _, writable, _ = select.select([], [self.socket._socket], [], 0)
+            if writable:
+                self.socket.send(command.to_byte_buffer())
+        except OSError:
+            pass
+
+    def add_command(self, command: common.Command, replay: bool = False, sequence: Optional[int] = None):
         """
         Add command to be consumed later. Meant to be used by other threads.
+
+        Replayed commands come from the room history and are not counted in the queue limits. Room commands have the
+        sequence number that follows them in the room history.
+        """
+        self._command_queue.put(command, replay, sequence)
+
+    def add_sequence(self, sequence: int):
+        """
+        Tell a resumable client that it has the room commands up to sequence once the queued commands are sent.
+        """
+        if self.resumable:
+            self._command_queue.put_sequence(sequence)
+
+    def replay(self, replay: "RoomReplay"):
+        """
+        Queue the commands of a room history for a joining client. Meant to be used by this thread, that queues them
+        all before it handles the next commands of the client.
+        """
+        try:
+            for command in replay:
+                self.add_command(command, replay=True)
+        except BaseException:
+            replay.close()
+            raise
+
+    def stop_replay(self) -> Optional["Room"]:
+        """
+        Abandon the replay of a room history, for a client that disconnects while joining. Return the room it was
+        joining, if any.
         """
-        self._command_queue.put(command)
+        replay = self._replay
+        self._replay = None
+        if replay is None or not replay.close():
+            return None
+        return replay.room
 
     def send_command(self, command: common.Command):
         """
         Directly send a command to the socket. Meant to be used by this thread.
         """
         assert threading.current_thread() is self.thread
+        self._log_send(command)
+        common.write_message(self.socket, command, self.compression)
+
+    def send_file(self, file: BinaryIO, offset: int, count: int) -> bool:
+        """
+        Directly send count bytes of file from offset to the socket, without copying them through Python objects
+        where the platform supports it. Meant to be used by this thread.
+        Return False if the connection cannot send files.
+        """
+        assert threading.current_thread() is self.thread
+        try:
+            self.socket.sendfile(file, offset, count)
+        except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError) as e:
+            logger.warning(e)
+            raise common.ClientDisconnectedException()
+        return True
+
+    def _log_send(self, command: common.Command):
         if _log_server_updates or command.type not in (
             common.MessageType.CLIENT_UPDATE,
             common.MessageType.ROOM_UPDATE,
         ):
             logger.debug("Sending to %s:%s - %s", self.address[0], self.address[1], command.type)
-        common.write_message(self.socket, command)
+
+
+class EventLoopConnection(Connection):
+    """
+    Connection served by an EventLoop instead of a dedicated thread.
+
+    The socket is non blocking. Incoming bytes are accumulated until complete frames are available and outgoing
+    commands are written when the socket is writable, so that the event loop thread never blocks on a client.
+    """
+
+    def __init__(self, server: Server, sock: Socket, address, event_loop: EventLoop):
+        super().__init__(server, sock, address)
+        self._event_loop = event_loop
+        self._write_buffers: Deque[memoryview] = collections.deque()  # frame buffers of the commands being written
+        self._write_byte_size = 0  # bytes remaining in _write_buffers
+        self.writing = False  # True when registered to the event loop for write events, only used by the loop
+        # commands received while joining a room, handled once the client is in the room
+        self._held_commands: Deque[common.Command] = collections.deque()
+
+    def start(self):
+        self.socket.setblocking(False)
+        self._event_loop.register(self)
+
+    def add_command(self, command: common.Command, replay: bool = False, sequence: Optional[int] = None):
+        """
+        Add command to be sent when the socket is writable. Can be used from any thread.
+        """
+        self._command_queue.put(command, replay, sequence)
+        self._event_loop.request_write(self)
+
+    def add_sequence(self, sequence: int):
+        if self.resumable:
+            self._command_queue.put_sequence(sequence)
+            self._event_loop.request_write(self)
+
+    def replay(self, replay: "RoomReplay"):
+        """
+        Send the commands of a room history as the socket accepts them, so that the event loop does not walk the
+        history at once while the other connections wait.
+        """
+        self._replay = replay
+        self._event_loop.request_write(self)
+
+    def send_command(self, command: common.Command):
+        """
+        Queue a command to be sent by the event loop, since the socket cannot be written synchronously.
+        """
+        self.add_command(command)
+
+    def fetch_outgoing_commands(self):
+        # Outgoing commands are written by the event loop when the socket becomes writable
+        pass
+
+    def send_file(self, file: BinaryIO, offset: int, count: int) -> bool:
+        # The socket is non blocking and must not block the event loop
+        return False
+
+    def has_pending_writes(self) -> bool:
+        return (
+            bool(self._write_buffers)
+            or self._bulk is not None
+            or self._replay is not None
+            or not self._command_queue.empty()
+        )
+
+    def handle_read(self):
+        """
+        Read available bytes and process all complete commands.
+        Raise ClientDisconnectedException if the socket is disconnected.
+        """
+        try:
+            commands = self._reader.receive()
+        except BlockingIOError:
+            return
+
+        commands = self._chunk_assembler.assemble(common.unpack_batches(commands))
+        if commands:
+            logger.debug("Received from %s - %d commands ", self.unique_id, len(commands))
+        self._held_commands.extend(commands)
+        self._handle_held_commands()
+
+    def _handle_held_commands(self):
+        while self._held_commands and self._replay is None:
+            self.handle_command(self._held_commands.popleft())
+
+    def handle_write(self) -> bool:
+        """
+        Write as many pending commands as the socket accepts.
+        Return True if all pending commands were written.
+        Raise ClientDisconnectedException if the socket is disconnected.
+        """
+        self._check_queue()
+        while True:
+            # gather the next commands, to write them with a single system call
+            if (
+                self._write_byte_size < common.SEND_BATCH_BYTE_SIZE
+                and len(self._write_buffers) < common.SEND_BATCH_BUFFER_COUNT
+            ):
+                for buffer in self._next_buffers():
+                    view = memoryview(buffer).cast("B")
+                    self._write_buffers.append(view)
+                    self._write_byte_size += len(view)
+                if self._replay is None:
+                    self._handle_held_commands()
+
+            if not self._write_buffers:
+                self._check_queue()
+                return True
+
+            try:
+                sent = common.send_buffers(self.socket, self._write_buffers)
+            except BlockingIOError:
+                return False
+            except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError) as e:
+                logger.warning(e)
+                raise common.ClientDisconnectedException()
+            self._write_byte_size -= sent
+
+
+# Maximum number of commands gathered to be written with a single system call
+_SEND_COMMAND_COUNT = common.SEND_BATCH_BUFFER_COUNT // 2
+
+
+class EventLoop:
+    """
+    Multiplex the sockets of all the connections of a server on a single thread.
+
+    Idle connections cost nothing: the loop sleeps in the selector until a socket is readable, or until a thread
+    queues an outgoing command, in which case the loop is woken up through a socket pair.
+    """
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._selector.register(self._wakeup_reader, selectors.EVENT_READ, None)
+
+        # connections that requested a write from another thread, protected by _pending_mutex
+        self._pending_writes: Set[EventLoopConnection] = set()
+        self._pending_mutex = threading.Lock()
+        self._wakeup_requested = False
+
+        self._connections: Set[EventLoopConnection] = set()
+        self.thread: Optional[threading.Thread] = None
+
+    def register(self, connection: EventLoopConnection):
+        self._connections.add(connection)
+        self._selector.register(connection.socket._socket, selectors.EVENT_READ, connection)
+
+    def unregister(self, connection: EventLoopConnection):
+        if connection not in self._connections:
+            return
+        self._connections.remove(connection)
+        try:
+            self._selector.unregister(connection.socket._socket)
+        except (KeyError, ValueError):
+            pass
+
+    def request_write(self, connection: EventLoopConnection):
+        """
+        Ensure that the loop will write the pending commands of connection. Can be used from any thread.
+        """
+        if threading.current_thread() is self.thread:
+            self._enable_write(connection)
+            return
+
+        with self._pending_mutex:
+            self._pending_writes.add(connection)
+            if self._wakeup_requested:
+                return
+            self._wakeup_requested = True
+        self.wakeup()
+
+    def wakeup(self):
+        try:
+            self._wakeup_writer.send(b"\0")
+        except OSError:
+            # the socket pair buffer is full, so a wakeup is already pending
+            pass
+
+    def _enable_write(self, connection: EventLoopConnection):
+        if connection.writing or connection not in self._connections:
+            return
+        connection.writing = True
+        self._selector.modify(connection.socket._socket, selectors.EVENT_READ | selectors.EVENT_WRITE, connection)
+
+    def _disable_write(self, connection: EventLoopConnection):
+        connection.writing = False
+        self._selector.modify(connection.socket._socket, selectors.EVENT_READ, connection)
+
+    def _handle_wakeup(self):
+        try:
+            while self._wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+        with self._pending_mutex:
+            pending = self._pending_writes
+            self._pending_writes = set()
+            self._wakeup_requested = False
+
+        for connection in pending:
+            self._enable_write(connection)
+
+    def run(self, server: Server, listening_socket: socket.socket):
+        self.thread = threading.current_thread()
+        self._selector.register(listening_socket, selectors.EVENT_READ, listening_socket)
+
+        try:
+            while not server.shutting_down:
+                # The timeout is only needed to handle KeyboardInterrupt on platforms where it does not interrupt select
+                events = self._selector.select(timeout=0.5)
+                for key, mask in events:
+                    if key.data is None:
+                        self._handle_wakeup()
+                    elif key.data is listening_socket:
+                        server.accept(listening_socket)
+                    else:
+                        self._handle_connection_events(server, key.data, mask)
+        finally:
+            self._selector.unregister(listening_socket)
+            for connection in list(self._connections):
+                self._close(server, connection)
+
+    def _handle_connection_events(self, server: Server, connection: EventLoopConnection, mask: int):
+        if connection not in self._connections:
+            # closed while handling a previous event of this iteration
+            return
+        try:
+            if mask & selectors.EVENT_READ:
+                connection.handle_read()
+            if connection.writing and connection in self._connections and connection.handle_write():
+                self._disable_write(connection)
+        except common.ClientDisconnectedException:
+            self._close(server, connection)
+        except Exception:
+            logger.exception("Exception during command processing. Disconnecting")
+            logger.error(
+                f"Disconnecting {connection.custom_attributes.get(common.ClientAttributes.USERNAME, 'Unknown')}"
+            )
+            self._close(server, connection)
+
+    def _close(self, server: Server, connection: EventLoopConnection):
+        self.unregister(connection)
+        server.handle_client_disconnect(connection)
+
+
+class RoomReplay:
+    """
+    The commands of a room history sent to a joining client, read from the history as they are sent.
+
+    Once the commands that remain are few enough, they are queued and the client is added to the room while holding
+    the room mutex, so that it receives the commands of the room in order, see Room._finish_sync().
+    """
+
+    def __init__(
+        self,
+        room: "Room",
+        connection: Connection,
+        offset: int,
+        on_joined: Optional[Callable[[], None]],
+        commands: Optional[Iterator[common.Command]] = None,
+    ):
+        self._room = room
+        self._connection = connection
+        self._offset = offset  # sequence number of the first command that follows self._commands
+        self._on_joined = on_joined
+        self._commands = commands if commands is not None else iter(())
+        self._done = False
+
+    def __iter__(self) -> Iterator[common.Command]:
+        return self
+
+    def __next__(self) -> common.Command:
+        while True:
+            command = next(self._commands, None)
+            if command is not None:
+                return command
+            if self._done:
+                raise StopIteration
+
+            room = self._room
+            self._connection.fetch_outgoing_commands()
+            if room._finish_sync(self._connection, self._offset):
+                self._done = True
+                if self._on_joined is not None:
+                    self._on_joined()
+                raise StopIteration
+
+            # the commands that were added since the last check
+            end = room._history.next_sequence
+            commands = itertools.takewhile(lambda item: item[0] < end, room._history.commands_since(self._offset))
+            self._commands = (command for _, command in commands)
+            self._offset = end
+
+    @property
+    def room(self) -> "Room":
+        return self._room
+
+    def close(self) -> bool:
+        """
+        Stop the replay, returning True if the client was not added to the room yet.
+        """
+        if self._done:
+            return False
+        self._done = True
+        self._room._abandon_sync()
+        return True
 
 
 class Room:
@@ -261,79 +887,187 @@ class Room:
         mixer_version: str,
         ignore_version_check: bool,
         generic_protocol: bool,
-        creator: Connection,
+        creator: Optional[Connection],
     ):
+        """
+        Without creator, the room is restored by the server and its content is added with restore_commands().
+        """
+        self._server = server
         self.name = room_name
         self.blender_version = blender_version
         self.mixer_version = mixer_version
         self.ignore_version_check = ignore_version_check
         self.generic_protocol = generic_protocol
         self.keep_open = False  # Should the room remain open when no more clients are inside ?
-        self.byte_size = 0
         self.joinable = False  # A room becomes joinable when its first client has send all the initial content
 
         self.custom_attributes: Dict[str, Any] = {}  # custom attributes are used between clients, but not by the server
 
-        self._commands: List[common.Command] = []
+        self._history = RoomHistory()
+        self._compacted_sequence = 0  # next sequence number of the history when it was last compacted
+        # next sequence numbers of the history at the times of the compactions, to keep the recent commands
+        self._sequence_checkpoints: Deque[Tuple[float, int]] = collections.deque()
 
+        # distinguishes this room from the rooms previously created with the same name, for resuming clients
+        self.token = uuid.uuid4().hex
+        self._resume_floor = 0  # the clients can resume from this sequence number, see resume_client()
+        self.resume_deadline = 0.0  # time.monotonic() until which the room waits for disconnected clients
+        self.log: Optional[RoomLog] = None  # durable copy of the history
+        self.uplink: Optional[RoomUplink] = None  # in relay mode, the client of the room on the main server
+
+        # serializes the modifications of the history and the broadcasting of the commands, so that all the clients
+        # receive the commands in the order of the history
         self._commands_mutex: threading.RLock = threading.RLock()
-        self._connections: List[Connection] = [creator]
+        # replaced by a modified copy under _commands_mutex, so that it can be read without lock
+        self._connections: Tuple[Connection, ...] = (creator,) if creator is not None else ()
 
         self.join_count: int = 0
         # this is used to ensure a room cannot be deleted while clients are joining (creator is not considered to be joining)
         # Server is responsible of increasing / decreasing join_count, with mutex protection
 
+        self._syncing_count = 0
+        # number of clients receiving the history, protected by _commands_mutex. The history is not compacted while
+        # clients are receiving it, since they could receive only a part of a removed lifecycle
+
+        if creator is None:
+            return
+
         creator.room = self
-        creator.send_command(common.Command(common.MessageType.JOIN_ROOM, common.encode_string(self.name)))
+        creator.send_command(self._join_room_command(creator, 0))
+        creator.add_sequence(0)  # the sequence numbers of the previous room of the client do not apply anymore
         creator.send_command(
             common.Command(common.MessageType.CONTENT)
         )  # self.joinable will be set to true by creator later
 
     def client_count(self):
-        return len(self._connections) + self.join_count
+        # the clients receiving the room history are not in self._connections yet
+        return len(self._connections) + self.join_count + self._syncing_count
 
     def command_count(self):
-        return len(self._commands)
+        return self._history.command_count()
+
+    @property
+    def byte_size(self):
+        return self._history.byte_size
+
+    def _join_room_command(self, connection: Connection, sequence: int) -> common.Command:
+        data = common.encode_string(self.name)
+        if connection.resumable:
+            data += common.encode_string(self.token) + common.encode_uint64(sequence)
+        return common.Command(common.MessageType.JOIN_ROOM, data)
 
-    def add_client(self, connection: Connection):
-        logger.info(f"Add Client {connection.unique_id} to Room {self.name}")
+    def add_client(
+        self,
+        connection: Connection,
+        join_mode: str = common.JoinMode.HISTORY,
+        on_joined: Optional[Callable[[], None]] = None,
+    ):
+        """
+        Send the room history to a joining client, then add it to the room and call on_joined. The history is sent
+        by the connection, see Connection.replay(), so that the client may be added after this returns.
+        """
+        logger.info(f"Add Client {connection.unique_id} to Room {self.name} ({join_mode})")
 
         connection.send_command(common.Command(common.MessageType.CLEAR_CONTENT))  # todo temporary size stored here
 
-        offset = 0
+        offset = 0  # sequence number of the first command not yet sent to the joining client
+        state: Iterator[common.Command] = iter(())
+        with self._commands_mutex:
+            self._syncing_count += 1
+            if join_mode == common.JoinMode.STATE:
+                # send the current state grouped by datablock, then the commands received meanwhile in order
+                offset = self._history.next_sequence
+                sequences = self._history.state_sequences()
+                state = (command for _, command in self._history.commands_at(sequences))
+
+        if join_mode != common.JoinMode.STATE and self.log is not None:
+            # stream the durable part of the history from the log, then the commands that follow from memory
+            offset = self._send_log(connection)
+
+        connection.replay(RoomReplay(self, connection, offset, on_joined, state))
+
+    def resume_client(
+        self, connection: Connection, sequence: int, on_joined: Optional[Callable[[], None]] = None
+    ) -> bool:
+        """
+        Add a client that was in the room before a disconnection and has received the commands up to sequence,
+        sending it only the commands that follow, then call on_joined. Return False if the commands that follow
+        sequence are not all in the history anymore, in which case the client must join the room again.
 
-        def _try_finish_sync():
-            connection.fetch_outgoing_commands()
-            with self._commands_mutex:
-                # from here no one can add commands anymore to self._commands (clients can still join and read previous commands)
-                command_count = self.command_count()
-                if command_count - offset > MAX_BROADCAST_COMMAND_COUNT:
-                    return False  # while still more than MAX_BROADCAST_COMMAND_COUNT commands to broadcast, release the mutex
-
-                # now is time to synchronize all room participants: broadcast remaining commands to new client
-                for i in range(offset, command_count):
-                    command = self._commands[i]
-                    connection.add_command(command)
-
-                # now he's part of the room, let him/her know
-                self._connections.append(connection)
-                connection.room = self
-                connection.add_command(common.Command(common.MessageType.JOIN_ROOM, common.encode_string(self.name)))
-                return True
+        The commands that supersede a command are always later in the history, so that only the compaction of
+        the removed entities prevents resuming, see compact_history().
+        """
+        with self._commands_mutex:
+            if not self._resume_floor <= sequence <= self._history.next_sequence:
+                return False
+            self._syncing_count += 1
 
-        while True:
-            if _try_finish_sync():
-                break  # all done
-            # broadcast commands that were added since last check
-            command_count = self.command_count()
-            for i in range(offset, command_count):
-                command = self._commands[i]  # atomic wrt. the GIL
-                connection.add_command(command)
-            offset = command_count
+        logger.info(f"Resume Client {connection.unique_id} in Room {self.name} from {sequence}")
+        connection.send_command(common.Command(common.MessageType.RESUME, common.encode_bool(True)))
+        connection.replay(RoomReplay(self, connection, sequence, on_joined))
+        return True
+
+    def _finish_sync(self, connection: Connection, offset: int) -> bool:
+        """
+        Queue the commands of the history from offset for a joining client and add it to the room, if they are few
+        enough to be queued while holding the mutex, in which case return True.
+        """
+        with self._commands_mutex:
+            # from here no one can add commands anymore to self._history (clients can still join and read previous commands)
+            if self._history.next_sequence - offset > MAX_BROADCAST_COMMAND_COUNT:
+                return (
+                    False  # while still more than MAX_BROADCAST_COMMAND_COUNT commands to broadcast, release the mutex
+                )
+
+            # now is time to synchronize all room participants: broadcast remaining commands to new client
+            for _, command in self._history.commands_since(offset):
+                connection.add_command(command, replay=True)
+
+            # now he's part of the room, let him/her know
+            next_sequence = self._history.next_sequence
+            self._syncing_count -= 1
+            self._connections = self._connections + (connection,)
+            connection.room = self
+            connection.add_command(self._join_room_command(connection, next_sequence), sequence=next_sequence)
+            return True
+
+    def _abandon_sync(self):
+        with self._commands_mutex:
+            self._syncing_count -= 1
+
+    def _send_log(self, connection: Connection) -> int:
+        """
+        Send the durable part of the room log to a joining client and return the sequence number of the first
+        command that it does not contain, or 0 if the log could not be sent or is much larger than the history.
+
+        The log may contain commands that were superseded or dropped from the history since they were logged, which
+        is harmless since it also contains the commands that supersede them or end their lifecycle.
+        """
+        assert self.log is not None
+        if self.log.compressed and not connection.compression:
+            return 0
+        if self.log.media_references:
+            # the references are expanded for each client, see Connection._media_blocks()
+            return 0
+        durable = self.log.open_durable()
+        if durable is None:
+            return 0
+        file, next_sequence, size = durable
+        with file:
+            if size > SEND_LOG_MAX_RATIO * self.byte_size:
+                return 0
+            if not connection.send_file(file, 0, size):
+                return 0
+        logger.info(f"Room {self.name}: {size} bytes sent from the log to {connection.unique_id}")
+        return next_sequence
+
+    def connections(self) -> Tuple[Connection, ...]:
+        return self._connections
 
     def remove_client(self, connection: Connection):
         logger.info("Remove Client % s from Room % s", connection.address, self.name)
-        self._connections.remove(connection)
+        with self._commands_mutex:
+            self._connections = tuple(c for c in self._connections if c is not connection)
 
     def attributes_dict(self):
         return {
@@ -348,70 +1082,165 @@ class Room:
             common.RoomAttributes.JOINABLE: self.joinable,
         }
 
-    def add_command(self, command, sender: Connection):
-        def merge_command():
-            """
-            Add the command to the room list, possibly merge with the previous command.
-            """
-            command_type = command.type
-            if (
-                common.MessageType.OPTIMIZED_COMMANDS.value
-                < command_type.value
-                < common.MessageType.END_OPTIMIZED_COMMANDS.value
-            ):
-                command_path = common.decode_string(command.data, 0)[0]
-                if self.command_count() > 0:
-                    stored_command = self._commands[-1]
-                    if (
-                        command_type == stored_command.type
-                        and command_path == common.decode_string(stored_command.data, 0)[0]
-                    ):
-                        self._commands.pop()
-                        self.byte_size -= stored_command.byte_size()
-            if (
-                command_type != common.MessageType.CLIENT_ID_WRAPPER
-                and command_type != common.MessageType.FRAME
-                and command_type != common.MessageType.QUERY_ANIMATION_DATA
-            ):
-                self._commands.append(command)
-                self.byte_size += command.byte_size()
+    def _broadcast_size_update(self, previous_byte_size: int, previous_command_count: int):
+        room_update = {}
+        if self.byte_size != previous_byte_size:
+            room_update[common.RoomAttributes.BYTE_SIZE] = self.byte_size
+        if previous_command_count != self.command_count():
+            room_update[common.RoomAttributes.COMMAND_COUNT] = self.command_count()
+
+        self._server.broadcast_room_update(self, room_update)
 
+    def add_command(self, command, sender: Optional[Connection]):
+        next_sequence: Optional[int] = None  # sequence number that follows command in the history
         with self._commands_mutex:
             current_byte_size = self.byte_size
             current_command_count = self.command_count()
-            merge_command()
-
-            room_update = {}
-            if self.byte_size != current_byte_size:
-                room_update[common.RoomAttributes.BYTE_SIZE] = self.byte_size
-            if current_command_count != self.command_count():
-                room_update[common.RoomAttributes.COMMAND_COUNT] = self.command_count()
-
-            sender._server.broadcast_room_update(self, room_update)
+            if (
+                command.type != common.MessageType.CLIENT_ID_WRAPPER
+                and command.type != common.MessageType.FRAME
+                and command.type != common.MessageType.QUERY_ANIMATION_DATA
+            ):
+                # the history drops the commands superseded by this one
+                sequence = self._history.append(command)
+                if self.log is not None:
+                    self.log.append(sequence, command)
+                next_sequence = sequence + 1
+                if sender is not None:
+                    sender.add_sequence(next_sequence)
+            if self.uplink is not None and sender is not None:
+                self.uplink.send(command)
 
             for connection in self._connections:
                 if connection != sender:
-                    connection.add_command(command)
+                    connection.add_command(command, sequence=next_sequence)
+
+        self._broadcast_size_update(current_byte_size, current_command_count)
+
+    def restore_commands(self, commands: List[common.Command]):
+        """
+        Add the commands of a restored room, before clients can join it.
+        """
+        with self._commands_mutex:
+            for command in commands:
+                self._history.append(command)
+            self._history.remove_many(dead_lifecycle_sequences(self._history.commands_since(0)))
+            self._compacted_sequence = self._history.next_sequence
+
+    def history_snapshot(self) -> Tuple[int, List[common.Command]]:
+        """
+        Return the sequence number of the next command and the commands of the history.
+        """
+        with self._commands_mutex:
+            return self._history.next_sequence, [command for _, command in self._history.commands_since(0)]
+
+    def compact_history(self, retention: float = 0.0):
+        """
+        Drop from the history the lifecycles of the removed entities, see dead_lifecycle_sequences().
+
+        The commands received during the last retention seconds are not dropped, so that the clients disconnected
+        meanwhile can resume the room. The history is scanned without holding the mutex, so that clients can keep
+        on broadcasting.
+        """
+        end = self._history.next_sequence
+        if retention > 0.0:
+            now = time.monotonic()
+            checkpoints = self._sequence_checkpoints
+            checkpoints.append((now, end))
+            while len(checkpoints) > 1 and checkpoints[1][0] <= now - retention:
+                checkpoints.popleft()
+            checkpoint_time, checkpoint_sequence = checkpoints[0]
+            end = checkpoint_sequence if checkpoint_time <= now - retention else 0
+        if self.log is not None:
+            # joining clients receive the log up to its durable sequence number, then the history, so that a
+            # lifecycle must not be dropped from the history while it is partly logged
+            end = min(end, self.log.durable[0])
+        if end <= self._compacted_sequence:
+            return
+
+        commands = itertools.takewhile(lambda item: item[0] < end, self._history.commands_since(0))
+        dead = dead_lifecycle_sequences(commands)
+
+        with self._commands_mutex:
+            if self._syncing_count > 0:
+                return
+            self._compacted_sequence = end
+            if not dead:
+                return
+
+            current_byte_size = self.byte_size
+            current_command_count = self.command_count()
+            self._history.remove_many(dead)
+            self._resume_floor = max(self._resume_floor, max(dead) + 1)
+            logger.info(
+                "Room %s: dropped %d commands of removed entities",
+                self.name,
+                current_command_count - self.command_count(),
+            )
+        self._broadcast_size_update(current_byte_size, current_command_count)
 
 
 class Server:
     def __init__(self):
+        # _rooms and _connections are replaced by modified copies and never modified in place, so that they can be
+        # read without lock. Their mutexes serialize the modifications.
         self._rooms: Dict[str, Room] = {}
         self._connections: Dict[str, Connection] = {}
-        self._mutex = threading.RLock()
+        self._rooms_mutex = threading.RLock()
+        self._connections_mutex = threading.Lock()
         self.latency: float = 0.0  # seconds
         self.bandwidth: float = 0.0  # MBps
+        self.use_event_loop: bool = False  # serve all connections from a single thread instead of one thread each
+        # optional features enabled for the clients
+        self.capabilities: Set[str] = {
+            common.Capabilities.COMPRESSION,
+            common.Capabilities.BATCH,
+            common.Capabilities.CHUNKS,
+        }
+        self.shutting_down: bool = False
+        self._event_loop: Optional[EventLoop] = None
+        self.history_compaction_interval: float = HISTORY_COMPACTION_INTERVAL  # seconds, 0 to disable
+        self.join_mode: str = common.JoinMode.HISTORY  # used when the joining client does not request a mode
+        self.room_log_dir: Optional[str] = None  # directory of the durable room logs, None to keep rooms in memory
+        self._room_log_writer: Optional[RoomLogWriter] = None
+        self.queue_soft_limit: int = DEFAULT_SOFT_LIMIT  # bytes waiting to be sent before a client is lagging
+        self.queue_hard_limit: int = DEFAULT_HARD_LIMIT  # bytes waiting to be sent before a client is disconnected
+        # directory of the media files shared by the rooms, None to keep the media files in the room histories
+        self.media_dir: Optional[str] = None
+        self.media_store: Optional[MediaStore] = None
+        self._maintenance_wakeup = threading.Event()
+        self._service_threads: List[threading.Thread] = []
+
+        self.workers: int = 0  # worker processes that serve the rooms, 0 to serve them in this process
+        self.peers: Optional[Peers] = None  # the other processes of a multi-process server, or the main server
+        self.upstream: Optional[Tuple[str, int]] = None  # address of the main server, to run as a relay
+        # seconds during which the clients disconnected from a room can resume it, 0 to disable
+        self.resume_retention: float = RESUME_RETENTION
+
+        # seconds between two broadcasts of the accumulated room and client updates, 0 to broadcast them immediately
+        self.status_update_interval: float = STATUS_UPDATE_INTERVAL
+        self._status_mutex = threading.Lock()  # protects the pending updates, taken after the other mutexes
+        self._pending_room_updates: Dict[str, Dict[str, Any]] = {}
+        self._pending_client_updates: Dict[str, Dict[str, Any]] = {}
+        self._pending_presence_updates: Dict[str, Dict[str, Any]] = {}  # ROOM_SCOPED_CLIENT_ATTRIBUTES
 
     def delete_room(self, room_name: str):
-        with self._mutex:
-            if room_name not in self._rooms:
+        with self._rooms_mutex:
+            room = self._rooms.get(room_name)
+            if room is None:
                 logger.warning("Room %s does not exist.", room_name)
                 return
-            if self._rooms[room_name].client_count() > 0:
+            if room.client_count() > 0:
                 logger.warning("Room %s is not empty.", room_name)
                 return
 
-            del self._rooms[room_name]
+            self._rooms = {name: value for name, value in self._rooms.items() if name != room_name}
+            with self._status_mutex:
+                self._pending_room_updates.pop(room_name, None)
+            if room.log is not None:
+                room.log.delete()
+            if room.uplink is not None:
+                room.uplink.stop()
             logger.info(f"Room {room_name} deleted")
 
             self.broadcast_to_all_clients(
@@ -426,15 +1255,24 @@ class Server:
         mixer_version: str,
         ignore_version_check: bool,
         generic_protocol: bool,
+        join_mode: str = common.JoinMode.DEFAULT,
     ):
         assert connection.room is None
+        if join_mode == common.JoinMode.DEFAULT:
+            join_mode = self.join_mode
+        if join_mode not in (common.JoinMode.HISTORY, common.JoinMode.STATE):
+            raise Exception(f"Unknown join mode {join_mode}")
 
-        def _create_room():
+        def _create_room(uplink: Optional[RoomUplink]):
             logger.info(f"Room {room_name} does not exist. Creating it.")
             room = Room(
                 self, room_name, blender_version, mixer_version, ignore_version_check, generic_protocol, connection
             )
-            self._rooms[room_name] = room
+            self._open_room_log(room)
+            if uplink is not None:
+                room.uplink = uplink
+                uplink.start(room)
+            self._rooms = {**self._rooms, room_name: room}
             # room is now visible to others, but not joinable until the client has sent CONTENT
             logger.info(
                 f"Room {room_name} added with blender version {blender_version} and mixer version {mixer_version} (ignore version check: {ignore_version_check})"
@@ -443,10 +1281,28 @@ class Server:
             self.broadcast_room_update(room, room.attributes_dict())  # Inform new room
             self.broadcast_client_update(connection, {common.ClientAttributes.ROOM: connection.room.name})
 
-        with self._mutex:
+        uplink: Optional[RoomUplink] = None
+        relay = self.peers if isinstance(self.peers, RelayPeers) else None
+        if relay is not None and room_name not in self._rooms:
+            # outside of the mutex, since the content of the room is received from the main server
+            uplink = relay.join_upstream(
+                room_name, blender_version, mixer_version, ignore_version_check, generic_protocol
+            )
+
+        with self._rooms_mutex:
             room = self._rooms.get(room_name)
+            if room is not None and uplink is not None:
+                # relayed by another client meanwhile
+                uplink.stop()
+            elif room is None and relay is not None:
+                if uplink is None:
+                    raise Exception(f"Room {room_name} was deleted while joining, retry")
+                if not uplink.created:
+                    room = self._open_relayed_room(
+                        uplink, room_name, blender_version, mixer_version, ignore_version_check, generic_protocol
+                    )
             if room is None:
-                _create_room()
+                _create_room(uplink)
                 return
 
             if not room.joinable:
@@ -463,23 +1319,87 @@ class Server:
                         f"Mixer version mismatch with room {room_name}: client version is {mixer_version}, room version is {room.mixer_version}"
                     )
 
-            # Do this before releasing the global mutex
+            # Do this before releasing the rooms mutex
             # Ensure the room will not be deleted because it now has at least one client
             room.join_count += 1
 
-        room.add_client(connection)
-        # this call can take a while because history broadcasting occurs, so the mutex is released here
+        room.add_client(connection, join_mode, lambda: self._joined_room(connection))
 
-        # from here client is in the room list, we can decrease join_count
-        with self._mutex:
+        # from here the room counts the client until it leaves, we can decrease join_count
+        with self._rooms_mutex:
             room.join_count -= 1
 
+    def _joined_room(self, connection: Connection):
+        """
+        Tell the clients that a client joined a room, once it received the room history.
+        """
         assert connection.room is not None
+        self._send_room_presence(connection)
         self.broadcast_client_update(connection, {common.ClientAttributes.ROOM: connection.room.name})
 
+    def resume_room(self, connection: Connection, room_name: str, token: str, sequence: int):
+        """
+        Add a client to the room it was in before a disconnection, if it can receive only the commands it missed.
+        Otherwise tell the client to join the room again.
+        """
+        assert connection.room is None
+        with self._rooms_mutex:
+            room = self._rooms.get(room_name)
+            if room is not None and (not room.joinable or room.token != token):
+                room = None
+            if room is not None:
+                room.join_count += 1
+
+        resumed = False
+        if room is not None:
+            resumed = room.resume_client(connection, sequence, lambda: self._joined_room(connection))
+            with self._rooms_mutex:
+                room.join_count -= 1
+
+        if not resumed:
+            logger.info(f"Client {connection.unique_id} cannot resume room {room_name}")
+            connection.send_command(common.Command(common.MessageType.RESUME, common.encode_bool(False)))
+
+    def _open_relayed_room(
+        self,
+        uplink: RoomUplink,
+        room_name: str,
+        blender_version: str,
+        mixer_version: str,
+        ignore_version_check: bool,
+        generic_protocol: bool,
+    ) -> Room:
+        """
+        Create the local copy of a room of the main server, in relay mode.
+        """
+        room = Room(self, room_name, blender_version, mixer_version, ignore_version_check, generic_protocol, None)
+        room.restore_commands(uplink.history)
+        room.joinable = True
+        room.uplink = uplink
+        uplink.start(room)
+        with self._rooms_mutex:
+            self._rooms = {**self._rooms, room_name: room}
+        logger.info(f"Room {room_name} relayed with {room.command_count()} commands")
+        self.broadcast_room_update(room, room.attributes_dict())
+        return room
+
+    def _send_room_presence(self, connection: Connection):
+        """
+        Exchange the room scoped attributes of a joining client with the clients of its room.
+        """
+        assert connection.room is not None
+        updates = {}
+        for other in connection.room.connections():
+            presence = _room_scoped_attributes(other.custom_attributes)
+            if other is not connection and presence:
+                updates[other.unique_id] = presence
+        if updates:
+            connection.add_command(common.Command(common.MessageType.CLIENT_UPDATE, common.encode_json(updates)))
+        self.broadcast_client_update(connection, _room_scoped_attributes(connection.custom_attributes))
+
     def leave_room(self, connection: Connection):
         assert connection.room is not None
-        with self._mutex:
+        with self._rooms_mutex:
             room = self._rooms.get(connection.room.name)
             if room is None:
                 raise ValueError(f"Room not found {connection.room.name})")
@@ -488,28 +1408,89 @@ class Server:
             self.broadcast_client_update(connection, {common.ClientAttributes.ROOM: None})
 
             if room.client_count() == 0 and not room.keep_open:
+                if room.resume_deadline > time.monotonic():
+                    logger.info('No more clients in room "%s", waiting for disconnected clients', room.name)
+                    return
                 logger.info('No more clients in room "%s" and not keep_open', room.name)
                 self.delete_room(room.name)
             else:
                 logger.info(f"Connections left in room {room.name}: {room.client_count()}.")
 
     def broadcast_to_all_clients(self, command: common.Command):
-        with self._mutex:
-            for connection in self._connections.values():
-                connection.add_command(command)
+        self.broadcast_to_local_clients(command)
+        if self.peers is not None:
+            self.peers.observe(command)
+            self.peers.broadcast(command)
+
+    def broadcast_to_local_clients(self, command: common.Command):
+        """
+        Send command to the clients of this process only, for messages that are already broadcast by another process
+        of a multi-process server.
+        """
+        for connection in self._connections.values():
+            connection.add_command(command)
 
     def broadcast_client_update(self, connection: Connection, attributes: Dict[str, Any]):
+        """
+        Broadcast client attributes updates, to the clients of the room of connection for the room scoped attributes
+        and to all the clients for the others.
+        """
         if attributes == {}:
             return
 
-        self.broadcast_to_all_clients(
-            common.Command(common.MessageType.CLIENT_UPDATE, common.encode_json({connection.unique_id: attributes}))
-        )
+        presence = _room_scoped_attributes(attributes)
+        others = {key: value for key, value in attributes.items() if key not in presence}
+        if self.status_update_interval > 0.0:
+            with self._status_mutex:
+                if others:
+                    self._pending_client_updates.setdefault(connection.unique_id, {}).update(others)
+                if presence:
+                    self._pending_presence_updates.setdefault(connection.unique_id, {}).update(presence)
+            return
+
+        if others:
+            self.broadcast_to_all_clients(
+                common.Command(common.MessageType.CLIENT_UPDATE, common.encode_json({connection.unique_id: others}))
+            )
+        if presence:
+            self._broadcast_presence_updates({connection.unique_id: presence})
+
+    def _broadcast_presence_updates(self, updates: Dict[str, Dict[str, Any]]):
+        """
+        Send room scoped client attributes updates to the clients of the room of each updated client.
+        """
+        rooms_updates: Dict[Room, Dict[str, Dict[str, Any]]] = {}
+        for client_id, attributes in updates.items():
+            connection = self._connections.get(client_id)
+            if connection is not None and connection.room is not None:
+                rooms_updates.setdefault(connection.room, {})[client_id] = attributes
+
+        for room, room_updates in rooms_updates.items():
+            command = common.Command(common.MessageType.CLIENT_UPDATE, common.encode_json(room_updates))
+            for connection in room.connections():
+                connection.add_command(command)
 
     def broadcast_room_update(self, room: Room, attributes: Dict[str, Any]):
+        """
+        Broadcast room attributes updates to all the clients. The updates of the attributes computed from the history
+        are accumulated, since they change with each command.
+        """
         if attributes == {}:
             return
 
+        if room.log is not None and not attributes.keys() <= _HISTORY_ROOM_ATTRIBUTES:
+            # the attributes that are not computed from the history are needed to restore the room
+            room.log.write_attributes({common.RoomAttributes.NAME: room.name, **room.attributes_dict()})
+
+        if self.status_update_interval > 0.0:
+            history_attributes = {key: value for key, value in attributes.items() if key in _HISTORY_ROOM_ATTRIBUTES}
+            if history_attributes:
+                with self._status_mutex:
+                    self._pending_room_updates.setdefault(room.name, {}).update(history_attributes)
+                attributes = {key: value for key, value in attributes.items() if key not in history_attributes}
+                if not attributes:
+                    return
+
         self.broadcast_to_all_clients(
             common.Command(
                 common.MessageType.ROOM_UPDATE,
@@ -517,8 +1498,38 @@ class Server:
             )
         )
 
+    def flush_status_updates(self):
+        """
+        Broadcast the accumulated room and client updates.
+        """
+        # the mutexes prevent the deletion of rooms and connections, so that no update is sent after the ROOM_DELETED
+        # or CLIENT_DISCONNECTED message
+        with self._rooms_mutex, self._connections_mutex:
+            with self._status_mutex:
+                room_updates = self._pending_room_updates
+                client_updates = self._pending_client_updates
+                presence_updates = self._pending_presence_updates
+                self._pending_room_updates = {}
+                self._pending_client_updates = {}
+                self._pending_presence_updates = {}
+
+            room_updates = {name: value for name, value in room_updates.items() if name in self._rooms}
+            if room_updates:
+                self.broadcast_to_all_clients(
+                    common.Command(common.MessageType.ROOM_UPDATE, common.encode_json(room_updates))
+                )
+            client_updates = {
+                client_id: value for client_id, value in client_updates.items() if client_id in self._connections
+            }
+            if client_updates:
+                self.broadcast_to_all_clients(
+                    common.Command(common.MessageType.CLIENT_UPDATE, common.encode_json(client_updates))
+                )
+            if presence_updates:
+                self._broadcast_presence_updates(presence_updates)
+
     def set_room_custom_attributes(self, room_name: str, custom_attributes: Mapping[str, Any]):
-        with self._mutex:
+        with self._rooms_mutex:
             if room_name not in self._rooms:
                 logger.warning("Room %s does not exist.", room_name)
                 return
@@ -527,7 +1538,7 @@ class Server:
             self.broadcast_room_update(self._rooms[room_name], diff)
 
     def set_room_keep_open(self, room_name: str, value: bool):
-        with self._mutex:
+        with self._rooms_mutex:
             if room_name not in self._rooms:
                 logger.warning("Room %s does not exist.", room_name)
                 return
@@ -537,24 +1548,48 @@ class Server:
                 self.broadcast_room_update(room, {common.RoomAttributes.KEEP_OPEN: room.keep_open})
 
     def get_list_rooms_command(self) -> common.Command:
-        with self._mutex:
-            result_dict = {room_name: value.attributes_dict() for room_name, value in self._rooms.items()}
-            return common.Command(common.MessageType.LIST_ROOMS, common.encode_json(result_dict))
+        result_dict = self.peers.rooms_attributes() if self.peers is not None else {}
+        result_dict.update({room_name: value.attributes_dict() for room_name, value in self._rooms.items()})
+        return common.Command(common.MessageType.LIST_ROOMS, common.encode_json(result_dict))
 
-    def get_list_clients_command(self) -> common.Command:
-        with self._mutex:
-            result_dict = {cid: c.client_attributes() for cid, c in self._connections.items()}
-            return common.Command(common.MessageType.LIST_CLIENTS, common.encode_json(result_dict))
+    def get_list_clients_command(self, connection: Connection) -> common.Command:
+        """
+        Return the attributes of all the clients, without the room scoped attributes of the clients that are not in
+        the room of connection.
+        """
+        result_dict = self.peers.clients_attributes() if self.peers is not None else {}
+        result_dict.update({cid: c.client_attributes() for cid, c in self._connections.items()})
+        room_name = connection.room.name if connection.room is not None else None
+        for cid, attributes in result_dict.items():
+            same_room = room_name is not None and attributes.get(common.ClientAttributes.ROOM) == room_name
+            if cid == connection.unique_id or same_room:
+                continue
+            result_dict[cid] = {
+                key: value for key, value in attributes.items() if key not in common.ROOM_SCOPED_CLIENT_ATTRIBUTES
+            }
+        return common.Command(common.MessageType.LIST_CLIENTS, common.encode_json(result_dict))
 
     def handle_client_disconnect(self, connection: Connection):
         # First remove connection from server state, to avoid further broadcasting tentatives
-        with self._mutex:
-            del self._connections[connection.unique_id]
+        with self._connections_mutex:
+            self._connections = {
+                client_id: value for client_id, value in self._connections.items() if value is not connection
+            }
 
         # Clean leaving of the room
         if connection.room is not None:
+            if connection.resumable and connection.room.joinable and self.resume_retention > 0.0:
+                connection.room.resume_deadline = time.monotonic() + self.resume_retention
             self.leave_room(connection)
 
+        # Abandon the room the client was joining
+        room = connection.stop_replay()
+        if room is not None:
+            with self._rooms_mutex:
+                if room.client_count() == 0 and not room.keep_open and self._rooms.get(room.name) is room:
+                    logger.info('No more clients in room "%s" and not keep_open', room.name)
+                    self.delete_room(room.name)
+
         try:
             connection.socket.close()
         except Exception as e:
@@ -565,8 +1600,77 @@ class Server:
             common.Command(common.MessageType.CLIENT_DISCONNECTED, common.encode_string(connection.unique_id))
         )
 
+    def accept(self, sock: socket.socket):
+        client_socket, client_address = sock.accept()
+        client_socket = Socket(client_socket)
+        client_socket.set_bandwidth(self.bandwidth, self.bandwidth)
+
+        connection: Connection
+        if self._event_loop is not None:
+            connection = EventLoopConnection(self, client_socket, client_address, self._event_loop)
+        else:
+            connection = Connection(self, client_socket, client_address)
+            connection.latency = self.latency
+        logger.info(f"New connection from {client_address}")
+        self._add_connection(connection)
+
+    def adopt_connection(
+        self,
+        sock: socket.socket,
+        address,
+        custom_attributes: Dict[str, Any],
+        received_commands: List[common.Command],
+        capabilities: Optional[List[str]] = None,
+        media_hashes: Optional[List[str]] = None,
+    ):
+        """
+        Serve a connection passed by another process of a multi-process server.
+        """
+        client_socket = Socket(sock)
+        client_socket.set_bandwidth(self.bandwidth, self.bandwidth)
+        connection = Connection(self, client_socket, address, received_commands)
+        connection.latency = self.latency
+        connection.custom_attributes = custom_attributes
+        connection.enable_capabilities(capabilities or [])
+        connection.media_hashes = set(media_hashes or [])
+        logger.info(f"Connection from {address} passed by another process")
+        self._add_connection(connection)
+
+    def hand_off(self, connection: Connection, commands: List[common.Command]):
+        """
+        Pass a connection to the process of a multi-process server that owns the room it joins, with the commands
+        received and not processed yet, starting with JOIN_ROOM or RESUME. Meant to be used by the thread of the
+        connection.
+        """
+        assert self.peers is not None
+        assert not self.peers.is_local_room(common.decode_string(commands[0].data, 0)[0])
+        with self._connections_mutex:
+            self._connections = {
+                client_id: value for client_id, value in self._connections.items() if value is not connection
+            }
+        try:
+            connection.fetch_outgoing_commands()
+            self.peers.hand_off(connection, commands)
+        except (common.ClientDisconnectedException, OSError):
+            self.handle_client_disconnect(connection)
+
+    def _add_connection(self, connection: Connection):
+        with self._connections_mutex:
+            self._connections = {**self._connections, connection.unique_id: connection}
+        connection.start()
+        self.broadcast_client_update(connection, connection.client_attributes())
+
     def run(self, port):
-        global SHUTDOWN
+        if self.workers > 0:
+            # before the sockets and threads of this process are created, since the workers may be forked
+            front_peers = FrontPeers(self, self.workers)
+            self.peers = front_peers
+            front_peers.start()
+        elif self.upstream is not None:
+            relay_peers = RelayPeers(self, *self.upstream)
+            self.peers = relay_peers
+            relay_peers.start()
+
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         binding_host = ""
         sock.bind((binding_host, port))
@@ -574,29 +1678,155 @@ class Server:
         sock.listen(1000)
 
         logger.info("Listening on port % s", port)
-        while True:
-            try:
-                timeout = 0.1  # Check for a new client every 10th of a second
-                readable, _, _ = select.select([sock], [], [], timeout)
-                if len(readable) > 0:
-                    client_socket, client_address = sock.accept()
-                    client_socket = Socket(client_socket)
-                    client_socket.set_bandwidth(self.bandwidth, self.bandwidth)
-
-                    connection = Connection(self, client_socket, client_address)
-                    connection.latency = self.latency
-                    with self._mutex:
-                        self._connections[connection.unique_id] = connection
-                    connection.start()
-                    logger.info(f"New connection from {client_address}")
-                    self.broadcast_client_update(connection, connection.client_attributes())
-            except KeyboardInterrupt:
-                break
+        self._start_services()
+        try:
+            if self.use_event_loop:
+                logger.info("Serving connections with an event loop")
+                self._event_loop = EventLoop()
+                self._event_loop.run(self, sock)
+            else:
+                self._run_threads(sock)
+        except KeyboardInterrupt:
+            pass
 
         logger.info("Shutting down server")
-        SHUTDOWN = True
+        self._stop_services()
+        if isinstance(self.peers, (FrontPeers, RelayPeers)):
+            self.peers.stop()
         sock.close()
 
+    def run_worker(self, peers: WorkerPeers):
+        """
+        Serve the rooms of a worker process of a multi-process server, until the front process stops.
+        """
+        self.peers = peers
+        logger.info("Worker %d started", peers.index)
+        self._start_services()
+        peers.run()
+        logger.info("Worker %d shutting down", peers.index)
+        self._stop_services()
+
+    def _start_services(self):
+        # a relay forwards the media to the main server, that stores them
+        if self.media_dir is not None and self.upstream is None:
+            self.media_store = MediaStore(self.media_dir)
+            self.media_store.start()
+        if self.room_log_dir is not None:
+            self._room_log_writer = RoomLogWriter(self.room_log_dir)
+            self._room_log_writer.start()
+            self.restore_rooms()
+
+        self._service_threads = [
+            threading.Thread(None, self._run_maintenance, name="maintenance"),
+            threading.Thread(None, self._run_status_updates, name="status updates"),
+        ]
+        for thread in self._service_threads:
+            thread.start()
+
+    def _stop_services(self):
+        self.shutting_down = True
+        self._maintenance_wakeup.set()
+        for thread in self._service_threads:
+            thread.join()
+        if self._room_log_writer is not None:
+            self._room_log_writer.stop()
+
+    def _open_room_log(self, room: Room):
+        if self._room_log_writer is not None:
+            room.log = RoomLog(self._room_log_writer, room.name, room.history_snapshot, lambda: room.byte_size)
+
+    def restore_rooms(self):
+        """
+        Restore the rooms from the logs of room_log_dir.
+        """
+        room_filter = self.peers.is_local_room if self.peers is not None else None
+        for attributes, commands in recover_rooms(self.room_log_dir, room_filter):
+            room_name = attributes[common.RoomAttributes.NAME]
+            room = Room(
+                self,
+                room_name,
+                attributes.get(common.RoomAttributes.BLENDER_VERSION, ""),
+                attributes.get(common.RoomAttributes.MIXER_VERSION, ""),
+                attributes.get(common.RoomAttributes.IGNORE_VERSION_CHECK, False),
+                attributes.get(common.RoomAttributes.GENERIC_PROTOCOL, True),
+                None,
+            )
+            room.keep_open = True
+            room.joinable = True
+            room.custom_attributes = {
+                key: value for key, value in attributes.items() if key not in _SERVER_ROOM_ATTRIBUTES
+            }
+            room.restore_commands(commands)
+            self._open_room_log(room)
+            assert room.log is not None
+            room.log.restored(
+                room.history_snapshot()[0],
+                any(command.compressed for command in commands),
+                any(is_media_reference(command) for command in commands),
+            )
+            with self._rooms_mutex:
+                self._rooms = {**self._rooms, room_name: room}
+            logger.info(f"Room {room_name} restored with {room.command_count()} commands")
+            if self.peers is not None:
+                self.broadcast_room_update(room, room.attributes_dict())
+
+    def _run_threads(self, sock: socket.socket):
+        while not self.shutting_down:
+            timeout = 0.1  # Check for a new client every 10th of a second
+            readable, _, _ = select.select([sock], [], [], timeout)
+            if len(readable) > 0:
+                self.accept(sock)
+
+    def _run_maintenance(self):
+        """
+        Background tasks that must not delay the broadcasting
+        """
+        while not self.shutting_down:
+            interval = self.history_compaction_interval
+            self._maintenance_wakeup.wait(interval if interval > 0.0 else HISTORY_COMPACTION_INTERVAL)
+            if self.shutting_down:
+                break
+
+            self._delete_abandoned_rooms()
+            if interval <= 0.0:
+                continue
+            rooms = list(self._rooms.values())
+            for room in rooms:
+                try:
+                    room.compact_history(self.resume_retention)
+                except Exception:
+                    logger.exception("Room %s: history compaction failed", room.name)
+
+    def _delete_abandoned_rooms(self):
+        """
+        Delete the rooms that waited in vain for their disconnected clients to resume them.
+        """
+        now = time.monotonic()
+        with self._rooms_mutex:
+            for room in list(self._rooms.values()):
+                if 0.0 < room.resume_deadline <= now and room.client_count() == 0 and not room.keep_open:
+                    logger.info('No client resumed room "%s"', room.name)
+                    self.delete_room(room.name)
+
+    def _run_status_updates(self):
+        while not self.shutting_down:
+            if self.status_update_interval <= 0.0:
+                self._maintenance_wakeup.wait()
+                continue
+            self._maintenance_wakeup.wait(self.status_update_interval)
+            if self.shutting_down:
+                break
+            try:
+                self.flush_status_updates()
+            except Exception:
+                logger.exception("Status updates broadcast failed")
+
+    def shutdown(self):
+        self.shutting_down = True
+        self._maintenance_wakeup.set()
+        if self._event_loop is not None:
+            self._event_loop.wakeup()
+
 
 def main():
     global _log_server_updates
@@ -611,6 +1841,29 @@ def main():
     server = Server()
     server.latency = args.latency / 1000.0
     server.bandwidth = args.bandwidth
+    server.use_event_loop = args.event_loop
+    server.history_compaction_interval = args.history_compaction_interval
+    server.join_mode = args.join_mode
+    server.room_log_dir = args.room_log_dir
+    server.queue_soft_limit = int(args.queue_soft_limit * 1024 * 1024)
+    server.queue_hard_limit = int(args.queue_hard_limit * 1024 * 1024)
+    server.status_update_interval = 1.0 / args.status_update_rate if args.status_update_rate > 0.0 else 0.0
+    server.resume_retention = args.resume_retention
+    server.media_dir = args.media_dir
+    if args.no_compression:
+        server.capabilities.discard(common.Capabilities.COMPRESSION)
+    server.workers = args.workers
+    if server.workers > 0:
+        if not workers_supported():
+            args_parser.error("--workers requires Unix sockets, that are not available on this platform")
+        if server.use_event_loop:
+            args_parser.error("--workers cannot be used with --event-loop")
+    if args.relay is not None:
+        server.upstream = parse_address(args.relay)
+        if server.workers > 0 or server.use_event_loop or server.room_log_dir is not None:
+            args_parser.error("--relay cannot be used with --workers, --event-loop or --room-log-dir")
+    if server.use_event_loop and args.latency > 0.0:
+        logger.warning("Latency simulation is not available with --event-loop, ignored")
     server.run(args.port)
 
 
@@ -623,6 +1876,78 @@ def parse_cli_args():
         "--bandwidth", type=float, default=0.0, help="simulate bandwidth limitation (megabytes per second)"
     )
     parser.add_argument("--latency", type=float, default=0.0, help="simulate network latency (in milliseconds)")
+    parser.add_argument(
+        "--event-loop",
+        action="store_true",
+        help="serve all connections from a single event loop thread instead of one thread per connection",
+    )
+    parser.add_argument(
+        "--history-compaction-interval",
+        type=float,
+        default=HISTORY_COMPACTION_INTERVAL,
+        help="seconds between two removals of the deleted entities from the room histories (0 to disable)",
+    )
+    parser.add_argument(
+        "--join-mode",
+        choices=[common.JoinMode.HISTORY, common.JoinMode.STATE],
+        default=common.JoinMode.HISTORY,
+        help="how the room content is sent to joining clients that do not request a mode: "
+        "in the order of the room history, or grouped by datablock",
+    )
+    parser.add_argument(
+        "--room-log-dir",
+        default=None,
+        help="directory where the rooms are logged, so that the rooms kept open are restored after a restart",
+    )
+    parser.add_argument(
+        "--queue-soft-limit",
+        type=float,
+        default=DEFAULT_SOFT_LIMIT / (1024 * 1024),
+        help="megabytes waiting to be sent to a client above which superseded updates are dropped (0 for no limit)",
+    )
+    parser.add_argument(
+        "--queue-hard-limit",
+        type=float,
+        default=DEFAULT_HARD_LIMIT / (1024 * 1024),
+        help="megabytes waiting to be sent to a client above which it is disconnected (0 for no limit)",
+    )
+    parser.add_argument(
+        "--status-update-rate",
+        type=float,
+        default=1.0 / STATUS_UPDATE_INTERVAL,
+        help="broadcasts per second of the accumulated room and client updates (0 to broadcast them immediately)",
+    )
+    parser.add_argument(
+        "--no-compression",
+        action="store_true",
+        help="do not let the clients exchange compressed commands",
+    )
+    parser.add_argument(
+        "--media-dir",
+        help="directory where the media files of all the rooms are stored, so that each file is uploaded once "
+        "(by default, the media files are kept in the room histories)",
+    )
+    parser.add_argument(
+        "--resume-retention",
+        type=float,
+        default=RESUME_RETENTION,
+        help="seconds during which a client disconnected from a room can resume it and receive only the commands it "
+        "missed (0 to disable)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="number of worker processes that serve the rooms, each room being served by one of them "
+        "(0 to serve all the rooms in the main process)",
+    )
+    parser.add_argument(
+        "--relay",
+        metavar="HOST:PORT",
+        default=None,
+        help="run as a relay of the main server at this address: the rooms joined by the local clients are joined "
+        "once on the main server and their content is kept locally",
+    )
     return parser.parse_args(), parser
 
 
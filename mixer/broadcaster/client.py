@@ -20,10 +20,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import collections
+import itertools
 import socket
 import logging
-import time
-from typing import Dict, Any, Mapping, Optional, List, Callable
+import select
+import threading
+from typing import Dict, Any, Deque, Iterator, Mapping, Optional, List, Callable, Set, Tuple, Union
 
 import mixer.broadcaster.common as common
 from mixer.broadcaster.socket import Socket
@@ -40,12 +43,19 @@ class Client:
     - receiving packet of bytes and convert them to commands
     - send commands
     - maintain an updated view of clients and room states from server's inputs
+
+    With background_io, the socket is read and written by a network thread of the client while it is connected, so
+    that the caller of fetch_commands() only gets the commands already received, and is never blocked by the
+    network. The network thread is started by the first fetch after connect(), so that the commands sent before, like
+    RESUME, are written before the pending commands, as without background_io. Then the network thread writes the
+    commands of send_command() before the pending commands, and waits for incoming bytes or for commands to send.
     """
 
-    def __init__(self, host: str = common.DEFAULT_HOST, port: int = common.DEFAULT_PORT):
+    def __init__(self, host: str = common.DEFAULT_HOST, port: int = common.DEFAULT_PORT, background_io: bool = False):
         self.host = host
         self.port = port
-        self.pending_commands: List[common.Command] = []
+        # commands, and streams of commands added with add_command_stream()
+        self.pending_commands: List[Union[common.Command, Iterator[common.Command]]] = []
         self.socket: Socket = None
 
         self.client_id: Optional[str] = None  # Will be filled with a unique string identifying this client
@@ -53,6 +63,36 @@ class Client:
         self.clients_attributes: Dict[str, Dict[str, Any]] = {}
         self.rooms_attributes: Dict[str, Dict[str, Any]] = {}
         self.current_room: Optional[str] = None
+        self.compression = False  # the commands are sent compressed, enabled by the server, see Capabilities
+        self.batch = False  # the pending commands are packed in BATCH messages, enabled by the server
+        self.chunks = False  # the large commands are sent in CHUNK messages, enabled by the server
+        self.bulk_byte_budget = 4 * 1024 * 1024  # bytes of large commands sent per fetch_outgoing_commands()
+        # the bulk transfer in progress: the large command being sent in chunks, or the stream of commands being sent
+        self._chunked_command: Optional[common.Command] = None
+        self._chunks: Optional[common.FrameChunks] = None
+        self._stream: Optional[Iterator[common.Command]] = None
+        self._chunk_assembler = common.ChunkAssembler()  # the large command being received
+        self._reader: Optional[common.FrameReader] = None
+        # content hashes of the media stored by the server, that are sent as references, see MEDIA_HASHES
+        self.server_media_hashes: Set[str] = set()
+
+        # to resume the current room after a disconnection, see resume_room()
+        self.room_token: Optional[str] = None
+        self.room_sequence = 0  # sequence number of the next room command to receive
+        self._join_arguments: Optional[Tuple[Any, ...]] = None
+
+        self.background_io = background_io
+        self._io_thread: Optional[threading.Thread] = None
+        self._io_stop = threading.Event()
+        self._io_disconnected = False  # set by the network thread when it loses the connection
+        self._incoming: Deque[common.Command] = collections.deque()  # commands received by the network thread
+        # commands of send_command() not yet written by the network thread
+        self._control_commands: List[common.Command] = []
+        # protects the pending commands, the control commands and the bulk transfer, shared with the network thread
+        self._send_mutex = threading.RLock()
+        # written to wake the network thread up when there are commands to send
+        self._wakeup_reader: Optional[socket.socket] = None
+        self._wakeup_writer: Optional[socket.socket] = None
 
     def __del__(self):
         if self.socket is not None:
@@ -74,6 +114,7 @@ class Client:
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket = Socket(sock)
             self.socket.connect((self.host, self.port))
+            self._reader = common.FrameReader(self.socket)
             local_address = self.socket.getsockname()
             logger.info(
                 "Connecting from local %s:%s to %s:%s",
@@ -82,7 +123,21 @@ class Client:
                 self.host,
                 self.port,
             )
+            self.compression = False
+            self.batch = False
+            self.chunks = False
+            self._chunks = None
+            if self._chunked_command is not None:
+                # the chunks sent before a lost connection are lost too
+                self._chunks = common.FrameChunks(self._chunked_command.frame_buffers())
+            self._chunk_assembler = common.ChunkAssembler()
+            self.server_media_hashes = set()
+            with self._send_mutex:
+                # like the commands that were not written to the previous socket without background_io
+                self._control_commands = []
             self.send_command(common.Command(common.MessageType.CLIENT_ID))
+            capabilities = [common.Capabilities.COMPRESSION, common.Capabilities.BATCH, common.Capabilities.CHUNKS]
+            self.send_command(common.Command(common.MessageType.CAPABILITIES, common.encode_string_array(capabilities)))
             self.send_command(common.Command(common.MessageType.LIST_CLIENTS))
             self.send_command(common.Command(common.MessageType.LIST_ROOMS))
         except ConnectionRefusedError:
@@ -95,8 +150,15 @@ class Client:
             raise
 
     def disconnect(self):
+        self._io_stop.set()
+        with self._send_mutex:
+            self._clear_bulk_transfer()
         if self.socket:
-            self.socket.shutdown(socket.SHUT_RDWR)
+            try:
+                # also interrupts a blocked write of the network thread
+                self.socket.shutdown(socket.SHUT_RDWR)
+            finally:
+                self._stop_io_thread()
             self.socket.close()
             self.socket = None
 
@@ -104,10 +166,26 @@ class Client:
         return self.socket is not None
 
     def add_command(self, command: common.Command):
-        self.pending_commands.append(command)
+        with self._send_mutex:
+            self.pending_commands.append(command)
+        self._wake_io_thread()
+
+    def add_command_stream(self, commands: Iterator[common.Command]):
+        """
+        Add commands that are produced only when they are sent, so that a bulk transfer, like a file read block by
+        block, never needs to fit in memory. The commands added after the stream are sent like the commands added
+        after a large command, see fetch_outgoing_commands().
+
+        The stream survives a lost connection: after connect(), its remaining commands are sent, with the ones that
+        the server may not have received. With background_io, the stream is consumed by the network thread.
+        """
+        with self._send_mutex:
+            self.pending_commands.append(commands)
+        self._wake_io_thread()
 
     def handle_connection_lost(self):
         logger.info("Connection lost for %s:%s", self.host, self.port)
+        self._stop_io_thread()
         # Set socket to None before putting CONNECTION_LIST message to avoid sending/reading new messages
         self.socket = None
 
@@ -128,13 +206,28 @@ class Client:
         return False
 
     def send_command(self, command: common.Command):
+        if self._io_thread is not None:
+            # written by the network thread, before the pending commands
+            with self._send_mutex:
+                self._control_commands.append(command)
+            self._wake_io_thread()
+            return not self._io_disconnected
         try:
-            common.write_message(self.socket, command)
+            if self.compression:
+                command.compress()
+            common.write_message(self.socket, command, self.compression)
             return True
         except common.ClientDisconnectedException:
             self.handle_connection_lost()
             return False
 
+    def send_media_hashes(self, hashes: List[str]):
+        """
+        Tell the server the content hashes of the media in the cache, so that it sends references to them instead of
+        their blocks. Meant to be called before join_room() or resume_room().
+        """
+        return self.send_command(common.Command(common.MessageType.MEDIA_HASHES, common.encode_string_array(hashes)))
+
     def join_room(
         self,
         room_name: str,
@@ -142,18 +235,63 @@ class Client:
         mixer_version: str,
         ignore_version_check: bool,
         generic_protocol: bool,
+        join_mode: str = common.JoinMode.DEFAULT,
+        resumable: bool = False,
     ):
+        """
+        With resumable, the server sends the sequence numbers of the room commands, so that the room can be resumed
+        with resume_room() after a disconnection.
+        """
+        self.room_token = None
+        self._join_arguments = None
+        if resumable:
+            self._join_arguments = (
+                room_name,
+                blender_version,
+                mixer_version,
+                ignore_version_check,
+                generic_protocol,
+                join_mode,
+            )
         name = common.encode_string(room_name)
         bl_version = common.encode_string(blender_version)
         mix_version = common.encode_string(mixer_version)
         version_check = common.encode_bool(ignore_version_check)
         protocol = common.encode_bool(generic_protocol)
-        return self.send_command(
-            common.Command(common.MessageType.JOIN_ROOM, name + bl_version + mix_version + version_check + protocol, 0)
-        )
+        data = name + bl_version + mix_version + version_check + protocol
+        if join_mode != common.JoinMode.DEFAULT or resumable:
+            data += common.encode_string(join_mode)
+        if resumable:
+            data += common.encode_bool(resumable)
+        return self.send_command(common.Command(common.MessageType.JOIN_ROOM, data, 0))
+
+    def can_resume(self) -> bool:
+        return self.room_token is not None and self._join_arguments is not None
+
+    def resume_room(self):
+        """
+        Join again the room joined before a disconnection, once connected again, to receive only the room commands
+        missed meanwhile. If the server cannot resume the room, the room is joined again.
+        """
+        assert self.room_token is not None and self._join_arguments is not None
+        # the server does not know the attributes of the new connection
+        if self.current_custom_attributes and not self.send_command(
+            common.Command(
+                common.MessageType.SET_CLIENT_CUSTOM_ATTRIBUTES, common.encode_json(self.current_custom_attributes), 0
+            )
+        ):
+            return False
+        room_name = self._join_arguments[0]
+        data = common.encode_string(room_name) + common.encode_string(self.room_token)
+        data += common.encode_uint64(self.room_sequence)
+        return self.send_command(common.Command(common.MessageType.RESUME, data, 0))
 
     def leave_room(self, room_name: str):
+        with self._send_mutex:
+            self._clear_bulk_transfer()
         self.current_room = None
+        self.room_token = None
+        self._join_arguments = None
         return self.send_command(common.Command(common.MessageType.LEAVE_ROOM, room_name.encode("utf8"), 0))
 
     def delete_room(self, room_name: str):
@@ -220,11 +358,37 @@ class Client:
         del self.clients_attributes[client_id]
 
     def _handle_join_room(self, command: common.Command):
-        room_name, _ = common.decode_string(command.data, 0)
+        room_name, index = common.decode_string(command.data, 0)
+        if index < len(command.data):
+            self.room_token, index = common.decode_string(command.data, index)
+            self.room_sequence, _ = common.decode_uint64(command.data, index)
 
         logger.info("Info: Join room '%s' confirmed by server", room_name)
         self.current_room = room_name
 
+    def _handle_capabilities(self, command: common.Command):
+        capabilities, _ = common.decode_string_array(command.data, 0)
+        self.compression = common.Capabilities.COMPRESSION in capabilities
+        self.batch = common.Capabilities.BATCH in capabilities
+        self.chunks = common.Capabilities.CHUNKS in capabilities
+
+    def _handle_media_hashes(self, command: common.Command):
+        hashes, _ = common.decode_string_array(command.data, 0)
+        self.server_media_hashes.update(hashes)
+
+    def _handle_room_sequence(self, command: common.Command):
+        self.room_sequence, _ = common.decode_uint64(command.data, 0)
+
+    def _handle_resume(self, command: common.Command):
+        resumed, _ = common.decode_bool(command.data, 0)
+        if resumed:
+            logger.info("Info: Resume room from %d accepted by server", self.room_sequence)
+            return
+
+        assert self._join_arguments is not None
+        logger.warning("Room %s cannot be resumed, joining it again", self._join_arguments[0])
+        self.join_room(*self._join_arguments, resumable=True)
+
     def _handle_send_error(self, command: common.Command):
         error_message, _ = common.decode_string(command.data, 0)
 
@@ -234,11 +398,15 @@ class Client:
         MessageType.LIST_CLIENTS: _handle_list_client,
         MessageType.LIST_ROOMS: _handle_list_rooms,
         MessageType.CLIENT_ID: _handle_client_id,
+        MessageType.CAPABILITIES: _handle_capabilities,
+        MessageType.MEDIA_HASHES: _handle_media_hashes,
         MessageType.ROOM_UPDATE: _handle_room_update,
         MessageType.ROOM_DELETED: _handle_room_deleted,
         MessageType.CLIENT_UPDATE: _handle_client_update,
         MessageType.CLIENT_DISCONNECTED: _handle_client_disconnected,
         MessageType.JOIN_ROOM: _handle_join_room,
+        MessageType.ROOM_SEQUENCE: _handle_room_sequence,
+        MessageType.RESUME: _handle_resume,
         MessageType.SEND_ERROR: _handle_send_error,
     }
 
@@ -249,12 +417,22 @@ class Client:
         """
         Gather incoming commands from the socket and return them as a list.
         Process those that have a default handler with the one registered.
+
+        With background_io, return the commands received by the network thread since the previous call.
         """
-        try:
-            received_commands = common.read_all_messages(self.socket)
-        except common.ClientDisconnectedException:
-            self.handle_connection_lost()
-            raise
+        if self.socket is None or self._reader is None:
+            logger.warning("fetch_incoming_commands called with no socket")
+            return []
+        if self.background_io and self._io_thread is None:
+            self._start_io_thread()
+        if self._io_thread is not None:
+            received_commands = self._take_incoming_commands()
+        else:
+            try:
+                received_commands = self._chunk_assembler.assemble(common.unpack_batches(self._reader.read()))
+            except common.ClientDisconnectedException:
+                self.handle_connection_lost()
+                raise
 
         count = len(received_commands)
         if count > 0:
@@ -266,21 +444,203 @@ class Client:
 
         return received_commands
 
-    def fetch_outgoing_commands(self, commands_send_interval=0):
+    def fetch_outgoing_commands(self):
         """
-        Send commands in pending_commands queue to the server.
+        Send commands in pending_commands queue to the server, packed in BATCH messages if the server accepts them.
+
+        A large command, sent in chunks if the server accepts CHUNK messages, and a stream of commands are bulk
+        transfers, sent at most bulk_byte_budget bytes per call. Meanwhile, the interactive commands are sent between
+        the chunks or the commands of the stream and the other commands remain pending, so that a bulk transfer does
+        not freeze the interaction.
+
+        With background_io, the pending commands are sent by the network thread, started by the first call.
         """
-        for idx, command in enumerate(self.pending_commands):
-            logger.debug("Send %s (%d / %d)", command.type, idx + 1, len(self.pending_commands))
+        if self._io_thread is not None:
+            return
+        if not self.socket:
+            if self.pending_commands:
+                logger.warning("fetch_outgoing_commands called with no socket")
+            return
+        if self.background_io:
+            self._start_io_thread()
+            return
 
-            if not self.send_command(command):
-                break
+        try:
+            self._write_pending_commands()
+        except common.ClientDisconnectedException:
+            self.handle_connection_lost()
 
-            if commands_send_interval > 0:
-                time.sleep(commands_send_interval)
+    def _write_pending_commands(self):
+        """
+        Write the pending commands, see fetch_outgoing_commands().
+        Raise ClientDisconnectedException if the socket is disconnected.
+        """
+        with self._send_mutex:
+            buffers, streamed = self._pending_buffers()
 
-        self.pending_commands = []
+        try:
+            common.write_buffers(self.socket, buffers)
+        except common.ClientDisconnectedException:
+            if streamed:
+                with self._send_mutex:
+                    if streamed[-1] is self._chunked_command:
+                        self._chunked_command = None
+                        self._chunks = None
+                    self._stream = itertools.chain(streamed, self._stream or ())
+            raise
 
-    def fetch_commands(self, commands_send_interval=0) -> List[common.Command]:
-        self.fetch_outgoing_commands(commands_send_interval)
+    def _pending_buffers(self) -> Tuple[List[Any], List[common.Command]]:
+        """
+        Return the buffers of the pending commands to write, and the commands of streams that they contain.
+        """
+        buffers: List[Any] = []
+        for command in self._control_commands:
+            if self.compression:
+                command.compress()
+            buffers.extend(command.frame_buffers(self.compression))
+        self._control_commands = []
+
+        streamed: List[common.Command] = []  # commands of streams written by this call
+        budget = self.bulk_byte_budget
+        while True:
+            items = self.pending_commands
+            self.pending_commands = []
+            ready: List[common.Command] = []
+            for item in items:
+                if not isinstance(item, common.Command):
+                    if self._bulk_transfer():
+                        self.pending_commands.append(item)
+                    else:
+                        self._stream = item
+                    continue
+                if self.compression:
+                    item.compress()
+                if not self._bulk_transfer():
+                    if not self._start_chunks(item):
+                        ready.append(item)
+                elif item.type in common.INTERACTIVE_MESSAGES:
+                    ready.append(item)
+                else:
+                    self.pending_commands.append(item)
+            if ready:
+                logger.debug("Send %d commands", len(ready))
+            buffers.extend(common.commands_buffers(ready, self.compression, self.batch))
+
+            while budget > 0 and self._bulk_transfer():
+                if self._chunks is not None:
+                    buffers.extend(self._chunks.next_chunk())
+                    budget -= common.CHUNK_SIZE
+                    if self._chunks.done:
+                        self._chunked_command = None
+                        self._chunks = None
+                    continue
+                assert self._stream is not None
+                command = next(self._stream, None)
+                if command is None:
+                    self._stream = None
+                    continue
+                streamed.append(command)
+                if self.compression:
+                    command.compress()
+                if not self._start_chunks(command):
+                    buffers.extend(command.frame_buffers(self.compression))
+                    budget -= command.byte_size()
+            if self._bulk_transfer() or not self.pending_commands:
+                break
+        return buffers, streamed
+
+    def _bulk_transfer(self) -> bool:
+        return self._chunks is not None or self._stream is not None
+
+    def _start_chunks(self, command: common.Command) -> bool:
+        if not self.chunks or command.byte_size() <= common.CHUNK_SIZE:
+            return False
+        logger.debug("Send %s in chunks", command.type)
+        self._chunked_command = command
+        self._chunks = common.FrameChunks(command.frame_buffers(self.compression))
+        return True
+
+    def _clear_bulk_transfer(self):
+        self._chunked_command = None
+        self._chunks = None
+        self._stream = None
+
+    def fetch_commands(self) -> List[common.Command]:
+        self.fetch_outgoing_commands()
         return self.fetch_incoming_commands()
+
+    def _start_io_thread(self):
+        self._io_stop.clear()
+        self._io_disconnected = False
+        self._incoming.clear()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+        self._io_thread = threading.Thread(None, self._run_io_thread, name="mixer network", daemon=True)
+        self._io_thread.start()
+
+    def _stop_io_thread(self):
+        thread = self._io_thread
+        if thread is None or thread is threading.current_thread():
+            return
+        self._io_stop.set()
+        self._wake_io_thread()
+        thread.join()
+        self._io_thread = None
+        for wakeup_socket in (self._wakeup_reader, self._wakeup_writer):
+            if wakeup_socket is not None:
+                wakeup_socket.close()
+        self._wakeup_reader = None
+        self._wakeup_writer = None
+
+    def _wake_io_thread(self):
+        writer = self._wakeup_writer
+        if writer is None:
+            return
+        try:
+            writer.send(b"\0")
+        except OSError:
+            # the socket pair buffer is full, so a wakeup is already pending, or the network thread is stopped
+            pass
+
+    def _run_io_thread(self):
+        """
+        Write the pending commands and read the incoming ones into _incoming, until stopped or disconnected.
+        Between the writes, wait for incoming bytes or for a wakeup, unless a bulk transfer is in progress.
+        """
+        assert self._reader is not None and self._wakeup_reader is not None
+        sock = self.socket._socket
+        wakeup_reader = self._wakeup_reader
+        try:
+            while not self._io_stop.is_set():
+                self._write_pending_commands()
+                timeout = 0.0 if self._bulk_transfer() else None
+                readable, _, _ = select.select([sock, wakeup_reader], [], [], timeout)
+                if wakeup_reader in readable:
+                    try:
+                        while wakeup_reader.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                if sock in readable:
+                    received_commands = common.unpack_batches(self._reader.read(0.0))
+                    self._incoming.extend(self._chunk_assembler.assemble(received_commands))
+        except common.ClientDisconnectedException:
+            self._io_disconnected = True
+        except Exception:
+            if not self._io_stop.is_set():
+                logger.exception("Exception in the network thread, disconnecting")
+            self._io_disconnected = True
+
+    def _take_incoming_commands(self) -> List[common.Command]:
+        """
+        Return the commands received by the network thread.
+        Raise ClientDisconnectedException once they are all returned, if the network thread lost the connection.
+        """
+        # the network thread adds its last commands before it sets _io_disconnected
+        disconnected = self._io_disconnected
+        received_commands = [self._incoming.popleft() for _ in range(len(self._incoming))]
+        if disconnected and not received_commands:
+            self.handle_connection_lost()
+            raise common.ClientDisconnectedException()
+        return received_commands
@@ -0,0 +1,175 @@
+# MIT License
+#
+# Copyright (c) 2020 Ubisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Queue of the commands waiting to be sent to a client by the server.
+"""
+
+import collections
+import threading
+from typing import Deque, Dict, List, Optional
+
+from mixer.broadcaster.common import INTERACTIVE_MESSAGES, Command, MessageType
+from mixer.broadcaster.room_history import CoalescingKey, coalescing_key
+
+# Default limits of the bytes waiting to be sent to a client, see CommandQueue
+DEFAULT_SOFT_LIMIT = 16 * 1024 * 1024
+DEFAULT_HARD_LIMIT = 512 * 1024 * 1024
+
+
+def _collapse_key(command: Command) -> Optional[CoalescingKey]:
+    if command.type == MessageType.FRAME:
+        return command.type, ""
+    return coalescing_key(command)
+
+
+class CommandQueue:
+    """
+    Thread safe queue of the commands waiting to be sent to a client, bounded in bytes.
+
+    When more than soft_limit bytes are waiting, the client is lagging: a new command that supersedes a queued one
+    (same coalescing key, transform of the same object, or frame change) replaces it, so that the client receives
+    only the latest one. When more than hard_limit bytes are waiting, the queue overflows: it drops its content and
+    the connection is expected to disconnect the client.
+
+    Commands replayed from the room history to a joining client are not counted in the limits since the history
+    keeps them in memory anyway, but are counted in byte_size.
+
+    Room commands are put with the sequence number that follows them in the room history, and sequence is the
+    sequence number reached by the commands returned by get(), including the collapsed ones, so that the client can
+    be told which room commands it has received.
+
+    The commands of common.INTERACTIVE_MESSAGES are in a separate lane, so that they can be sent while a large
+    command is sent in chunks, before the other commands that wait behind the large command. Otherwise the commands
+    are returned in the order they were put.
+    """
+
+    def __init__(self, soft_limit: int = DEFAULT_SOFT_LIMIT, hard_limit: int = DEFAULT_HARD_LIMIT):
+        self.soft_limit = soft_limit  # bytes, 0 for no limit
+        self.hard_limit = hard_limit  # bytes, 0 for no limit
+
+        self._mutex = threading.Lock()
+        # [command or None when collapsed, replay, sequence, put index, collapse key]
+        self._entries: Deque[List] = collections.deque()
+        self._interactive_entries: Deque[List] = collections.deque()
+        self._put_count = 0
+        self._overtaking_sequence = 0  # sequence reached by the interactive commands returned before older commands
+        self._collapsible: Dict[CoalescingKey, List] = {}  # the queued entry of each collapse key
+        self.byte_size = 0
+        self._live_byte_size = 0  # byte size of the commands that are not replayed
+        self.overflowed = False
+        self.sequence = 0
+
+    @property
+    def lagging(self) -> bool:
+        return self.soft_limit > 0 and self._live_byte_size > self.soft_limit
+
+    def empty(self) -> bool:
+        """
+        Return True if get() has nothing left to return, including the sequence numbers of put_sequence().
+        """
+        return not self._entries and not self._interactive_entries
+
+    def put(self, command: Command, replay: bool = False, sequence: Optional[int] = None):
+        size = command.byte_size()
+        with self._mutex:
+            if self.overflowed:
+                return
+
+            key = _collapse_key(command)
+            if key is not None and self.lagging:
+                superseded = self._collapsible.get(key)
+                if superseded is not None and superseded[0] is not None:
+                    self._remove(superseded)
+
+            entry = [command, replay, sequence, self._put_count, key]
+            self._put_count += 1
+            if command.type in INTERACTIVE_MESSAGES:
+                self._interactive_entries.append(entry)
+            else:
+                self._entries.append(entry)
+            if key is not None:
+                self._collapsible[key] = entry
+            self.byte_size += size
+            if not replay:
+                self._live_byte_size += size
+                if self.hard_limit > 0 and self._live_byte_size > self.hard_limit:
+                    self.overflowed = True
+                    self._clear()
+
+    def put_sequence(self, sequence: int):
+        """
+        Advance sequence without sending a command, for the room commands that the client sent itself.
+        """
+        with self._mutex:
+            if not self.overflowed:
+                self._entries.append([None, False, sequence, self._put_count, None])
+                self._put_count += 1
+
+    def get(self, interactive_only: bool = False) -> Optional[Command]:
+        """
+        Return the next command to send, or None if the queue is empty.
+        With interactive_only, return only the interactive commands, including the ones put after other commands.
+        """
+        with self._mutex:
+            while True:
+                interactive = self._interactive_entries
+                if interactive and (interactive_only or not self._entries or interactive[0][3] < self._entries[0][3]):
+                    entry = interactive.popleft()
+                    overtaking = bool(self._entries) and self._entries[0][3] < entry[3]
+                elif self._entries and not interactive_only:
+                    entry = self._entries.popleft()
+                    overtaking = False
+                else:
+                    return None
+
+                command = entry[0]
+                if entry[2] is not None:
+                    if overtaking:
+                        self._overtaking_sequence = entry[2]
+                    else:
+                        self.sequence = entry[2]
+                if not self._entries and self._overtaking_sequence > self.sequence:
+                    # the older commands that the interactive commands overtook are now returned too
+                    self.sequence = self._overtaking_sequence
+                if command is None:
+                    continue
+                self._remove(entry)
+                key = entry[4]
+                if key is not None and self._collapsible.get(key) is entry:
+                    del self._collapsible[key]
+                return command
+
+    def _remove(self, entry: List):
+        command, replay = entry[0], entry[1]
+        entry[0] = None
+        size = command.byte_size()
+        self.byte_size -= size
+        if not replay:
+            self._live_byte_size -= size
+
+    def _clear(self):
+        self._entries.clear()
+        self._interactive_entries.clear()
+        self._collapsible.clear()
+        self.byte_size = 0
+        self._live_byte_size = 0
@@ -25,18 +25,51 @@ This module defines types and utilities used by client and server code.
 """
 
 import array
+import collections
 from enum import IntEnum
-from typing import Dict, Mapping, Any, Optional, List, Tuple
+import itertools
+from typing import Deque, Dict, Iterable, Mapping, Any, Optional, List, Tuple
 import select
 import struct
 import json
 import logging
 
+from mixer.broadcaster.compression import COMPRESSION_THRESHOLD, compress, decompress
 from mixer.broadcaster.socket import Socket
 
 DEFAULT_HOST = "localhost"
 DEFAULT_PORT = 12800
 
+# Size of the header of each frame: byte size of the data (8), command id (4), message type (2)
+HEADER_SIZE = 8 + 4 + 2
+
+_FRAME_HEADER = struct.Struct("<QIH")
+
+# Set in the message type of a frame header when the frame data starts with a coalescing key, see Command
+COALESCING_KEY_FLAG = 0x8000
+
+# Set in the message type of a frame header when the frame data is compressed after the coalescing key, see Command
+COMPRESSED_FLAG = 0x4000
+
+# Separates the entity from the field group in a coalescing key, see make_coalescing_key()
+COALESCING_KEY_SEPARATOR = "|"
+
+# Frames with less data than this are cached as a single buffer, larger ones as a header and a view on the data
+FRAME_COPY_THRESHOLD = 64 * 1024
+
+# Size of the buffer of a FrameReader, that receives the frames smaller than FRAME_COPY_THRESHOLD
+READ_BUFFER_SIZE = 256 * 1024
+
+# Maximum byte size and buffer count written with a single system call, see send_buffers()
+SEND_BATCH_BYTE_SIZE = 1024 * 1024
+SEND_BATCH_BUFFER_COUNT = 512
+
+# Commands with a smaller frame are packed into BATCH messages, for the receivers that accept them
+BATCH_COMMAND_MAX_SIZE = 4 * 1024
+
+# Commands with a larger frame are sent in CHUNK messages of this size, for the receivers that accept them
+CHUNK_SIZE = 256 * 1024
+
 logger = logging.getLogger(__name__)
 
 
@@ -75,6 +108,17 @@ class MessageType(IntEnum):
 
     CLIENT_DISCONNECTED = 22  # Server: Notify a client has diconnected
 
+    # Client: join again the room left by a disconnection and receive only the commands missed meanwhile;
+    # Server: tell if the missed commands follow or if the client must join the room again
+    RESUME = 23
+    ROOM_SEQUENCE = 24  # Server: notify the sequence number of the next room command, to resumable clients only
+    # Client: ask for optional features, right after CLIENT_ID; Server: send the features enabled for the client
+    CAPABILITIES = 25
+    BATCH = 26  # Both: the complete frames of several commands, to be processed in order
+    CHUNK = 27  # Both: a part of the frame of a large command, sent between other commands
+    # Client: the content hashes of the media in its cache; Server: the content hashes of the media it stores
+    MEDIA_HASHES = 28
+
     COMMAND = 100
     DELETE = 101
     CAMERA = 102
@@ -190,6 +234,8 @@ class ClientAttributes:
     IP = "ip"  # Sent by server only, type = str
     PORT = "port"  # Sent by server only, type = int
     ROOM = "room"  # Sent by server only, type = str
+    QUEUE_BYTE_SIZE = "queue_byte_size"  # Sent by server only, type = int, bytes waiting to be sent to the client
+    LAGGING = "lagging"  # Sent by server only, type = bool, the client does not consume its commands fast enough
 
     # Client to server attributes, not used by the server but clients are encouraged to use these keys for the same semantic
     USERNAME = "user_name"  # type = str
@@ -207,6 +253,11 @@ class ClientAttributes:
     )
 
 
+# Client attributes that describe the activity of a client in its room, sent by the server only to the clients of
+# the same room
+ROOM_SCOPED_CLIENT_ATTRIBUTES = {ClientAttributes.USERSCENES, "blender_windows"}
+
+
 class RoomAttributes:
     """
     Attributes associated with a room by the server.
@@ -234,6 +285,44 @@ class RoomAttributes:
     JOINABLE = "joinable"  # Sent by server only, type = bool, indicate if the room is joinable
 
 
+class JoinMode:
+    """
+    How the server sends the room content to a joining client, optional field of JOIN_ROOM.
+
+    Documentation to update if you change this: doc/protocol.md
+    """
+
+    DEFAULT = ""  # the join mode of the server
+    HISTORY = "history"  # the room commands, in the order they were received
+    STATE = "state"  # the room commands, with the commands of each datablock grouped together
+
+
+class Capabilities:
+    """
+    Optional features of the protocol, negotiated with CAPABILITIES.
+
+    Documentation to update if you change this: doc/protocol.md
+    """
+
+    COMPRESSION = "compression"  # the receiver accepts frames with COMPRESSED_FLAG
+    BATCH = "batch"  # the receiver accepts BATCH messages
+    CHUNKS = "chunks"  # the receiver accepts CHUNK messages
+
+
+# Commands that may be sent between the chunks of a large command, before the commands that follow the large command.
+# They are sent often and only depend on the commands of the same type, so that they keep the interaction
+# responsive while a large command is transferred.
+INTERACTIVE_MESSAGES = {
+    MessageType.TRANSFORM,
+    MessageType.FRAME,
+    MessageType.PLAY,
+    MessageType.PAUSE,
+    MessageType.CLIENT_ID_WRAPPER,
+    MessageType.CLIENT_UPDATE,
+    MessageType.ROOM_UPDATE,
+}
+
+
 class ClientDisconnectedException(Exception):
     """When a client is disconnected and we try to read from it."""
 
@@ -274,7 +363,7 @@ def decode_string(data, index):
     string_length = bytes_to_int(data[index : index + 4])
     start = index + 4
     end = start + string_length
-    value = data[start:end].decode()
+    value = str(data[start:end], "utf-8")
     return value, end
 
 
@@ -303,6 +392,14 @@ def decode_int(data, index):
     return struct.unpack("i", data[index : index + 4])[0], index + 4
 
 
+def encode_uint64(value):
+    return struct.pack("Q", value)
+
+
+def decode_uint64(data, index):
+    return struct.unpack("Q", data[index : index + 8])[0], index + 8
+
+
 def encode_vector2(value):
     return struct.pack("2f", *(value.x, value.y))
 
@@ -364,10 +461,9 @@ def decode_quaternion(data, index):
 
 
 def encode_string_array(values):
-    buffer = encode_int(len(values))
-    for item in values:
-        buffer += encode_string(item)
-    return buffer
+    writer = BufferWriter()
+    writer.write_string_array(values)
+    return writer.getvalue()
 
 
 def decode_string_array(data, index):
@@ -380,56 +476,63 @@ def decode_string_array(data, index):
     return values, index
 
 
-def decode_array(data, index, schema, inc):
+def decode_typed_array(data, index, typecode: str) -> Tuple[array.array, int]:
+    """
+    Decode a count prefixed array of numbers into an array.array of typecode, in a single copy of the bytes.
+    """
     count = bytes_to_int(data[index : index + 4])
     start = index + 4
-    end = start
-    values = []
-    for _ in range(count):
-        end = start + inc
-        values.append(struct.unpack(schema, data[start:end]))
-        start = end
+    values = array.array(typecode)
+    end = start + count * values.itemsize
+    values.frombytes(memoryview(data)[start:end])
     return values, end
 
 
-def decode_float_array(data, index):
+def decode_struct_items(data, index, schema: str, count: int) -> Tuple[List[Tuple], int]:
+    """
+    Decode count consecutive items of a struct schema, in one pass.
+    """
+    end = index + count * struct.calcsize(schema)
+    return list(struct.iter_unpack(schema, memoryview(data)[index:end])), end
+
+
+def decode_struct_array(data, index, schema: str) -> Tuple[List[Tuple], int]:
+    """
+    Decode a count prefixed array of items of a struct schema into a list of tuples, in one pass.
+    """
     count = bytes_to_int(data[index : index + 4])
-    start = index + 4
-    values = []
-    end = start
-    for _ in range(count):
-        end = start + 4
-        values.extend(struct.unpack("f", data[start:end]))
-        start = end
-    return values, end
+    return decode_struct_items(data, index + 4, schema, count)
+
+
+def decode_array(data, index, schema, inc):
+    assert struct.calcsize(schema) == inc
+    return decode_struct_array(data, index, schema)
+
+
+def decode_float_array(data, index):
+    values, end = decode_typed_array(data, index, "f")
+    return values.tolist(), end
 
 
 def decode_int_array(data, index):
-    count = bytes_to_int(data[index : index + 4])
-    start = index + 4
-    values = []
-    end = start
-    for _ in range(count):
-        end = start + 4
-        values.extend(struct.unpack("I", data[start:end]))
-        start = end
-    return values, end
+    values, end = decode_typed_array(data, index, "I")
+    return values.tolist(), end
 
 
 def decode_int2_array(data, index):
-    return decode_array(data, index, "2I", 2 * 4)
+    return decode_struct_array(data, index, "2I")
 
 
 def decode_int3_array(data, index):
-    return decode_array(data, index, "3I", 3 * 4)
+    return decode_struct_array(data, index, "3I")
 
 
 def decode_vector3_array(data, index):
-    return decode_array(data, index, "3f", 3 * 4)
+    return decode_struct_array(data, index, "3f")
 
 
 def decode_vector2_array(data, index):
-    return decode_array(data, index, "2f", 2 * 4)
+    return decode_struct_array(data, index, "2f")
 
 
 def encode_py_array(data: array.array) -> bytes:
@@ -449,26 +552,532 @@ def decode_py_array(buffer: bytes, index: int) -> Tuple[array.array, int]:
     return array_, index + byte_count
 
 
+_INT = struct.Struct("i")
+_UINT32 = struct.Struct("<I")
+_UINT64 = struct.Struct("Q")
+_FLOAT = struct.Struct("f")
+_VECTOR2 = struct.Struct("2f")
+_VECTOR3 = struct.Struct("3f")
+_VECTOR4 = struct.Struct("4f")
+
+
+class BufferWriter:
+    """
+    Build the data of a message with the encoding of the encode_*() functions, without the quadratic copies of
+    repeated bytes concatenations.
+
+    The values are packed in place into a bytearray that grows by doubling. The bytes of FRAME_COPY_THRESHOLD or more
+    written with write_bytes() are not copied but kept as chunks, joined with the packed bytes once by getvalue(),
+    so they must not change meanwhile.
+    """
+
+    def __init__(self, size_hint: int = 1024):
+        self._chunks: List[Any] = []
+        self._buffer = bytearray(max(size_hint, 16))
+        self._size = 0  # count of bytes packed in _buffer
+        self._chunks_size = 0
+
+    def __len__(self) -> int:
+        return self._chunks_size + self._size
+
+    def _reserve(self, count: int) -> int:
+        """
+        Make room for count bytes and return their offset in _buffer.
+        """
+        offset = self._size
+        if offset + count > len(self._buffer):
+            self._buffer.extend(bytes(max(len(self._buffer), offset + count - len(self._buffer))))
+        self._size = offset + count
+        return offset
+
+    def pack(self, struct_: struct.Struct, *values):
+        struct_.pack_into(self._buffer, self._reserve(struct_.size), *values)
+
+    def write_struct(self, fmt: str, *values):
+        struct.pack_into(fmt, self._buffer, self._reserve(struct.calcsize(fmt)), *values)
+
+    def write_bytes(self, data):
+        count = len(memoryview(data).cast("B"))
+        if count < FRAME_COPY_THRESHOLD:
+            offset = self._reserve(count)
+            self._buffer[offset : offset + count] = data
+            return
+        if self._size > 0:
+            self._chunks.append(memoryview(self._buffer)[: self._size])
+            self._chunks_size += self._size
+            self._buffer = bytearray(len(self._buffer))
+            self._size = 0
+        self._chunks.append(data)
+        self._chunks_size += count
+
+    def write_int(self, value: int):
+        self.pack(_INT, value)
+
+    def write_bool(self, value):
+        self.pack(_UINT32, 1 if value else 0)
+
+    def write_uint64(self, value: int):
+        self.pack(_UINT64, value)
+
+    def write_float(self, value: float):
+        self.pack(_FLOAT, value)
+
+    def write_string(self, value: str):
+        encoded_value = value.encode()
+        self.pack(_UINT32, len(encoded_value))
+        self.write_bytes(encoded_value)
+
+    def write_json(self, value: dict):
+        self.write_string(json.dumps(value))
+
+    def write_string_array(self, values):
+        self.write_int(len(values))
+        for item in values:
+            self.write_string(item)
+
+    def write_vector2(self, value):
+        self.pack(_VECTOR2, value.x, value.y)
+
+    def write_vector3(self, value):
+        self.pack(_VECTOR3, value.x, value.y, value.z)
+
+    def write_vector4(self, value):
+        self.pack(_VECTOR4, value[0], value[1], value[2], value[3])
+
+    def write_color(self, value):
+        self.pack(_VECTOR4, value[0], value[1], value[2], value[3] if len(value) > 3 else 1.0)
+
+    def write_quaternion(self, value):
+        self.pack(_VECTOR4, value.w, value.x, value.y, value.z)
+
+    def write_matrix(self, value):
+        for i in range(4):
+            self.write_vector4(value.col[i])
+
+    def getvalue(self) -> bytes:
+        tail = memoryview(self._buffer)[: self._size]
+        if not self._chunks:
+            return bytes(tail)
+        return b"".join([*self._chunks, tail])
+
+
+class BufferReader:
+    """
+    Decode the data of a message with a cursor over a memoryview, instead of threading (value, index) tuples through
+    the decode_*() functions, with the same encoding.
+
+    index is the position of the next value, and may be passed to the decode_*() functions and updated with their
+    result.
+    """
+
+    def __init__(self, data, index: int = 0):
+        self._view = memoryview(data).cast("B")
+        self.index = index
+
+    @property
+    def remaining(self) -> int:
+        return len(self._view) - self.index
+
+    def unpack(self, struct_: struct.Struct) -> Tuple:
+        values = struct_.unpack_from(self._view, self.index)
+        self.index += struct_.size
+        return values
+
+    def read_struct(self, fmt: str) -> Tuple:
+        values = struct.unpack_from(fmt, self._view, self.index)
+        self.index += struct.calcsize(fmt)
+        return values
+
+    def read_bytes(self, count: int) -> memoryview:
+        start = self.index
+        self.index += count
+        return self._view[start : self.index]
+
+    def read_int(self) -> int:
+        return self.unpack(_INT)[0]
+
+    def read_bool(self) -> bool:
+        return self.unpack(_UINT32)[0] == 1
+
+    def read_uint64(self) -> int:
+        return self.unpack(_UINT64)[0]
+
+    def read_float(self) -> float:
+        return self.unpack(_FLOAT)[0]
+
+    def read_string(self) -> str:
+        return str(self.read_bytes(self.unpack(_UINT32)[0]), "utf-8")
+
+    def read_json(self):
+        return json.loads(self.read_string())
+
+    def read_string_array(self) -> List[str]:
+        return [self.read_string() for _ in range(self.unpack(_UINT32)[0])]
+
+    def read_vector2(self) -> Tuple[float, float]:
+        return self.unpack(_VECTOR2)
+
+    def read_vector3(self) -> Tuple[float, float, float]:
+        return self.unpack(_VECTOR3)
+
+    def read_vector4(self) -> Tuple[float, float, float, float]:
+        return self.unpack(_VECTOR4)
+
+    read_color = read_vector4
+    read_quaternion = read_vector4
+
+    def read_matrix(self) -> Tuple[Tuple[float, float, float, float], ...]:
+        return tuple(self.unpack(_VECTOR4) for _ in range(4))
+
+    def read_typed_array(self, typecode: str) -> array.array:
+        values, self.index = decode_typed_array(self._view, self.index, typecode)
+        return values
+
+    def read_struct_array(self, schema: str) -> List[Tuple]:
+        values, self.index = decode_struct_array(self._view, self.index, schema)
+        return values
+
+    def read_struct_items(self, schema: str, count: int) -> List[Tuple]:
+        values, self.index = decode_struct_items(self._view, self.index, schema, count)
+        return values
+
+
 class Command:
+    """
+    A message exchanged between a client and the server.
+
+    A command may have a coalescing key, which tells the server that this command supersedes any previous command
+    of the room with the same type and coalescing key, so that the server can drop the previous one from the room
+    history without decoding the data. On the wire, the key is sent as a string before the data and
+    COALESCING_KEY_FLAG is set in the message type. See doc/protocol.md.
+
+    The data of a command may also be compressed, for the receivers that negotiated it, see Capabilities. On the
+    wire, COMPRESSED_FLAG is set in the message type and the data that follows the key is compressed. A command
+    received compressed keeps its compressed data, so that it can be forwarded without compressing it again, and
+    decompresses its data when it is read.
+    """
+
     _id = 100
 
-    def __init__(self, command_type: MessageType, data=b"", command_id=0):
-        self.data = data or b""
+    def __init__(self, command_type: MessageType, data=b"", command_id=0, coalescing_key: Optional[str] = None):
         self.type = command_type
         self.id = command_id
         if command_id == 0:
             self.id = Command._id
             Command._id += 1
+        self.coalescing_key = coalescing_key
+        self.data = data or b""
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = decompress(self._compressed)
+        return self._data
+
+    @data.setter
+    def data(self, data):
+        self._data = data
+        self._compressed: Optional[bytes] = None
+        self._reset_frames()
+
+    def _reset_frames(self):
+        self._frame_header: Optional[bytes] = None
+        self._frame_buffers: Optional[Tuple[Any, ...]] = None
+        self._compressed_frame_header: Optional[bytes] = None
+        self._compressed_frame_buffers: Optional[Tuple[Any, ...]] = None
+
+    @property
+    def compressed(self) -> bool:
+        return self._compressed is not None
+
+    def compress(self):
+        """
+        Compress the data if it is worth it, so that the frames returned with compressed=True are compressed.
+        """
+        if self._compressed is not None or len(self.data) < COMPRESSION_THRESHOLD:
+            return
+        compressed = compress(self.data)
+        if len(compressed) < len(self.data):
+            self._compressed = compressed
+
+    def set_compressed_data(self, compressed: bytes):
+        """
+        Set the data from its compressed version, which is decompressed only if the data is read.
+        """
+        self._data = None
+        self._compressed = compressed
+        self._reset_frames()
+
+    def _encoded_coalescing_key(self) -> bytes:
+        if self.coalescing_key is None:
+            return b""
+        return encode_string(self.coalescing_key)
+
+    def _payload(self, compressed: bool) -> bytes:
+        return self._compressed if compressed else self.data
+
+    def frame_header(self, compressed: bool = False) -> bytes:
+        """
+        Return the bytes that precede the data in a frame: header and encoded coalescing key.
+        With compressed, return the header of the compressed frame if the data is compressed.
+
+        The header is built once, so type, id and coalescing key must not be changed after the command is sent.
+        """
+        compressed = compressed and self._compressed is not None
+        header = self._compressed_frame_header if compressed else self._frame_header
+        if header is None:
+            key = self._encoded_coalescing_key()
+            message_type = self.type.value
+            if key:
+                message_type |= COALESCING_KEY_FLAG
+            if compressed:
+                message_type |= COMPRESSED_FLAG
+
+            size = int_to_bytes(len(key) + len(self._payload(compressed)), 8)
+            command_id = int_to_bytes(self.id, 4)
+            mtype = int_to_bytes(message_type, 2)
+            header = size + command_id + mtype + key
+            if compressed:
+                self._compressed_frame_header = header
+            else:
+                self._frame_header = header
+        return header
+
+    def frame_buffers(self, compressed: bool = False) -> Tuple[Any, ...]:
+        """
+        Return the buffers to write, in order, to send this command.
+        With compressed, return the buffers of the compressed frame if the data is compressed, for the receivers
+        that accept compressed frames.
+
+        The buffers are built once and shared by all the sends of the command, so that broadcasting a command or
+        replaying a room history does not copy the data: small frames are a single bytes object, larger ones are the
+        header and a memoryview on the data.
+        """
+        compressed = compressed and self._compressed is not None
+        buffers = self._compressed_frame_buffers if compressed else self._frame_buffers
+        if buffers is None:
+            header = self.frame_header(compressed)
+            payload = self._payload(compressed)
+            if len(payload) < FRAME_COPY_THRESHOLD:
+                buffers = (header + payload,)
+            else:
+                buffers = (header, memoryview(payload))
+            if compressed:
+                self._compressed_frame_buffers = buffers
+            else:
+                self._frame_buffers = buffers
+        return buffers
+
+    def set_frame(self, frame):
+        """
+        Send frame, the complete frame of this command that is already encoded, instead of building it again.
+        The frame is compressed if the data is compressed.
+        """
+        compressed = self._compressed is not None
+        header = bytes(frame[: len(frame) - len(self._payload(compressed))])
+        if compressed:
+            self._compressed_frame_header = header
+            self._compressed_frame_buffers = (frame,)
+        else:
+            self._frame_header = header
+            self._frame_buffers = (frame,)
 
     def byte_size(self):
-        return 8 + 4 + 2 + len(self.data)
+        """
+        Return the byte size of the frame, compressed if the data is compressed.
+        """
+        compressed = self._compressed is not None
+        return len(self.frame_header(compressed)) + len(self._payload(compressed))
 
     def to_byte_buffer(self):
-        size = int_to_bytes(len(self.data), 8)
-        command_id = int_to_bytes(self.id, 4)
-        mtype = int_to_bytes(self.type.value, 2)
+        return self.frame_header() + self.data
+
+
+def make_command_from_frame(message_type: int, data: bytes, command_id: int) -> Command:
+    """
+    Build a Command from the fields of a frame read from a socket or a file.
+    """
+    coalescing_key = None
+    if message_type & COALESCING_KEY_FLAG:
+        message_type &= ~COALESCING_KEY_FLAG
+        coalescing_key, index = decode_string(data, 0)
+        data = data[index:]
+    if message_type & COMPRESSED_FLAG:
+        command = Command(int_to_message_type(message_type & ~COMPRESSED_FLAG), b"", command_id, coalescing_key)
+        command.set_compressed_data(data)
+        return command
+    return Command(int_to_message_type(message_type), data, command_id, coalescing_key)
+
+
+def decode_batch(data) -> List[Command]:
+    """
+    Return the commands of the data of a BATCH message.
+    """
+    commands: List[Command] = []
+    offset = 0
+    while offset < len(data):
+        frame_size = bytes_to_int(data[offset : offset + 8])
+        command_id = bytes_to_int(data[offset + 8 : offset + 12])
+        message_type = bytes_to_int(data[offset + 12 : offset + HEADER_SIZE])
+        frame_end = offset + HEADER_SIZE + frame_size
+        commands.append(make_command_from_frame(message_type, data[offset + HEADER_SIZE : frame_end], command_id))
+        offset = frame_end
+    return commands
+
+
+def unpack_batches(commands: List[Command]) -> List[Command]:
+    """
+    Return commands, with the BATCH messages replaced by the commands they contain.
+    """
+    if not any(command.type == MessageType.BATCH for command in commands):
+        return commands
+    unpacked: List[Command] = []
+    for command in commands:
+        if command.type == MessageType.BATCH:
+            unpacked.extend(decode_batch(command.data))
+        else:
+            unpacked.append(command)
+    return unpacked
+
+
+def commands_buffers(commands: Iterable[Command], compressed: bool = False, batch: bool = False) -> List[Any]:
+    """
+    Return the buffers to write, in order, to send commands.
+
+    With batch, consecutive small commands are packed into BATCH messages. A BATCH message only adds a header before
+    the frames of the commands it contains, so that packing does not copy their buffers.
+    """
+    buffers: List[Any] = []
+    packed: List[Any] = []  # frame buffers of the small commands not yet added to buffers
+    packed_count = 0
+    packed_size = 0
+    for command in commands:
+        frame_buffers = command.frame_buffers(compressed)
+        size = sum(len(buffer) for buffer in frame_buffers)
+        if batch and size < BATCH_COMMAND_MAX_SIZE:
+            if packed_size + size > SEND_BATCH_BYTE_SIZE:
+                _add_batch(buffers, packed, packed_count, packed_size)
+                packed, packed_count, packed_size = [], 0, 0
+            packed.extend(frame_buffers)
+            packed_count += 1
+            packed_size += size
+        else:
+            _add_batch(buffers, packed, packed_count, packed_size)
+            packed, packed_count, packed_size = [], 0, 0
+            buffers.extend(frame_buffers)
+    _add_batch(buffers, packed, packed_count, packed_size)
+    return buffers
+
+
+def _add_batch(buffers: List[Any], packed: List[Any], count: int, size: int):
+    # a single command is not worth a BATCH header
+    if count > 1:
+        buffers.append(int_to_bytes(size, 8) + int_to_bytes(0, 4) + int_to_bytes(MessageType.BATCH.value, 2))
+    buffers.extend(packed)
+
+
+class FrameChunks:
+    """
+    The CHUNK messages that carry the frame of a large command, to be sent one at a time between other commands.
+
+    A CHUNK message contains a bool that tells if it is the last chunk of the frame, then a part of the frame. The
+    chunks only reference the frame buffers, they do not copy them.
+    """
+
+    def __init__(self, frame_buffers: Iterable):
+        self._buffers: Deque[memoryview] = collections.deque(memoryview(buffer).cast("B") for buffer in frame_buffers)
+
+    @property
+    def done(self) -> bool:
+        return not self._buffers
+
+    def next_chunk(self) -> List[Any]:
+        """
+        Return the buffers of the next CHUNK message.
+        """
+        parts: List[Any] = []
+        size = 0
+        while self._buffers and size < CHUNK_SIZE:
+            buffer = self._buffers.popleft()
+            if len(buffer) > CHUNK_SIZE - size:
+                self._buffers.appendleft(buffer[CHUNK_SIZE - size :])
+                buffer = buffer[: CHUNK_SIZE - size]
+            parts.append(buffer)
+            size += len(buffer)
+        last = encode_bool(self.done)
+        header = int_to_bytes(len(last) + size, 8) + int_to_bytes(0, 4) + int_to_bytes(MessageType.CHUNK.value, 2)
+        return [header + last, *parts]
+
+
+class ChunkAssembler:
+    """
+    Rebuild the large commands received in CHUNK messages on a connection.
+    """
+
+    def __init__(self):
+        self._frame: Optional[bytearray] = None
+
+    def assemble(self, commands: List[Command]) -> List[Command]:
+        """
+        Return commands, with the CHUNK messages replaced by the commands that they complete.
+        """
+        if not any(command.type == MessageType.CHUNK for command in commands):
+            return commands
+        assembled: List[Command] = []
+        for command in commands:
+            if command.type != MessageType.CHUNK:
+                assembled.append(command)
+                continue
+            last, index = decode_bool(command.data, 0)
+            if self._frame is None:
+                self._frame = bytearray()
+            self._frame += memoryview(command.data)[index:]
+            if last:
+                frame = memoryview(self._frame)
+                self._frame = None
+                command_id = bytes_to_int(frame[8:12])
+                message_type = bytes_to_int(frame[12:HEADER_SIZE])
+                assembled.append(make_command_from_frame(message_type, frame[HEADER_SIZE:], command_id))
+        return assembled
+
+    def pending(self) -> List[Command]:
+        """
+        Return a CHUNK message with the part of the large command received so far, if any, so that another assembler
+        can complete it with the next chunks.
+        """
+        if self._frame is None:
+            return []
+        return [Command(MessageType.CHUNK, encode_bool(False) + bytes(self._frame))]
+
+
+def make_coalescing_key(entity: str, field_group: Optional[str] = None) -> str:
+    """
+    Return a coalescing key for commands that update field_group of entity.
 
-        return size + command_id + mtype + self.data
+    The entity is the path of an object or the uuid of a datablock. The field group identifies the part of the entity
+    that the command updates, so that updates of other parts of the same entity do not supersede it. Without field
+    group, the key only tags the command with its entity and the command does not supersede any other command.
+    """
+    if field_group is None:
+        return entity
+    return f"{entity}{COALESCING_KEY_SEPARATOR}{field_group}"
+
+
+def coalescing_key_entity(coalescing_key: str) -> str:
+    """
+    Return the entity part of a key returned by make_coalescing_key().
+    """
+    entity, separator, _ = coalescing_key.rpartition(COALESCING_KEY_SEPARATOR)
+    if not separator:
+        return coalescing_key
+    return entity
+
+
+def coalescing_key_has_field_group(coalescing_key: str) -> bool:
+    """
+    Return True if a key returned by make_coalescing_key() supersedes other commands.
+    """
+    return COALESCING_KEY_SEPARATOR in coalescing_key
 
 
 class CommandFormatter:
@@ -504,92 +1113,172 @@ class CommandFormatter:
         return s
 
 
-def recv(socket: Socket, size: int):
+class FrameReader:
     """
-    Try to read size bytes from the socket.
-    Raise ClientDisconnectedException if the socket is disconnected.
-    """
-    result = b""
-    while size != 0:
-        r, _, _ = select.select([socket], [], [], 0.1)
-        if len(r) > 0:
-            try:
-                tmp = socket.recv(size)
-            except (ConnectionAbortedError, ConnectionResetError) as e:
-                logger.warning(e)
-                raise ClientDisconnectedException()
+    Read the frames received on a socket and build their commands.
 
-            if len(tmp) == 0:
-                raise ClientDisconnectedException()
+    The socket is read with recv_into() into a buffer reused for all the frames, and the headers are parsed in place.
+    The data of a small frame is copied out of the buffer into its command. A frame of FRAME_COPY_THRESHOLD bytes or
+    more is received directly into a buffer of its own, and the data of its command is a memoryview of this buffer,
+    so that the bytes of a large frame are not copied again as they arrive.
+    """
 
-            result += tmp
-            size -= len(tmp)
-    return result
+    def __init__(self, sock: Socket):
+        self._socket = sock
+        self._buffer = bytearray(READ_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first received byte not parsed yet
+        self._end = 0  # end of the received bytes
+        # the large frame being received: id, message type and buffer, and the count of bytes received
+        self._large: Optional[Tuple[int, int, memoryview]] = None
+        self._large_received = 0
+        self._filled = False  # the last read filled the whole buffer, more bytes may be waiting
+
+    @property
+    def pending(self) -> bool:
+        """True if a frame is partially received"""
+        return self._large is not None or self._end > self._start
+
+    def read(self, timeout: Optional[float] = None) -> List[Command]:
+        """
+        Return the commands of the frames waiting on a blocking socket, after waiting up to timeout seconds for the
+        first bytes. A frame that has started to arrive is read up to its end, so that no byte remains in the reader
+        when it returns.
+        Raise ClientDisconnectedException if the socket is disconnected.
+        """
+        select_timeout = timeout if timeout is not None else 0.0001
+        commands: List[Command] = []
+        readable, _, _ = select.select([self._socket._socket], [], [], select_timeout)
+        while readable:
+            commands.extend(self.receive())
+            if not self.pending:
+                if not self._filled:
+                    break
+                readable, _, _ = select.select([self._socket._socket], [], [], 0)
+        return commands
+
+    def receive(self) -> List[Command]:
+        """
+        Read the socket once and return the commands of the frames completed, for blocking and non-blocking sockets.
+        Raise ClientDisconnectedException if the socket is disconnected, and BlockingIOError if a non-blocking
+        socket has nothing to read.
+        """
+        if self._large is not None:
+            target = self._large[2][self._large_received :]
+        else:
+            remaining = self._end - self._start
+            if self._start > 0:
+                # at most the beginning of a small frame
+                self._view[:remaining] = self._view[self._start : self._end]
+                self._start, self._end = 0, remaining
+            target = self._view[self._end :]
+
+        try:
+            count = self._socket.recv_into(target)
+        except (ConnectionAbortedError, ConnectionResetError) as e:
+            logger.warning(e)
+            raise ClientDisconnectedException()
+        if count == 0:
+            raise ClientDisconnectedException()
+        self._filled = count == len(target)
+
+        commands: List[Command] = []
+        if self._large is not None:
+            self._large_received += count
+            if self._large_received == len(self._large[2]):
+                commands.append(self._large_command())
+            return commands
+
+        self._end += count
+        self._parse(commands)
+        return commands
+
+    def _parse(self, commands: List[Command]):
+        while self._end - self._start >= HEADER_SIZE:
+            size, command_id, message_type = _FRAME_HEADER.unpack_from(self._buffer, self._start)
+            data_start = self._start + HEADER_SIZE
+            if size >= FRAME_COPY_THRESHOLD:
+                frame = memoryview(bytearray(size))
+                received = min(size, self._end - data_start)
+                frame[:received] = self._view[data_start : data_start + received]
+                self._start = data_start + received
+                self._large = (command_id, message_type, frame)
+                self._large_received = received
+                if received < size:
+                    return
+                commands.append(self._large_command())
+                continue
+
+            if self._end - data_start < size:
+                return
+            data = bytes(self._view[data_start : data_start + size])
+            commands.append(make_command_from_frame(message_type, data, command_id))
+            self._start = data_start + size
+
+    def _large_command(self) -> Command:
+        assert self._large is not None
+        command_id, message_type, frame = self._large
+        self._large = None
+        return make_command_from_frame(message_type, frame, command_id)
 
 
-def read_message(socket: Socket, timeout: Optional[float] = None) -> Optional[Command]:
+def read_all_messages(socket: Socket, timeout: Optional[float] = None) -> List[Command]:
     """
-    Try to read a full message from the socket.
+    Try to read all messages waiting on the socket, with the commands of BATCH messages in place of them.
     Raise ClientDisconnectedException if the socket is disconnected.
-    Return None if no message is waiting on the socket.
-    """
-    if not socket:
-        logger.warning("read_message called with no socket")
-        return None
-
-    select_timeout = timeout if timeout is not None else 0.0001
-    r, _, _ = select.select([socket._socket], [], [], select_timeout)
-    if len(r) == 0:
-        return None
+    Return empty list if no message is waiting on the socket.
 
-    try:
-        prefix_size = 14
-        msg = recv(socket, prefix_size)
+    A socket read repeatedly should rather have its own FrameReader, that reuses its buffer.
+    """
+    return unpack_batches(FrameReader(socket).read(timeout))
 
-        frame_size = bytes_to_int(msg[:8])
-        command_id = bytes_to_int(msg[8:12])
-        message_type = bytes_to_int(msg[12:])
 
-        msg = recv(socket, frame_size)
+def send_buffers(sock: Socket, buffers: Deque[memoryview]) -> int:
+    """
+    Send the first buffers with a single system call, using scatter/gather output when available.
 
-        return Command(int_to_message_type(message_type), msg, command_id)
+    Remove the sent bytes from buffers and return their count. Raise the exceptions of socket.send().
+    """
+    if hasattr(sock._socket, "sendmsg"):
+        sent = sock.sendmsg(list(itertools.islice(buffers, SEND_BATCH_BUFFER_COUNT)))
+    else:
+        sent = sock.send(buffers[0])
 
-    except ClientDisconnectedException:
-        raise
-    except Exception as e:
-        logger.error(e, exc_info=True)
-        raise
+    remaining = sent
+    while remaining > 0:
+        buffer = buffers[0]
+        if remaining < len(buffer):
+            buffers[0] = buffer[remaining:]
+            break
+        buffers.popleft()
+        remaining -= len(buffer)
+    return sent
 
 
-def read_all_messages(socket: Socket, timeout: Optional[float] = None) -> List[Command]:
+def write_buffers(sock: Socket, buffers: Iterable):
     """
-    Try to read all messages waiting on the socket.
+    Write all buffers to a blocking socket, with as few system calls as possible.
     Raise ClientDisconnectedException if the socket is disconnected.
-    Return empty list if no message is waiting on the socket.
     """
-    received_commands: List[Command] = []
-    while True:
-        command = read_message(socket, timeout=timeout)
-        if command is None:
-            break
-        received_commands.append(command)
-    return received_commands
+    pending: Deque[memoryview] = collections.deque(memoryview(buffer).cast("B") for buffer in buffers)
+    try:
+        while pending:
+            select.select([], [sock._socket], [])
+            send_buffers(sock, pending)
+    except (ConnectionAbortedError, ConnectionResetError, BrokenPipeError) as e:
+        logger.warning(e)
+        raise ClientDisconnectedException()
 
 
-def write_message(sock: Optional[Socket], command: Command):
+def write_message(sock: Optional[Socket], command: Command, compressed: bool = False):
+    """
+    Write command to sock, compressed if compressed is True and the data is compressed.
+    """
     if not sock:
         logger.warning("write_message called with no socket")
         return
 
-    buffer = command.to_byte_buffer()
-
-    try:
-        _, w, _ = select.select([], [sock._socket], [])
-        if sock.sendall(buffer) is not None:
-            raise ClientDisconnectedException()
-    except (ConnectionAbortedError, ConnectionResetError) as e:
-        logger.warning(e)
-        raise ClientDisconnectedException()
+    write_buffers(sock, command.frame_buffers(compressed))
 
 
 def make_set_room_attributes_command(room_name: str, attributes: dict):
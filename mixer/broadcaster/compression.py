@@ -0,0 +1,66 @@
+# MIT License
+#
+# Copyright (c) 2020 Ubisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Compression of the command data, see Command.compress().
+
+Each command is compressed on its own, so that the server can store and forward a compressed command to any client
+without decompressing and compressing it again. The preset dictionary provides the strings that are repeated across
+the commands of the generic protocol, which a stream compressor would find in the previous commands.
+"""
+
+import zlib
+
+# Level of the compression, favoring speed since the commands are compressed by the Blender main thread
+COMPRESSION_LEVEL = 1
+
+# Commands with less data than this are not compressed
+COMPRESSION_THRESHOLD = 256
+
+# Strings of the json encoding of the proxies, the most frequent ones last. Changing it breaks the compatibility
+# with the clients and servers that use another version.
+PRESET_DICTIONARY = (
+    b'"_aos_length": "_member_name": "_items": "_dict": "_rna_ui": "_path": "_index": "_sequence": '
+    b'"_diff_additions": "_diff_deletions": "_diff_updates": "_library_uuid": "_is_library_indirect": '
+    b'"_identifier": "_initial_name": "_bpy_data_collection": "_datablock_uuid": '
+    b'"DatablockLinkProxy" "LibraryProxy" "ShapeKeyProxy" "NodeLinksProxy" "CustomPropertiesProxy" '
+    b'"PtrToCollectionItemProxy" "SetProxy" "MeshProxy" "ObjectProxy" "NonePtrProxy" "AosElement" "SoaElement" '
+    b'"AosProxy" "DatablockRefCollectionProxy" "DatablockCollectionProxy" "StructCollectionProxy" '
+    b'"DeltaDeletion" "DeltaReplace" "DeltaAddition" "DeltaUpdate" "value": '
+    b'"use_nodes": "location": "rotation_euler": "scale": "material": "vertices": "edges": "loops": "polygons": '
+    b'"normal": "co": "data": "name": null, true, false, 0.0, 1.0, '
+    b'"DatablockRefProxy" "DatablockProxy" "StructProxy", "_data": {"__mixer_class__": '
+)
+
+
+def compress(data: bytes) -> bytes:
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=PRESET_DICTIONARY)
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompress(data: bytes) -> bytes:
+    decompressor = zlib.decompressobj(zdict=PRESET_DICTIONARY)
+    result = decompressor.decompress(data)
+    if not decompressor.eof:
+        raise zlib.error("Incomplete compressed data")
+    return result
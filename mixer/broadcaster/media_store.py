@@ -0,0 +1,218 @@
+# MIT License
+#
+# Copyright (c) 2020 Ubisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Content-addressed store of the media files, shared by all the rooms of a server and kept on disk.
+
+A BLENDER_DATA_MEDIA message is a block of a media file, with the content hash of the whole file. The server writes
+the blocks received from a client to a blob named after the hash, and the room history keeps a reference to the blob
+instead of the blocks: a BLENDER_DATA_MEDIA message without data. A reference is expanded into the blocks of the blob
+when it is sent to a client that does not already have this content, see MEDIA_HASHES in doc/protocol.md.
+"""
+
+import hashlib
+import logging
+import os
+import re
+from typing import Any, BinaryIO, List, Optional, Tuple
+
+from mixer.broadcaster.common import (
+    Command,
+    MessageType,
+    decode_string,
+    decode_uint64,
+    encode_string,
+    encode_uint64,
+)
+
+logger = logging.getLogger(__name__)
+
+# Size of the blocks of the media files, small enough for a block not to be sent in chunks
+MEDIA_BLOCK_SIZE = 128 * 1024
+
+_HASH_PATTERN = re.compile("[0-9a-f]{64}")
+_UNSAFE_CHARACTERS = re.compile("[^0-9A-Za-z_-]")
+_PARTIAL_SUFFIX = ".part"
+
+
+def content_hash(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def file_hash(path: str) -> str:
+    """
+    Return the content hash of a file, read one block at a time.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(MEDIA_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def encode_media_block(path: str, hash_: str, offset: int, total_size: int, data) -> bytes:
+    return b"".join([encode_string(path), encode_string(hash_), encode_uint64(offset), encode_uint64(total_size), data])
+
+
+def decode_media_block(buffer) -> Tuple[str, str, int, int, int]:
+    """
+    Return the path, content hash, offset and total size of a media block, and the index of its data in buffer.
+    """
+    path, index = decode_string(buffer, 0)
+    hash_, index = decode_string(buffer, index)
+    offset, index = decode_uint64(buffer, index)
+    total_size, index = decode_uint64(buffer, index)
+    return path, hash_, offset, total_size, index
+
+
+def is_media_reference(command: Command) -> bool:
+    """
+    Return True if command is a reference to a stored media, that the receiver must have in its cache.
+    """
+    if command.type != MessageType.BLENDER_DATA_MEDIA:
+        return False
+    _, _, _, total_size, index = decode_media_block(command.data)
+    return total_size > 0 and index == len(command.data)
+
+
+class MediaBlocks:
+    """
+    The BLENDER_DATA_MEDIA blocks of a stored media, read from its blob when they are sent, one block at a time
+    between the interactive commands like common.FrameChunks.
+    """
+
+    def __init__(self, reference: Command, blob_path: str):
+        self._reference = reference
+        self._path, self._hash, _, self._total_size, _ = decode_media_block(reference.data)
+        self._blob_path = blob_path
+        self._file: Optional[BinaryIO] = None
+        self._offset = 0
+
+    @property
+    def done(self) -> bool:
+        return self._offset >= self._total_size
+
+    def next_chunk(self) -> List[Any]:
+        """
+        Return the frame buffers of the next block.
+        """
+        if self._file is None:
+            self._file = open(self._blob_path, "rb")
+        data = self._file.read(min(MEDIA_BLOCK_SIZE, self._total_size - self._offset))
+        if not data:
+            raise OSError(f"Media blob {self._blob_path} truncated at {self._offset} of {self._total_size} bytes")
+        block = encode_media_block(self._path, self._hash, self._offset, self._total_size, data)
+        self._offset += len(data)
+        if self.done:
+            self._file.close()
+        command = Command(MessageType.BLENDER_DATA_MEDIA, block, self._reference.id, self._reference.coalescing_key)
+        return list(command.frame_buffers())
+
+
+class MediaStore:
+    """
+    The blobs of a directory, named after their content hash. The blocks of a blob being received are written to a
+    partial file of the uploader that sends them, that is renamed to the blob once complete and verified. Several
+    uploaders may send the same content at the same time, the first one complete stores it.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, hash_: str) -> str:
+        return os.path.join(self.directory, hash_)
+
+    def has(self, hash_: str) -> bool:
+        return _HASH_PATTERN.fullmatch(hash_) is not None and os.path.exists(self.path(hash_))
+
+    def hashes(self) -> List[str]:
+        """
+        Return the hashes of the complete blobs.
+        """
+        return [name for name in os.listdir(self.directory) if _HASH_PATTERN.fullmatch(name)]
+
+    def add_block(self, command: Command, uploader: str) -> Optional[Command]:
+        """
+        Write a received BLENDER_DATA_MEDIA block to its blob. Return the reference that replaces the media in the
+        room once the blob is complete, None meanwhile, or command itself if it cannot be stored.
+
+        The blocks of an uploader, the connection that sends them, must be added in order by a single thread.
+
+        The blocks of a blob that is already stored are not written again, and a reference to a stored blob is
+        returned as is.
+        """
+        path, hash_, offset, total_size, index = decode_media_block(command.data)
+        if total_size == 0 or _HASH_PATTERN.fullmatch(hash_) is None:
+            return command
+        reference = Command(
+            MessageType.BLENDER_DATA_MEDIA,
+            encode_media_block(path, hash_, 0, total_size, b""),
+            command.id,
+            command.coalescing_key,
+        )
+
+        blob_path = self.path(hash_)
+        # per process, for the workers of a multi-process server that share the directory
+        partial_path = f"{blob_path}.{os.getpid()}.{_UNSAFE_CHARACTERS.sub('_', uploader)}{_PARTIAL_SUFFIX}"
+        data = memoryview(command.data)[index:]
+        if os.path.exists(blob_path):
+            # a reference, or a block of a media stored meanwhile by another uploader
+            if data and os.path.exists(partial_path):
+                os.remove(partial_path)
+            return reference if not data or offset + len(data) >= total_size else None
+        if not data:
+            logger.error("Media store: reference to unknown media %s for %s", hash_, path)
+            return None
+
+        if offset > 0 and not os.path.exists(partial_path):
+            logger.warning("Media store: block at %d of %s received without the previous blocks", offset, path)
+            return None
+        with open(partial_path, "r+b" if offset > 0 else "wb") as f:
+            f.seek(offset)
+            f.write(data)
+        if offset + len(data) < total_size:
+            return None
+
+        if file_hash(partial_path) != hash_:
+            logger.error("Media store: content of %s does not match its hash %s, dropped", path, hash_)
+            os.remove(partial_path)
+            return None
+        if os.path.exists(blob_path):
+            # stored meanwhile from another uploader
+            os.remove(partial_path)
+            return reference
+        os.replace(partial_path, blob_path)
+        logger.info("Media store: %s stored as %s (%d bytes)", path, hash_, total_size)
+        return reference
+
+    def blocks(self, reference: Command) -> Optional[MediaBlocks]:
+        """
+        Return the blocks of the media of a reference, or None if the blob is missing.
+        """
+        hash_ = decode_media_block(reference.data)[1]
+        if not self.has(hash_):
+            logger.error("Media store: blob %s is missing", hash_)
+            return None
+        return MediaBlocks(reference, self.path(hash_))
@@ -0,0 +1,295 @@
+# MIT License
+#
+# Copyright (c) 2020 Ubisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+"""
+Relay mode of the server, for the sites that reach the main server over a slow or distant network.
+
+The relay serves its local clients like a server and keeps a local copy of the rooms they join. For each of these
+rooms it joins the room of the main server with a single client, forwards upstream the commands of the local clients
+and broadcasts locally the commands of the other sites. A local client that joins a room already relayed receives
+the room content from the local copy, without transfer from the main server.
+
+The relay also keeps the room and client attributes of the main server, so that the local clients can list and join
+the rooms of all the sites. The clients of the relay are not visible from the other sites, that see a single client
+per relayed room.
+"""
+
+from __future__ import annotations
+
+import logging
+import select
+import threading
+import time
+from typing import List, Optional, Tuple, TYPE_CHECKING
+
+from mixer.broadcaster.client import Client
+import mixer.broadcaster.common as common
+from mixer.broadcaster.server_workers import Peers
+
+if TYPE_CHECKING:
+    from mixer.broadcaster.apps.server import Room, Server
+
+logger = logging.getLogger(__name__)
+
+# seconds to wait for the main server to accept a connection or a room join
+UPSTREAM_TIMEOUT = 30.0
+
+# seconds to wait for upstream commands before sending the queued local commands
+_POLL_INTERVAL = 0.005
+
+# lobby requests of the local clients that are also forwarded to the main server
+RELAYED_REQUESTS = {
+    common.MessageType.SET_ROOM_CUSTOM_ATTRIBUTES,
+    common.MessageType.SET_ROOM_KEEP_OPEN,
+}
+
+# messages of the main server broadcast to the local clients, the updates of the rooms and clients
+_RELAYED_UPDATES = {
+    common.MessageType.ROOM_UPDATE,
+    common.MessageType.ROOM_DELETED,
+    common.MessageType.CLIENT_UPDATE,
+    common.MessageType.CLIENT_DISCONNECTED,
+}
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    """Return the (host, port) tuple of a host:port string, the port defaulting to the port of the server"""
+    host, _, port = address.rpartition(":")
+    if not host:
+        return address, common.DEFAULT_PORT
+    return host, int(port)
+
+
+def _connect(host: str, port: int, name: str) -> Client:
+    client = Client(host, port)
+    client.connect()
+    if not client.is_connected():
+        raise ConnectionError(f"Cannot connect to the main server {host}:{port}")
+    client.set_client_attributes({common.ClientAttributes.USERNAME: name})
+    return client
+
+
+class RoomUplink:
+    """
+    The client of the main server that joins a room on behalf of the local clients of the relay.
+    """
+
+    def __init__(self, client: Client, room_name: str):
+        self.room_name = room_name
+        self._client = client
+        self._room: Optional[Room] = None
+        self._outgoing: List[common.Command] = []
+        self._outgoing_mutex = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(None, self._run, name=f"uplink {room_name}")
+
+        self.created = False  # the room did not exist on the main server, the local creator sends its content
+        self.history: List[common.Command] = []  # content of an existing room received when joining
+
+    def join(
+        self,
+        blender_version: str,
+        mixer_version: str,
+        ignore_version_check: bool,
+        generic_protocol: bool,
+    ):
+        """
+        Join the room of the main server and receive its content.
+        Raise an exception when the main server refuses the join.
+        """
+        client = self._client
+        client.join_room(self.room_name, blender_version, mixer_version, ignore_version_check, generic_protocol)
+        # the clients that join an existing room receive CLEAR_CONTENT, the content of the room then JOIN_ROOM, the
+        # creator receives JOIN_ROOM then CONTENT
+        cleared = False
+        joined = False
+        start = time.monotonic()
+        while not (joined and (cleared or self.created)):
+            if time.monotonic() - start > UPSTREAM_TIMEOUT:
+                raise TimeoutError(f"No answer of the main server to the join of room {self.room_name}")
+            select.select([client.socket._socket], [], [], _POLL_INTERVAL)
+            for command in client.fetch_incoming_commands():
+                if command.type == common.MessageType.SEND_ERROR:
+                    raise Exception(f"Main server: {common.decode_string(command.data, 0)[0]}")
+                elif command.type == common.MessageType.CLEAR_CONTENT:
+                    cleared = True
+                    self.history = []
+                elif command.type == common.MessageType.JOIN_ROOM:
+                    joined = True
+                elif command.type == common.MessageType.CONTENT:
+                    self.created = True
+                elif command.type.value > common.MessageType.COMMAND.value:
+                    self.history.append(command)
+
+    def start(self, room: Room):
+        """
+        Relay the commands of room, that contains the content received by join().
+        """
+        self._room = room
+        self.history = []
+        self._thread.start()
+
+    def send(self, command: common.Command):
+        """
+        Queue a command of a local client to be sent to the main server.
+        """
+        with self._outgoing_mutex:
+            self._outgoing.append(command)
+
+    def stop(self):
+        self._stopped = True
+        if not self._thread.is_alive():
+            self._disconnect()
+
+    def _disconnect(self):
+        if self._client.is_connected():
+            try:
+                self._client.disconnect()
+            except OSError:
+                pass
+
+    def _run(self):
+        client = self._client
+        room = self._room
+        assert room is not None
+        try:
+            while not self._stopped and client.is_connected():
+                with self._outgoing_mutex:
+                    outgoing, self._outgoing = self._outgoing, []
+                for index, command in enumerate(outgoing):
+                    if not client.send_command(command):
+                        # the connection is lost, the uplink stops and the local clients are told below
+                        logger.error(
+                            "%d commands of room %s not relayed to the main server",
+                            len(outgoing) - index,
+                            self.room_name,
+                        )
+                        raise common.ClientDisconnectedException()
+                if not outgoing:
+                    select.select([client.socket._socket], [], [], _POLL_INTERVAL)
+                for command in client.fetch_incoming_commands():
+                    if command.type.value > common.MessageType.COMMAND.value:
+                        room.add_command(command, None)
+        except common.ClientDisconnectedException:
+            pass
+        except Exception:
+            logger.exception("Relay of room %s failed", self.room_name)
+        finally:
+            self._disconnect()
+
+        if not self._stopped:
+            message = f"Connection of the relay to the main server lost for room {self.room_name}"
+            logger.error(message)
+            error = common.Command(common.MessageType.SEND_ERROR, common.encode_string(message))
+            for connection in room.connections():
+                connection.add_command(error)
+
+
+class RelayPeers(Peers):
+    """
+    The main server seen from a relay, that keeps its room and client attributes and opens the room uplinks.
+    """
+
+    def __init__(self, server: Server, host: str, port: int):
+        super().__init__(server)
+        self.host = host
+        self.port = port
+        self._lobby: Optional[Client] = None
+        self._lobby_mutex = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._uplinks: List[RoomUplink] = []
+
+    def start(self):
+        self._lobby = _connect(self.host, self.port, "relay")
+        logger.info("Relaying the main server %s:%s", self.host, self.port)
+        self._thread = threading.Thread(None, self._run_lobby, name="relay lobby")
+        self._thread.start()
+
+    def stop(self):
+        with self._lobby_mutex:
+            uplinks, self._uplinks = self._uplinks, []
+        for uplink in uplinks:
+            uplink.stop()
+        if self._thread is not None:
+            self._thread.join()
+
+    def is_local_room(self, room_name: str) -> bool:
+        # the rooms of the main server are relayed by this process, so that no connection is handed off
+        return True
+
+    def broadcast(self, command: common.Command):
+        # the main server knows the relay by its uplinks, not its local clients
+        pass
+
+    def forward(self, command: common.Command):
+        """
+        Forward a lobby request of a local client to the main server.
+        """
+        with self._lobby_mutex:
+            if self._lobby is not None:
+                self._lobby.send_command(command)
+
+    def join_upstream(
+        self,
+        room_name: str,
+        blender_version: str,
+        mixer_version: str,
+        ignore_version_check: bool,
+        generic_protocol: bool,
+    ) -> RoomUplink:
+        """
+        Join a room of the main server with a new client, to relay it locally.
+        """
+        uplink = RoomUplink(_connect(self.host, self.port, f"relay {room_name}"), room_name)
+        try:
+            uplink.join(blender_version, mixer_version, ignore_version_check, generic_protocol)
+        except Exception:
+            uplink.stop()
+            raise
+        with self._lobby_mutex:
+            self._uplinks = [u for u in self._uplinks if not u._stopped] + [uplink]
+        logger.info("Room %s joined on the main server (%d commands)", room_name, len(uplink.history))
+        return uplink
+
+    def _run_lobby(self):
+        lobby = self._lobby
+        assert lobby is not None
+        try:
+            while not self._server.shutting_down and lobby.is_connected():
+                select.select([lobby.socket._socket], [], [], 0.1)
+                with self._lobby_mutex:
+                    commands = lobby.fetch_incoming_commands()
+                for command in commands:
+                    if command.type in (common.MessageType.LIST_ROOMS, common.MessageType.LIST_CLIENTS):
+                        self.observe(command)
+                    elif command.type in _RELAYED_UPDATES:
+                        self.observe(command)
+                        self._server.broadcast_to_local_clients(command)
+        except common.ClientDisconnectedException:
+            pass
+        if not self._server.shutting_down:
+            logger.error("Connection of the relay to the main server %s:%s lost", self.host, self.port)
+        with self._lobby_mutex:
+            if lobby.is_connected():
+                lobby.disconnect()
+            self._lobby = None
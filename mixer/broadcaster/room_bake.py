@@ -27,9 +27,8 @@ An known issue is that all these functions are synchronous, so we cannot inform
 """
 
 from mixer.broadcaster.common import MessageType, encode_json
-from mixer.broadcaster.common import Command
+from mixer.broadcaster.common import Command, make_command_from_frame
 from mixer.broadcaster.common import ClientDisconnectedException
-from mixer.broadcaster.common import read_all_messages
 from mixer.broadcaster.client import Client
 from typing import List, Tuple, Dict, Any
 import logging
@@ -111,7 +110,7 @@ def upload_room(host: str, port: int, room_name: str, room_attributes: dict, com
 
             # The server will send back room update messages since the room is joined.
             # Consume them to avoid a client/server deadlock on broadcaster full send socket
-            read_all_messages(client.socket, timeout=0.0)
+            client.fetch_incoming_commands()
 
         client.send_command(Command(MessageType.CONTENT))
 
@@ -128,7 +127,7 @@ def save_room(room_attributes: dict, commands: List[Command], file_path: str):
 
 
 def load_room(file_path: str) -> Tuple[dict, List[Command]]:
-    from mixer.broadcaster.common import bytes_to_int, int_to_message_type
+    from mixer.broadcaster.common import bytes_to_int
     import json
 
     # todo factorize file reading with network reading
@@ -151,7 +150,7 @@ def load_room(file_path: str) -> Tuple[dict, List[Command]]:
 
             msg = f.read(frame_size)
 
-            commands.append(Command(int_to_message_type(message_type), msg, command_id))
+            commands.append(make_command_from_frame(message_type, msg, command_id))
 
     assert room_medata is not None
 
@@ -0,0 +1,453 @@
+# MIT License
+#
+# Copyright (c) 2020 Ubisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Storage of the commands of a room, that are replayed to joining clients.
+"""
+
+import array
+from bisect import bisect_left
+import struct
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from mixer.broadcaster.common import (
+    COALESCING_KEY_FLAG,
+    COMPRESSED_FLAG,
+    HEADER_SIZE,
+    Command,
+    MessageType,
+    coalescing_key_entity,
+    coalescing_key_has_field_group,
+    decode_string,
+    decode_string_array,
+    int_to_message_type,
+)
+
+CoalescingKey = Tuple[MessageType, str]
+
+# Compact the storage when it contains more removed commands than this and than live commands
+_COMPACTION_THRESHOLD = 1024
+
+# Initial size of the arena of a history
+_ARENA_MIN_SIZE = 64 * 1024
+
+_HEADER = struct.Struct("<QIH")
+_STRING_SIZE = struct.Struct("<I")
+
+# Message type of the removed commands in the storage, not used by any MessageType
+_REMOVED = 0
+
+
+def coalescing_key(command: Command) -> Optional[CoalescingKey]:
+    """
+    Return the key that identifies the commands superseded by command, or None if command does not supersede
+    any previous command.
+    """
+    if command.coalescing_key is not None:
+        if not coalescing_key_has_field_group(command.coalescing_key):
+            return None
+        return command.type, command.coalescing_key
+
+    if command.type == MessageType.TRANSFORM:
+        # Clients that do not send coalescing keys (VRtist) send the object path as the first field
+        return command.type, decode_string(command.data, 0)[0]
+
+    return None
+
+
+class _Storage:
+    """
+    The frames of the commands of a history, stored one after the other in an arena, with parallel indexes.
+
+    The arena only grows by replacement with a larger copy, so that the frames already stored are never moved or
+    modified in an arena and can be read through memoryviews while commands are appended.
+    """
+
+    def __init__(self, arena_size: int = _ARENA_MIN_SIZE):
+        self.arena = bytearray(arena_size)
+        self.end = 0  # bytes used in arena
+        self.sequences = array.array("Q")
+        self.offsets = array.array("Q")  # position of the frames in arena
+        self.types = array.array("H")  # wire message types, _REMOVED for removed commands
+
+    def append(self, sequence: int, command: Command):
+        size = command.byte_size()
+        end = self.end + size
+        if end > len(self.arena):
+            arena = bytearray(max(2 * len(self.arena), end))
+            arena[: self.end] = memoryview(self.arena)[: self.end]
+            self.arena = arena
+
+        offset = self.end
+        for buffer in command.frame_buffers(compressed=True):
+            length = len(buffer)
+            self.arena[offset : offset + length] = buffer
+            offset += length
+        message_type = _HEADER.unpack_from(self.arena, self.end)[2]
+
+        # the indexes are extended after the frame is written and types last, for the readers of commands_since()
+        self.sequences.append(sequence)
+        self.offsets.append(self.end)
+        self.types.append(message_type)
+        self.end = end
+
+    def frame_size(self, index: int) -> int:
+        return HEADER_SIZE + _HEADER.unpack_from(self.arena, self.offsets[index])[0]
+
+    def command(self, index: int) -> Command:
+        """
+        Return a Command for the frame at index. Neither the frame nor the data are copied: the data, compressed or
+        not, is a read-only memoryview on the arena.
+        """
+        arena = self.arena
+        offset = self.offsets[index]
+        size, command_id, message_type = _HEADER.unpack_from(arena, offset)
+        frame = memoryview(arena).toreadonly()[offset : offset + HEADER_SIZE + size]
+
+        data_start = HEADER_SIZE
+        coalescing_key = None
+        if message_type & COALESCING_KEY_FLAG:
+            message_type &= ~COALESCING_KEY_FLAG
+            key_size = _STRING_SIZE.unpack_from(frame, data_start)[0]
+            data_start += _STRING_SIZE.size
+            coalescing_key = str(frame[data_start : data_start + key_size], "utf-8")
+            data_start += key_size
+
+        if message_type & COMPRESSED_FLAG:
+            command = Command(int_to_message_type(message_type & ~COMPRESSED_FLAG), b"", command_id, coalescing_key)
+            command.set_compressed_data(frame[data_start:])
+        else:
+            command = Command(int_to_message_type(message_type), frame[data_start:], command_id, coalescing_key)
+        command.set_frame(frame)
+        return command
+
+
+def _datablock_uuid(command: Command) -> Optional[str]:
+    command_type = command.type
+    if command_type in (
+        MessageType.BLENDER_DATA_CREATE,
+        MessageType.BLENDER_DATA_UPDATE,
+        MessageType.BLENDER_DATA_MEDIA,
+    ):
+        if command.coalescing_key is None:
+            return None
+        return coalescing_key_entity(command.coalescing_key)
+    if command_type == MessageType.BLENDER_DATA_RENAME:
+        renames, _ = decode_string_array(command.data, 0)
+        if len(renames) == 3:
+            return renames[0]
+    return None
+
+
+class _StateGroup:
+    """
+    The sequence numbers of the live commands of a datablock, from its media and creation to its latest updates.
+    """
+
+    __slots__ = ("sequences", "closed")
+
+    def __init__(self):
+        self.sequences: Dict[int, None] = {}  # ordered set
+        self.closed = False  # the datablock was removed, a later creation starts a new group
+
+
+class RoomHistory:
+    """
+    The ordered list of the commands of a room.
+
+    Each added command receives a sequence number, that increases with each added command and is never reused.
+
+    A command with a coalescing key supersedes the previous command with the same type and key, wherever it is
+    in the history: the previous command is removed and the new one is appended, so that the history only contains
+    the latest version of each coalesced command. For the OPTIMIZED_COMMANDS of clients that do not send
+    coalescing keys, only the last command is merged, as before coalescing keys existed.
+
+    The commands are not kept as Command objects, whose overhead dominates for small commands, but as frames in an
+    arena, and commands_since() builds Command objects on the fly.
+
+    The history also maintains the state of the room, the same commands grouped by datablock, see state_sequences().
+    Since updates are coalesced by field group, the group of a datablock contains its creation and the latest update
+    of each field group, so that the state is proportional to the content of the room rather than to its history.
+
+    Iterating over the history with commands_since() does not require a lock to be held, provided that the
+    modifications are serialized by the caller: the iteration runs on a snapshot of the storage and may yield
+    commands removed during the iteration, which is harmless since they are superseded by later commands.
+    """
+
+    def __init__(self):
+        self._storage = _Storage()
+        self._next_sequence = 0
+        self._removed_count = 0
+
+        self._latest: Dict[CoalescingKey, int] = {}  # sequence number of the latest command for a coalescing key
+
+        # The state, in order: the sequence numbers of the commands that do not apply to a datablock, and the groups of
+        # the datablocks at the position of their first command
+        self._state: Dict[Union[int, _StateGroup], None] = {}
+        self._state_groups: Dict[str, List[_StateGroup]] = {}  # the groups of a uuid, in order
+
+        self.byte_size = 0
+
+    def command_count(self) -> int:
+        return len(self._storage.types) - self._removed_count
+
+    @property
+    def next_sequence(self) -> int:
+        """The sequence number that the next added command will receive"""
+        return self._next_sequence
+
+    def append(self, command: Command) -> int:
+        """
+        Add command to the history, after removing the commands it supersedes, and return its sequence number.
+        """
+        key = coalescing_key(command)
+        if key is not None:
+            previous = self._latest.get(key)
+            if previous is not None:
+                self.remove(previous)
+        elif self._is_legacy_optimized(command):
+            self._merge_legacy_optimized(command)
+
+        sequence = self._next_sequence
+        self._next_sequence += 1
+        self._storage.append(sequence, command)
+        self.byte_size += command.byte_size()
+        if key is not None:
+            self._latest[key] = sequence
+        self._add_to_state(sequence, command)
+        return sequence
+
+    def remove(self, sequence: int):
+        """
+        Remove the command with the sequence number, if it is still in the history.
+        """
+        storage = self._storage
+        index = bisect_left(storage.sequences, sequence)
+        if index == len(storage.sequences) or storage.sequences[index] != sequence:
+            return
+        if storage.types[index] == _REMOVED:
+            return
+
+        command = storage.command(index)
+        key = coalescing_key(command)
+        if key is not None and self._latest.get(key) == sequence:
+            del self._latest[key]
+        self._remove_from_state(sequence, command)
+
+        storage.types[index] = _REMOVED
+        self._removed_count += 1
+        self.byte_size -= storage.frame_size(index)
+
+        if self._removed_count > _COMPACTION_THRESHOLD and self._removed_count > self.command_count():
+            self._compact()
+
+    def remove_many(self, sequences: Iterable[int]):
+        for sequence in sequences:
+            self.remove(sequence)
+
+    def commands_since(self, sequence: int) -> Iterator[Tuple[int, Command]]:
+        """
+        Yield the sequence numbers and commands of the history from sequence number sequence.
+        """
+        storage = self._storage
+        types = storage.types
+        index = bisect_left(storage.sequences, sequence)
+        # len() is evaluated at each iteration, in order to yield the commands appended during the iteration
+        while index < len(types):
+            if types[index] != _REMOVED:
+                yield storage.sequences[index], storage.command(index)
+            index += 1
+
+    def state_sequences(self) -> List[int]:
+        """
+        Return the sequence numbers of the commands of the history, so that the commands of each datablock are
+        consecutive.
+
+        The commands of a datablock, from its media and creation up to its latest updates, are at the position of the
+        first command received for it, which is valid since the generic protocol resolves the references to
+        datablocks that are created later. A BLENDER_DATA_REMOVE ends a group, so that a datablock created again is not
+        created before its removal. Other commands keep their position in the history.
+
+        The state is modified with the history, so that the caller must serialize this call with the modifications.
+        """
+        sequences: List[int] = []
+        for item in self._state:
+            if isinstance(item, _StateGroup):
+                sequences.extend(item.sequences)
+            else:
+                sequences.append(item)
+        return sequences
+
+    def commands_at(self, sequences: Iterable[int]) -> Iterator[Tuple[int, Command]]:
+        """
+        Yield the sequence numbers and commands of the history with the sequence numbers in sequences, in the order
+        of sequences, skipping the commands that were removed.
+        """
+        storage = self._storage
+        for sequence in sequences:
+            index = bisect_left(storage.sequences, sequence)
+            if index < len(storage.types) and storage.sequences[index] == sequence:
+                if storage.types[index] != _REMOVED:
+                    yield sequence, storage.command(index)
+
+    def _add_to_state(self, sequence: int, command: Command):
+        uuid = _datablock_uuid(command)
+        if uuid is None:
+            if command.type == MessageType.BLENDER_DATA_REMOVE and self._state_groups:
+                try:
+                    removed_uuid = decode_string(command.data, 0)[0]
+                except UnicodeDecodeError:
+                    removed_uuid = ""
+                groups = self._state_groups.get(removed_uuid)
+                if groups:
+                    groups[-1].closed = True
+            self._state[sequence] = None
+            return
+
+        groups = self._state_groups.setdefault(uuid, [])
+        if not groups or groups[-1].closed:
+            groups.append(_StateGroup())
+            self._state[groups[-1]] = None
+        groups[-1].sequences[sequence] = None
+
+    def _remove_from_state(self, sequence: int, command: Command):
+        uuid = _datablock_uuid(command)
+        if uuid is None:
+            self._state.pop(sequence, None)
+            return
+
+        groups = self._state_groups.get(uuid, [])
+        for index, group in enumerate(groups):
+            if sequence in group.sequences:
+                del group.sequences[sequence]
+                if not group.sequences:
+                    del self._state[group]
+                    del groups[index]
+                    if not groups:
+                        del self._state_groups[uuid]
+                break
+
+    def _compact(self):
+        # Build a new storage, so that ongoing commands_since() iterations continue on the previous one
+        previous = self._storage
+        storage = _Storage(max(_ARENA_MIN_SIZE, self.byte_size))
+        for index, message_type in enumerate(previous.types):
+            if message_type != _REMOVED:
+                storage.append(previous.sequences[index], previous.command(index))
+        self._storage = storage
+        self._removed_count = 0
+
+    @staticmethod
+    def _is_legacy_optimized(command: Command) -> bool:
+        return (
+            MessageType.OPTIMIZED_COMMANDS.value < command.type.value < MessageType.END_OPTIMIZED_COMMANDS.value
+            and command.coalescing_key is None
+        )
+
+    def _merge_legacy_optimized(self, command: Command):
+        # Merge with the last command if it has the same type and path.
+        storage = self._storage
+        if not storage.types or storage.types[-1] & ~COMPRESSED_FLAG != command.type.value:
+            return
+        last = storage.command(len(storage.types) - 1)
+        if decode_string(command.data, 0)[0] == decode_string(last.data, 0)[0]:
+            self.remove(storage.sequences[-1])
+
+
+# VRtist commands that apply to an object and start with its name or path
+_VRTIST_OBJECT_COMMANDS = {
+    MessageType.TRANSFORM,
+    MessageType.OBJECT_VISIBILITY,
+    MessageType.SEND_TO_TRASH,
+    MessageType.RESTORE_FROM_TRASH,
+}
+
+
+class _Lifecycle:
+    def __init__(self, created: bool = False):
+        self.created = created
+        self.sequences: List[int] = []
+
+
+def _object_name(path: str) -> str:
+    return path.split("/")[-1]
+
+
+def dead_lifecycle_sequences(commands: Iterable[Tuple[int, Command]]) -> List[int]:
+    """
+    Return the sequence numbers of the commands that can be dropped from a history because they belong to the
+    lifecycle of a removed entity.
+
+    For datablocks of the generic protocol, the lifecycle of a uuid starts with BLENDER_DATA_CREATE and ends with
+    BLENDER_DATA_REMOVE. All its commands are dropped: creation, updates, media and renames of this datablock only.
+    If the creation is not in the history, the removal is kept.
+
+    For VRtist objects, the commands that apply to a deleted object, tracked by name across RENAME, are dropped, but
+    DELETE and RENAME are kept since the object may have been created by commands that the server cannot attribute
+    to the object. Objects that were sent to the trash and not deleted are kept, since they can be restored.
+    """
+    dead: List[int] = []
+    datablocks: Dict[str, _Lifecycle] = {}
+    objects: Dict[str, List[int]] = {}
+
+    for sequence, command in commands:
+        command_type = command.type
+        if command_type == MessageType.BLENDER_DATA_CREATE:
+            if command.coalescing_key is None:
+                continue
+            uuid = coalescing_key_entity(command.coalescing_key)
+            lifecycle = datablocks.get(uuid)
+            if lifecycle is None or lifecycle.created:
+                lifecycle = datablocks[uuid] = _Lifecycle()
+            # the media of a datablock is sent before its creation
+            lifecycle.created = True
+            lifecycle.sequences.append(sequence)
+        elif command_type in (MessageType.BLENDER_DATA_UPDATE, MessageType.BLENDER_DATA_MEDIA):
+            if command.coalescing_key is None:
+                continue
+            uuid = coalescing_key_entity(command.coalescing_key)
+            datablocks.setdefault(uuid, _Lifecycle()).sequences.append(sequence)
+        elif command_type == MessageType.BLENDER_DATA_RENAME:
+            renames, _ = decode_string_array(command.data, 0)
+            if len(renames) == 3:
+                datablocks.setdefault(renames[0], _Lifecycle()).sequences.append(sequence)
+        elif command_type == MessageType.BLENDER_DATA_REMOVE:
+            uuid, _ = decode_string(command.data, 0)
+            lifecycle = datablocks.pop(uuid, None)
+            if lifecycle is not None:
+                dead.extend(lifecycle.sequences)
+                if lifecycle.created:
+                    dead.append(sequence)
+        elif command_type in _VRTIST_OBJECT_COMMANDS:
+            name = _object_name(decode_string(command.data, 0)[0])
+            objects.setdefault(name, []).append(sequence)
+        elif command_type == MessageType.RENAME:
+            old_path, index = decode_string(command.data, 0)
+            new_path, _ = decode_string(command.data, index)
+            sequences = objects.pop(_object_name(old_path), None)
+            if sequences is not None:
+                objects[_object_name(new_path)] = sequences
+        elif command_type == MessageType.DELETE:
+            name = _object_name(decode_string(command.data, 0)[0])
+            dead.extend(objects.pop(name, []))
+
+    return dead
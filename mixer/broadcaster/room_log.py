@@ -0,0 +1,341 @@
+# MIT License
+#
+# Copyright (c) 2020 Ubisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Durable storage of the rooms of the server, so that they survive a server restart.
+
+Each room has an append-only log of its commands, with the same framing as the network and room_bake.save_room(),
+and a json file of its attributes. The files are written by a single background thread, that syncs them to disk
+once per batch of commands.
+"""
+
+import json
+import logging
+import mmap
+import os
+import queue
+import struct
+import threading
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Tuple
+import urllib.parse
+
+from mixer.broadcaster.common import HEADER_SIZE, Command, RoomAttributes, make_command_from_frame
+from mixer.broadcaster.media_store import is_media_reference
+
+logger = logging.getLogger(__name__)
+
+LOG_SUFFIX = ".log"
+ATTRIBUTES_SUFFIX = ".json"
+
+# The log is rewritten with the live commands of the room when it is larger than this and than
+# _REWRITE_RATIO times the byte size of the room
+_REWRITE_MIN_SIZE = 16 * 1024 * 1024
+_REWRITE_RATIO = 2
+
+_HEADER = struct.Struct("<QIH")
+
+_APPEND = 0
+_ATTRIBUTES = 1
+_DELETE = 2
+
+# sequence number of the next command and list of the live commands of a room
+Snapshot = Tuple[int, List[Command]]
+
+
+def _fsync_directory(path: str):
+    if os.name != "posix":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class RoomLog:
+    """
+    The files of a room. Modified only by the RoomLogWriter thread, other threads queue operations.
+    """
+
+    def __init__(
+        self, writer: "RoomLogWriter", room_name: str, snapshot: Callable[[], Snapshot], byte_size: Callable[[], int]
+    ):
+        stem = os.path.join(writer.log_dir, urllib.parse.quote(room_name, safe=""))
+        self.path = stem + LOG_SUFFIX
+        self.attributes_path = stem + ATTRIBUTES_SUFFIX
+        self._writer = writer
+        self._snapshot = snapshot
+        self._byte_size = byte_size
+        self._file = None
+        self._skip_before = 0  # commands before this sequence number are already in a rewritten log
+        self._last_sequence = -1
+
+        # All the commands with a sequence number lower than durable[0] are synced to disk, in the durable[1] first
+        # bytes of the log
+        self.durable: Tuple[int, int] = (0, 0)
+        self._replace_mutex = threading.Lock()  # protects the replacement of the log file by a rewrite
+        # the log may contain compressed frames, that can only be sent to the clients that accept them
+        self.compressed = False
+        # the log may contain references to stored media, that must be expanded for each client
+        self.media_references = False
+
+    def restored(self, next_sequence: int, compressed: bool = False, media_references: bool = False):
+        """
+        Declare that the log contains the commands of a room restored up to next_sequence, compressed if some of
+        its frames are compressed, with media_references if it contains references to stored media.
+        """
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        self._last_sequence = next_sequence - 1
+        self.durable = (next_sequence, size)
+        self.compressed = compressed
+        self.media_references = media_references
+
+    def open_durable(self) -> Optional[Tuple[BinaryIO, int, int]]:
+        """
+        Open the log for reading and return the file, with the values of durable that apply to this file, or None
+        if nothing is durable yet.
+
+        The file remains valid if the log is rewritten or deleted while it is read.
+        """
+        with self._replace_mutex:
+            next_sequence, size = self.durable
+            if size == 0:
+                return None
+            return open(self.path, "rb"), next_sequence, size
+
+    def append(self, sequence: int, command: Command):
+        self._writer.put((self, _APPEND, sequence, command))
+
+    def write_attributes(self, attributes: Dict[str, Any]):
+        self._writer.put((self, _ATTRIBUTES, attributes))
+
+    def delete(self):
+        self._writer.put((self, _DELETE))
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, "ab")
+
+    def _write(self, sequence: int, command: Command):
+        if sequence < self._skip_before:
+            return
+        self._open()
+        self._file.writelines(command.frame_buffers(compressed=True))
+        self.compressed = self.compressed or command.compressed
+        self.media_references = self.media_references or is_media_reference(command)
+        self._last_sequence = sequence
+
+    def _write_attributes(self, attributes: Dict[str, Any]):
+        tmp_path = self.attributes_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(attributes, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.attributes_path)
+        _fsync_directory(self._writer.log_dir)
+
+    def _sync(self):
+        if self._file is None:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        size = self._file.tell()
+        self.durable = (self._last_sequence + 1, size)
+        if size > _REWRITE_MIN_SIZE and size > _REWRITE_RATIO * self._byte_size():
+            self._rewrite()
+
+    def _rewrite(self):
+        next_sequence, commands = self._snapshot()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            compressed = False
+            media_references = False
+            for command in commands:
+                f.writelines(command.frame_buffers(compressed=True))
+                compressed = compressed or command.compressed
+                media_references = media_references or is_media_reference(command)
+            f.flush()
+            os.fsync(f.fileno())
+            size = f.tell()
+        self._close()
+        with self._replace_mutex:
+            os.replace(tmp_path, self.path)
+            self.durable = (next_sequence, size)
+            self.compressed = compressed
+            self.media_references = media_references
+        _fsync_directory(self._writer.log_dir)
+        logger.info("Room log %s rewritten with %d commands", self.path, len(commands))
+
+        self._skip_before = next_sequence
+        self._last_sequence = next_sequence - 1
+
+    def _close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _delete(self):
+        self._close()
+        for path in (self.path, self.attributes_path):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+
+class RoomLogWriter:
+    """
+    The thread that writes the logs of all the rooms of a server.
+    """
+
+    def __init__(self, log_dir: str):
+        self.log_dir = log_dir
+        self._queue: queue.Queue = queue.Queue()
+        self._thread = threading.Thread(None, self._run, name="room log writer")
+
+    def start(self):
+        os.makedirs(self.log_dir, exist_ok=True)
+        self._thread.start()
+
+    def stop(self):
+        """Write the pending operations and stop the thread"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def put(self, operation):
+        self._queue.put(operation)
+
+    def _run(self):
+        logs = set()
+        running = True
+        while running:
+            operations = [self._queue.get()]
+            while True:
+                try:
+                    operations.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            modified = set()
+            for operation in operations:
+                if operation is None:
+                    running = False
+                    continue
+                log = operation[0]
+                try:
+                    self._apply(operation)
+                except Exception:
+                    logger.exception("Room log %s: write failed", log.path)
+                if operation[1] == _DELETE:
+                    logs.discard(log)
+                    modified.discard(log)
+                else:
+                    logs.add(log)
+                    modified.add(log)
+
+            # a single sync per batch of commands
+            for log in modified:
+                try:
+                    log._sync()
+                except Exception:
+                    logger.exception("Room log %s: sync failed", log.path)
+
+        for log in logs:
+            log._close()
+
+    @staticmethod
+    def _apply(operation):
+        log, kind = operation[0], operation[1]
+        if kind == _APPEND:
+            log._write(operation[2], operation[3])
+        elif kind == _ATTRIBUTES:
+            log._write_attributes(operation[2])
+        elif kind == _DELETE:
+            log._delete()
+
+
+def read_log(path: str) -> List[Command]:
+    """
+    Return the commands of a room log.
+
+    A frame truncated by a crash during its write is removed from the log.
+    """
+    commands: List[Command] = []
+    with open(path, "r+b") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return commands
+
+        offset = 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            while offset + HEADER_SIZE <= size:
+                frame_size, command_id, message_type = _HEADER.unpack_from(buffer, offset)
+                frame_end = offset + HEADER_SIZE + frame_size
+                if frame_end > size:
+                    break
+                data = buffer[offset + HEADER_SIZE : frame_end]
+                commands.append(make_command_from_frame(message_type, data, command_id))
+                offset = frame_end
+
+        if offset != size:
+            logger.warning("Room log %s: truncated frame removed (%d bytes)", path, size - offset)
+            f.truncate(offset)
+    return commands
+
+
+def recover_rooms(
+    log_dir: str, room_filter: Optional[Callable[[str], bool]] = None
+) -> List[Tuple[Dict[str, Any], List[Command]]]:
+    """
+    Return the attributes and commands of the rooms logged in log_dir, or of the rooms whose name satisfies
+    room_filter.
+
+    Only the rooms that are kept open and joinable are recovered, the files of the other rooms are removed.
+    """
+    rooms: List[Tuple[Dict[str, Any], List[Command]]] = []
+    if not os.path.isdir(log_dir):
+        return rooms
+
+    for file_name in sorted(os.listdir(log_dir)):
+        if not file_name.endswith(ATTRIBUTES_SUFFIX):
+            continue
+        attributes_path = os.path.join(log_dir, file_name)
+        log_path = attributes_path[: -len(ATTRIBUTES_SUFFIX)] + LOG_SUFFIX
+        try:
+            with open(attributes_path, "r") as f:
+                attributes = json.load(f)
+            if room_filter is not None and not room_filter(attributes.get(RoomAttributes.NAME, "")):
+                continue
+            if not attributes.get(RoomAttributes.KEEP_OPEN) or not attributes.get(RoomAttributes.JOINABLE):
+                logger.info("Room log %s: room was not kept open, removed", log_path)
+                for path in (attributes_path, log_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                continue
+
+            commands = read_log(log_path) if os.path.exists(log_path) else []
+        except Exception:
+            logger.exception("Room log %s: recovery failed", log_path)
+            continue
+        rooms.append((attributes, commands))
+
+    return rooms
@@ -0,0 +1,384 @@
+# MIT License
+#
+# Copyright (c) 2020 Ubisoft
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Multi-process mode of the server, so that the rooms do not share a single GIL.
+
+A front process accepts the connections and serves the clients that are not in a room. Each room belongs to a worker
+process, chosen from the room name. When a client joins a room, its socket is passed to the worker of the room over
+a Unix socket, with the commands already read from it. A worker passes a client back to the front when it joins a
+room of another worker.
+
+The processes forward each other the messages broadcast to all the clients (ROOM_UPDATE, CLIENT_UPDATE, ...). Each
+process keeps the room and client attributes of the other processes from these messages, in order to answer
+LIST_ROOMS and LIST_CLIENTS for all the server.
+"""
+
+from __future__ import annotations
+
+import array
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+import socket
+import struct
+import threading
+from typing import Any, Deque, Dict, List, Optional, Tuple, TYPE_CHECKING
+
+import mixer.broadcaster.common as common
+
+if TYPE_CHECKING:
+    from mixer.broadcaster.apps.server import Connection, Server
+
+logger = logging.getLogger(__name__)
+
+# json size and payload size of a message between processes
+_MESSAGE_HEADER = struct.Struct("<II")
+_FRAME_HEADER = struct.Struct("<QIH")
+
+_RECV_SIZE = 256 * 1024
+_MAX_FDS = 16
+
+# Server attributes copied to the workers
+_WORKER_SETTINGS = (
+    "latency",
+    "bandwidth",
+    "history_compaction_interval",
+    "join_mode",
+    "room_log_dir",
+    "queue_soft_limit",
+    "queue_hard_limit",
+    "status_update_interval",
+    "resume_retention",
+    "capabilities",
+    "media_dir",
+)
+
+
+def is_supported() -> bool:
+    return hasattr(socket, "AF_UNIX") and hasattr(socket, "SCM_RIGHTS")
+
+
+def room_worker(room_name: str, worker_count: int) -> int:
+    """Return the index of the worker that owns a room"""
+    # not crc32, that gives the same parity to names that only differ by a trailing digit
+    digest = hashlib.blake2b(room_name.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % worker_count
+
+
+def _commands_from_frames(buffer: bytes) -> List[common.Command]:
+    commands = []
+    offset = 0
+    while offset < len(buffer):
+        size, command_id, message_type = _FRAME_HEADER.unpack_from(buffer, offset)
+        start = offset + common.HEADER_SIZE
+        commands.append(common.make_command_from_frame(message_type, buffer[start : start + size], command_id))
+        offset = start + size
+    return commands
+
+
+class PeerChannel:
+    """
+    Messages between two server processes over a Unix socket: a json object, a binary payload and optionally a
+    file descriptor.
+    """
+
+    def __init__(self, sock: socket.socket):
+        self._socket = sock
+        self._send_mutex = threading.Lock()
+        self._buffer = bytearray()
+        self._fds: Deque[int] = collections.deque()  # received file descriptors, in the order of their messages
+
+    def send(self, message: Dict[str, Any], payload: bytes = b"", fd: Optional[int] = None):
+        if fd is not None:
+            message = {**message, "fd": True}
+        encoded = json.dumps(message).encode("utf-8")
+        data = memoryview(_MESSAGE_HEADER.pack(len(encoded), len(payload)) + encoded + payload)
+        ancillary = []
+        if fd is not None:
+            ancillary.append((socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", [fd])))
+        with self._send_mutex:
+            sent = self._socket.sendmsg([data], ancillary)
+            if sent < len(data):
+                self._socket.sendall(data[sent:])
+
+    def receive(self) -> Optional[Tuple[Dict[str, Any], bytes, Optional[int]]]:
+        """
+        Wait for a message and return it, or None when the channel is closed.
+        """
+        while True:
+            message = self._parse()
+            if message is not None:
+                return message
+            try:
+                data, ancillary, _, _ = self._socket.recvmsg(_RECV_SIZE, socket.CMSG_SPACE(_MAX_FDS * 4))
+            except OSError:
+                return None
+            if not data:
+                return None
+            for level, kind, fds_data in ancillary:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds = array.array("i")
+                    fds.frombytes(fds_data[: len(fds_data) - (len(fds_data) % fds.itemsize)])
+                    self._fds.extend(fds)
+            self._buffer += data
+
+    def _parse(self) -> Optional[Tuple[Dict[str, Any], bytes, Optional[int]]]:
+        buffer = self._buffer
+        if len(buffer) < _MESSAGE_HEADER.size:
+            return None
+        json_size, payload_size = _MESSAGE_HEADER.unpack_from(buffer, 0)
+        payload_start = _MESSAGE_HEADER.size + json_size
+        end = payload_start + payload_size
+        if len(buffer) < end:
+            return None
+        message = json.loads(bytes(buffer[_MESSAGE_HEADER.size : payload_start]))
+        payload = bytes(buffer[payload_start:end])
+        del buffer[:end]
+        fd = self._fds.popleft() if message.get("fd") else None
+        return message, payload, fd
+
+    def close(self):
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+
+
+class Peers:
+    """
+    The other processes of a multi-process server, seen from one process, or the main server seen from a relay.
+    """
+
+    def __init__(self, server: Server):
+        self._server = server
+        self._mutex = threading.Lock()
+        # attributes of all the rooms and clients, updated with the broadcast messages
+        self._rooms_attributes: Dict[str, Dict[str, Any]] = {}
+        self._clients_attributes: Dict[str, Dict[str, Any]] = {}
+
+    def is_local_room(self, room_name: str) -> bool:
+        raise NotImplementedError
+
+    def broadcast(self, command: common.Command):
+        """Forward a message broadcast to the clients of this process to the other processes"""
+        raise NotImplementedError
+
+    def hand_off(self, connection: Connection, commands: List[common.Command]):
+        """Pass the socket of connection to the process that owns the room it joins"""
+        raise NotImplementedError
+
+    def rooms_attributes(self) -> Dict[str, Dict[str, Any]]:
+        with self._mutex:
+            return {name: dict(attributes) for name, attributes in self._rooms_attributes.items()}
+
+    def clients_attributes(self) -> Dict[str, Dict[str, Any]]:
+        with self._mutex:
+            return {client_id: dict(attributes) for client_id, attributes in self._clients_attributes.items()}
+
+    def observe(self, command: common.Command):
+        """
+        Update the attributes of the rooms and clients with a broadcast message, from this process or another one, or
+        with a list of them.
+        """
+        message_type = command.type
+        with self._mutex:
+            if message_type in (common.MessageType.ROOM_UPDATE, common.MessageType.LIST_ROOMS):
+                for name, attributes in common.decode_json(command.data, 0)[0].items():
+                    self._rooms_attributes.setdefault(name, {}).update(attributes)
+            elif message_type == common.MessageType.ROOM_DELETED:
+                self._rooms_attributes.pop(common.decode_string(command.data, 0)[0], None)
+            elif message_type in (common.MessageType.CLIENT_UPDATE, common.MessageType.LIST_CLIENTS):
+                for client_id, attributes in common.decode_json(command.data, 0)[0].items():
+                    self._clients_attributes.setdefault(client_id, {}).update(attributes)
+            elif message_type == common.MessageType.CLIENT_DISCONNECTED:
+                self._clients_attributes.pop(common.decode_string(command.data, 0)[0], None)
+
+    def _send_connection(self, channel: PeerChannel, connection: Connection, commands: List[common.Command]):
+        message = {
+            "type": "connection",
+            "address": list(connection.address),
+            "attributes": connection.custom_attributes,
+            "capabilities": connection.capabilities,
+            "media_hashes": sorted(connection.media_hashes),
+        }
+        payload = b"".join(command.to_byte_buffer() for command in commands)
+        channel.send(message, payload, connection.socket.fileno())
+        connection.socket.close()
+
+    def _handle_message(self, message: Dict[str, Any], payload: bytes, fd: Optional[int]) -> Optional[common.Command]:
+        """
+        Process a message received from another process. Return the command of a broadcast message.
+        """
+        kind = message["type"]
+        if kind == "broadcast":
+            command = _commands_from_frames(payload)[0]
+            self.observe(command)
+            self._server.broadcast_to_local_clients(command)
+            return command
+        if kind == "connection":
+            assert fd is not None
+            sock = socket.socket(fileno=fd)
+            address = tuple(message["address"])
+            self._server.adopt_connection(
+                sock,
+                address,
+                message["attributes"],
+                _commands_from_frames(payload),
+                message["capabilities"],
+                message["media_hashes"],
+            )
+        else:
+            logger.error("Unknown message %s from another server process", kind)
+        return None
+
+
+class FrontPeers(Peers):
+    """
+    The workers seen from the front process, that owns no room.
+    """
+
+    def __init__(self, server: Server, worker_count: int):
+        super().__init__(server)
+        self._channels: List[PeerChannel] = []
+        self._processes: List[multiprocessing.Process] = []
+        self._threads: List[threading.Thread] = []
+        self.worker_count = worker_count
+
+    def start(self):
+        settings = {name: getattr(self._server, name) for name in _WORKER_SETTINGS}
+        for index in range(self.worker_count):
+            front_socket, worker_socket = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+            process = multiprocessing.Process(
+                target=_run_worker,
+                args=(index, self.worker_count, worker_socket, settings),
+                name=f"mixer server worker {index}",
+                daemon=True,
+            )
+            process.start()
+            worker_socket.close()
+            self._channels.append(PeerChannel(front_socket))
+            self._processes.append(process)
+        logger.info("Started %d worker processes", self.worker_count)
+
+        for index, channel in enumerate(self._channels):
+            thread = threading.Thread(None, self._run_channel, args=(index, channel), name=f"worker {index} channel")
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for channel in self._channels:
+            channel.close()
+        for thread in self._threads:
+            thread.join()
+        for process in self._processes:
+            process.join(timeout=5.0)
+            if process.is_alive():
+                process.terminate()
+
+    def is_local_room(self, room_name: str) -> bool:
+        return False
+
+    def broadcast(self, command: common.Command):
+        self._broadcast(command, None)
+
+    def _broadcast(self, command: common.Command, origin: Optional[PeerChannel]):
+        payload = command.to_byte_buffer()
+        for channel in self._channels:
+            if channel is not origin:
+                try:
+                    channel.send({"type": "broadcast"}, payload)
+                except OSError as e:
+                    logger.warning("Broadcast to a worker failed: %s", e)
+
+    def hand_off(self, connection: Connection, commands: List[common.Command]):
+        room_name = common.decode_string(commands[0].data, 0)[0]
+        index = room_worker(room_name, self.worker_count)
+        logger.info("Client %s joins room %s on worker %d", connection.unique_id, room_name, index)
+        self._send_connection(self._channels[index], connection, commands)
+
+    def _run_channel(self, index: int, channel: PeerChannel):
+        while True:
+            received = channel.receive()
+            if received is None:
+                break
+            try:
+                command = self._handle_message(*received)
+                if command is not None:
+                    # relay to the other workers
+                    self._broadcast(command, channel)
+            except Exception:
+                logger.exception("Message from worker %d failed", index)
+        if not self._server.shutting_down:
+            logger.error("Worker %d stopped", index)
+
+
+class WorkerPeers(Peers):
+    """
+    The front process and the other workers seen from a worker process.
+    """
+
+    def __init__(self, server: Server, index: int, worker_count: int, channel: PeerChannel):
+        super().__init__(server)
+        self.index = index
+        self.worker_count = worker_count
+        self._channel = channel
+
+    def is_local_room(self, room_name: str) -> bool:
+        return room_worker(room_name, self.worker_count) == self.index
+
+    def broadcast(self, command: common.Command):
+        try:
+            self._channel.send({"type": "broadcast"}, command.to_byte_buffer())
+        except OSError as e:
+            logger.warning("Broadcast to the front process failed: %s", e)
+
+    def hand_off(self, connection: Connection, commands: List[common.Command]):
+        # the front process passes it to the right worker
+        self._send_connection(self._channel, connection, commands)
+
+    def run(self):
+        """
+        Process the messages of the front process until it closes the channel.
+        """
+        while True:
+            received = self._channel.receive()
+            if received is None:
+                break
+            try:
+                self._handle_message(*received)
+            except Exception:
+                logger.exception("Message from the front process failed")
+
+
+def _run_worker(index: int, worker_count: int, sock: socket.socket, settings: Dict[str, Any]):
+    from mixer.broadcaster.apps.server import Server
+
+    server = Server()
+    for name, value in settings.items():
+        setattr(server, name, value)
+    peers = WorkerPeers(server, index, worker_count, PeerChannel(sock))
+    server.peers = peers
+    server.run_worker(peers)
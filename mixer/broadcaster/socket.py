@@ -23,6 +23,7 @@
 import logging
 import socket
 import time
+from typing import Optional
 
 # https://stackoverflow.com/questions/1833563/simple-way-to-simulate-a-slow-network-in-python
 
@@ -51,17 +52,43 @@ class Socket:
         self._upstream_Bps = upstream_mbps * mbps_to_bytes_per_sec
         self._downstream_Bps = downstream_mbps * mbps_to_bytes_per_sec
 
-    def sendall(self, buffer, flags: int = 0):
+    def _simulate_send(self, size: int):
         if self._downstream_Bps > 0.0:
-            delay = len(buffer) / self._downstream_Bps
-            logger.warning(f"send {self._downstream_Bps} Bps, buffer {len(buffer)} bytes, delay {delay}")
+            delay = size / self._downstream_Bps
+            logger.warning(f"send {self._downstream_Bps} Bps, buffer {size} bytes, delay {delay}")
             time.sleep(delay)
+
+    def sendall(self, buffer, flags: int = 0):
+        self._simulate_send(len(buffer))
         return self._socket.sendall(buffer, flags)
 
-    def recv(self, size):
-        buffer = self._socket.recv(size)
+    def send(self, buffer, flags: int = 0):
+        sent = self._socket.send(buffer, flags)
+        self._simulate_send(sent)
+        return sent
+
+    def sendmsg(self, buffers, *args):
+        sent = self._socket.sendmsg(buffers, *args)
+        self._simulate_send(sent)
+        return sent
+
+    def sendfile(self, file, offset: int = 0, count: Optional[int] = None):
+        sent = self._socket.sendfile(file, offset, count)
+        self._simulate_send(sent)
+        return sent
+
+    def _simulate_recv(self, size: int):
         if self._upstream_Bps > 0.0:
-            delay = len(buffer) / self._upstream_Bps
-            logger.warning(f"recv {self._upstream_Bps} Bps, buffer {len(buffer)} bytes, delay {delay}")
+            delay = size / self._upstream_Bps
+            logger.warning(f"recv {self._upstream_Bps} Bps, buffer {size} bytes, delay {delay}")
             time.sleep(delay)
+
+    def recv(self, size):
+        buffer = self._socket.recv(size)
+        self._simulate_recv(len(buffer))
         return buffer
+
+    def recv_into(self, buffer, size: int = 0):
+        received = self._socket.recv_into(buffer, size)
+        self._simulate_recv(received)
+        return received
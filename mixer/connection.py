@@ -34,11 +34,19 @@ from pathlib import Path
 from mixer.draw_handlers import remove_draw_handlers
 from mixer.blender_client.client import SendSceneContentFailed, BlenderClient
 from mixer.handlers import HandlerManager
+from mixer.local_data import get_cached_media_hashes
 from mixer.os_utils import tech_infos
 
 
 logger = logging.getLogger(__name__)
 
+# Seconds during which the connection is attempted again after it was lost, to resume the current room
+RESUME_TIMEOUT = 30.0
+
+# Seconds between the runs of network_consumer_timer, while received commands remain to be processed or when idle
+BACKLOG_TIMER_INTERVAL = 0.001
+IDLE_TIMER_INTERVAL = 0.02
+
 
 def set_client_attributes():
     prefs = get_mixer_prefs()
@@ -71,7 +79,12 @@ def join_room(room_name: str, vrtist_protocol: bool = False, shared_folders=None
     set_client_attributes()
     blender_version = bpy.app.version_string
     mixer_version = mixer.display_version
-    share_data.client.join_room(room_name, blender_version, mixer_version, ignore_version_check, not vrtist_protocol)
+    if not vrtist_protocol:
+        # the server sends references to the media that are already in the cache
+        share_data.client.send_media_hashes(get_cached_media_hashes())
+    share_data.client.join_room(
+        room_name, blender_version, mixer_version, ignore_version_check, not vrtist_protocol, resumable=True
+    )
 
     if shared_folders is None:
         shared_folders = []
@@ -183,6 +196,8 @@ def is_client_connected():
 
 def network_consumer_timer():
     if not share_data.client.is_connected():
+        if share_data.client.resume_deadline is not None:
+            return try_resume()
         error_msg = "Timer still registered but client disconnected."
         logger.error(error_msg)
         # Returning None from a timer unregister it
@@ -192,9 +207,18 @@ def network_consumer_timer():
     # if we register it directly, then bpy.app.timers.is_registered(share_data.client.network_consumer)
     # return False...
     # However, with a simple function bpy.app.timers.is_registered works.
+    has_backlog = False
     try:
-        share_data.client.network_consumer()
-    except (ClientDisconnectedException, SendSceneContentFailed) as e:
+        has_backlog = share_data.client.network_consumer()
+    except ClientDisconnectedException as e:
+        logger.warning(e)
+        if share_data.client.can_resume():
+            share_data.client.resume_deadline = time.monotonic() + RESUME_TIMEOUT
+            return try_resume()
+        share_data.client = None
+        disconnect()
+        return None
+    except SendSceneContentFailed as e:
         logger.warning(e)
         share_data.client = None
         disconnect()
@@ -202,8 +226,37 @@ def network_consumer_timer():
     except Exception as e:
         logger.error(f"{e!r}", stack_info=True)
 
-    # Run every 1 / 100 seconds
-    return 0.01
+    # Run again as soon as Blender has redrawn while the received commands are processed
+    return BACKLOG_TIMER_INTERVAL if has_backlog else IDLE_TIMER_INTERVAL
+
+
+def try_resume():
+    """
+    Connect again after the connection was lost and resume the current room, so that only the commands missed
+    meanwhile are received instead of the whole room. Local changes are kept in the pending commands meanwhile.
+    """
+    client = share_data.client
+    try:
+        client.connect()
+    except OSError as e:
+        logger.debug(e)
+
+    if client.is_connected():
+        logger.warning(f"Connection restored, resuming room {client.current_room}")
+        client.resume_deadline = None
+        client.send_media_hashes(get_cached_media_hashes())
+        client.resume_room()
+        return 0.01
+
+    if time.monotonic() < client.resume_deadline:
+        # Run every second until the network is back
+        return 1.0
+
+    logger.warning("Connection lost, cannot resume the room")
+    client.resume_deadline = None
+    share_data.client = None
+    disconnect()
+    return None
 
 
 def create_main_client(host: str, port: int):
@@ -24,6 +24,9 @@ import logging
 import tempfile
 from pathlib import Path
 import hashlib
+import shutil
+from typing import List
+
 import bpy
 
 logger = logging.getLogger(__name__)
@@ -76,6 +79,76 @@ def get_local_or_create_cache_file(str_path: str, data: bytes):
     return str(cache_path)
 
 
+def write_local_or_cache_file_block(str_path: str, content_hash: str, offset: int, total_size: int, data: bytes):
+    """
+    Write a block of the file str_path to the media cache, unless the file exists locally.
+
+    The media cache keeps the files by content hash, so that the server can skip the files that are already cached,
+    see get_cached_media_hashes(). The blocks are written directly to a partial file, renamed after its last block,
+    and the cached file is then linked to the cache file of str_path. A transfer interrupted by a lost connection
+    continues the partial file when it resumes. A block without data is a reference to a cached file.
+    """
+    path = Path(str_path)
+    if path.exists():
+        return str_path
+
+    cache_path = get_cache_file_hash(path)
+    media_path = get_media_directory() / content_hash
+    if media_path.exists():
+        # a reference, or the last block of a file received again
+        if not data or offset + len(data) >= total_size:
+            link_cache_file(path, cache_path, media_path)
+        return str(cache_path)
+    if not data and total_size > 0:
+        logger.error(f"Media {content_hash} of {str_path} referenced but not in cache")
+        return None
+
+    partial_path = media_path.with_name(media_path.name + ".part")
+    if offset > 0 and not partial_path.exists():
+        logger.warning(f"Block at {offset} of {str_path} received without the previous blocks, ignored")
+        return None
+    partial_path.parent.mkdir(parents=True, exist_ok=True)
+    mode = "r+b" if offset > 0 else "wb"
+    with open(partial_path, mode) as data_file:
+        data_file.seek(offset)
+        data_file.write(data)
+
+    if offset + len(data) >= total_size:
+        os.replace(partial_path, media_path)
+        link_cache_file(path, cache_path, media_path)
+    return str(cache_path)
+
+
+def get_media_directory() -> Path:
+    return Path(get_data_directory()) / "media"
+
+
+def get_cached_media_hashes() -> List[str]:
+    """
+    Return the content hashes of the files of the media cache.
+    """
+    media_directory = get_media_directory()
+    if not media_directory.is_dir():
+        return []
+    return [entry.name for entry in media_directory.iterdir() if entry.suffix == ""]
+
+
+def link_cache_file(path: Path, cache_path: Path, media_path: Path):
+    """
+    Make cache_path, the cache file of path, a link to media_path, or a copy where links are not supported.
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    try:
+        os.link(media_path, tmp_path)
+    except OSError:
+        shutil.copyfile(media_path, tmp_path)
+    os.replace(tmp_path, cache_path)
+
+    with open(cache_path.with_suffix(".metadata"), "w") as metadata_file:
+        metadata_file.write(str(path))
+
+
 def get_or_create_cache_file(str_path: str, data: bytes):
     path = Path(str_path)
     cache_path = get_cache_file_hash(path)
@@ -0,0 +1,106 @@
+import unittest
+
+import mixer.broadcaster.common as common
+from mixer.broadcaster.command_queue import CommandQueue
+from mixer.broadcaster.common import Command, MessageType
+
+
+def transform(path: str, value: bytes = b"") -> Command:
+    return Command(MessageType.TRANSFORM, common.encode_string(path) + value)
+
+
+def drain(queue: CommandQueue):
+    commands = []
+    while True:
+        command = queue.get()
+        if command is None:
+            return commands
+        commands.append(command)
+
+
+class TestCommandQueue(unittest.TestCase):
+    def test_order_and_size(self):
+        queue = CommandQueue(0, 0)
+        commands = [transform("/a"), transform("/a"), Command(MessageType.FRAME, common.encode_int(1))]
+        for command in commands:
+            queue.put(command)
+        self.assertEqual(queue.byte_size, sum(c.byte_size() for c in commands))
+        self.assertEqual(drain(queue), commands)
+        self.assertTrue(queue.empty())
+
+    def test_collapse_when_lagging(self):
+        queue = CommandQueue(soft_limit=1, hard_limit=0)
+        first = transform("/a", b"0")
+        queue.put(first)
+        self.assertTrue(queue.lagging)
+        other = transform("/b")
+        queue.put(other)
+        frame = Command(MessageType.FRAME, common.encode_int(1))
+        queue.put(frame)
+        last = transform("/a", b"1")
+        queue.put(last)
+        last_frame = Command(MessageType.FRAME, common.encode_int(2))
+        queue.put(last_frame)
+
+        self.assertEqual(queue.byte_size, sum(c.byte_size() for c in (other, last, last_frame)))
+        self.assertEqual(drain(queue), [other, last, last_frame])
+        self.assertFalse(queue.lagging)
+
+    def test_overflow(self):
+        command = transform("/a")
+        queue = CommandQueue(soft_limit=0, hard_limit=command.byte_size() * 2)
+        for _ in range(10):
+            queue.put(command, replay=True)
+        self.assertFalse(queue.overflowed)
+        queue.put(command)
+        queue.put(command)
+        self.assertFalse(queue.overflowed)
+        queue.put(command)
+        self.assertTrue(queue.overflowed)
+        self.assertTrue(queue.empty())
+        self.assertIsNone(queue.get())
+
+    def test_sequence(self):
+        queue = CommandQueue(0, 0)
+        command = transform("/a")
+        queue.put(command, sequence=1)
+        queue.put_sequence(2)
+        queue.put(Command(MessageType.FRAME, common.encode_int(1)))
+        self.assertEqual(queue.get(), command)
+        self.assertEqual(queue.sequence, 1)
+        self.assertIsNotNone(queue.get())
+        self.assertEqual(queue.sequence, 2)
+        self.assertIsNone(queue.get())
+        self.assertEqual(queue.sequence, 2)
+
+        # a sequence number alone is still to be returned
+        queue.put_sequence(3)
+        self.assertFalse(queue.empty())
+        self.assertIsNone(queue.get())
+        self.assertEqual(queue.sequence, 3)
+        self.assertTrue(queue.empty())
+
+    def test_interactive_lane(self):
+        queue = CommandQueue(0, 0)
+        mesh = Command(MessageType.MESH, b"mesh")
+        data = Command(MessageType.BLENDER_DATA_UPDATE, b"data")
+        first = transform("/a")
+        last = transform("/b")
+        queue.put(first, sequence=1)
+        queue.put(mesh, sequence=2)
+        queue.put(data, sequence=3)
+        queue.put(last, sequence=4)
+
+        self.assertEqual(queue.get(), first)
+        self.assertEqual(queue.get(), mesh)
+        # while the mesh is sent, the interactive commands overtake the other commands
+        self.assertEqual(queue.get(interactive_only=True), last)
+        self.assertIsNone(queue.get(interactive_only=True))
+        self.assertEqual(queue.sequence, 2)
+        self.assertEqual(queue.get(), data)
+        self.assertEqual(queue.sequence, 4)
+        self.assertTrue(queue.empty())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,279 @@
+import collections
+import os
+import socket
+import struct
+import threading
+import unittest
+
+import mixer.broadcaster.common as common
+from mixer.broadcaster.common import Command, MessageType
+from mixer.broadcaster.socket import Socket
+
+
+class TestFrameBuffers(unittest.TestCase):
+    def test_small(self):
+        command = Command(MessageType.BLENDER_DATA_UPDATE, b"data", coalescing_key="a|b")
+        buffers = command.frame_buffers()
+        self.assertEqual(len(buffers), 1)
+        self.assertEqual(buffers[0], command.to_byte_buffer())
+        self.assertIs(command.frame_buffers(), buffers)
+
+    def test_large(self):
+        data = bytes(common.FRAME_COPY_THRESHOLD)
+        command = Command(MessageType.BLENDER_DATA_UPDATE, data)
+        header, payload = command.frame_buffers()
+        self.assertEqual(len(header), common.HEADER_SIZE)
+        self.assertIs(payload.obj, data)
+        self.assertEqual(header + bytes(payload), command.to_byte_buffer())
+        self.assertEqual(command.byte_size(), len(command.to_byte_buffer()))
+
+    def test_data_change(self):
+        command = Command(MessageType.BLENDER_DATA_UPDATE, b"data")
+        command.frame_buffers()
+        command.data = b"other data"
+        self.assertEqual(command.frame_buffers()[0][common.HEADER_SIZE :], b"other data")
+        self.assertEqual(common.bytes_to_int(command.frame_header()[:8]), len(b"other data"))
+
+
+class TestCompression(unittest.TestCase):
+    def test_compressed_frame(self):
+        data = b'{"name": "Cube", "location": [0.0, 0.0, 0.0]}' * 20
+        command = Command(MessageType.BLENDER_DATA_UPDATE, data, coalescing_key="a|b")
+        command.compress()
+        self.assertTrue(command.compressed)
+        self.assertEqual(command.frame_buffers(), (command.to_byte_buffer(),))
+
+        frame = b"".join(bytes(b) for b in command.frame_buffers(compressed=True))
+        self.assertLess(len(frame), len(command.to_byte_buffer()))
+        self.assertEqual(command.byte_size(), len(frame))
+        command_id = common.bytes_to_int(frame[8:12])
+        message_type = common.bytes_to_int(frame[12:14])
+        self.assertTrue(message_type & common.COMPRESSED_FLAG)
+
+        received = common.make_command_from_frame(message_type, frame[common.HEADER_SIZE :], command_id)
+        self.assertTrue(received.compressed)
+        self.assertEqual(received.type, MessageType.BLENDER_DATA_UPDATE)
+        self.assertEqual(received.coalescing_key, "a|b")
+        self.assertEqual(received.frame_buffers(compressed=True)[0], frame)
+        self.assertEqual(received.data, data)
+
+    def test_small_data_not_compressed(self):
+        command = Command(MessageType.BLENDER_DATA_UPDATE, b"data")
+        command.compress()
+        self.assertFalse(command.compressed)
+        self.assertEqual(command.frame_buffers(compressed=True), command.frame_buffers())
+
+
+class TestBatch(unittest.TestCase):
+    def test_commands_buffers(self):
+        large = Command(MessageType.MESH, bytes(common.BATCH_COMMAND_MAX_SIZE))
+        commands = [
+            Command(MessageType.TRANSFORM, b"first"),
+            Command(MessageType.TRANSFORM, b"second", coalescing_key="a|b"),
+            large,
+            Command(MessageType.FRAME, b"alone"),
+        ]
+        data = b"".join(bytes(b) for b in common.commands_buffers(commands, batch=True))
+        self.assertEqual(common.bytes_to_int(data[12:14]), MessageType.BATCH.value)
+        batch_size = common.bytes_to_int(data[:8])
+        batch = common.decode_batch(data[common.HEADER_SIZE : common.HEADER_SIZE + batch_size])
+        self.assertEqual([c.data for c in batch], [b"first", b"second"])
+        self.assertEqual(batch[1].coalescing_key, "a|b")
+
+        # the large command and the last small command are not packed
+        rest = data[common.HEADER_SIZE + batch_size :]
+        self.assertEqual(rest, large.to_byte_buffer() + commands[3].to_byte_buffer())
+
+    def test_unpack(self):
+        left, right = socket.socketpair()
+        with left, right:
+            commands = [Command(MessageType.TRANSFORM, str(i).encode()) for i in range(10)]
+            common.write_buffers(Socket(left), common.commands_buffers(commands, batch=True))
+            received = common.read_all_messages(Socket(right), timeout=1.0)
+            self.assertEqual([c.data for c in received], [c.data for c in commands])
+
+
+class TestChunkAssembler(unittest.TestCase):
+    def test_pending(self):
+        command = Command(MessageType.TRANSFORM, os.urandom(3 * common.CHUNK_SIZE))
+        frame_chunks = common.FrameChunks(command.frame_buffers())
+        chunks = []
+        while not frame_chunks.done:
+            frame = b"".join(frame_chunks.next_chunk())
+            chunks.append(Command(MessageType.CHUNK, frame[common.HEADER_SIZE :]))
+
+        # the assembly started by an assembler is completed by another one
+        first = common.ChunkAssembler()
+        self.assertEqual(first.assemble(chunks[:2]), [])
+        pending = first.pending()
+        self.assertEqual(len(pending), 1)
+        second = common.ChunkAssembler()
+        self.assertEqual(second.assemble(pending), [])
+        assembled = second.assemble(chunks[2:])
+        self.assertEqual([c.data for c in assembled], [command.data])
+        self.assertEqual(second.pending(), [])
+
+
+class TestSendBuffers(unittest.TestCase):
+    def test_partial_send(self):
+        class PartialSocket:
+            def __init__(self):
+                self._socket = self
+                self.received = b""
+
+            def sendmsg(self, buffers):
+                data = b"".join(bytes(b) for b in buffers)[:5]
+                self.received += data
+                return len(data)
+
+        sock = PartialSocket()
+        buffers = collections.deque(memoryview(b) for b in (b"abc", b"defg", b"hi"))
+        self.assertEqual(common.send_buffers(sock, buffers), 5)
+        self.assertEqual([bytes(b) for b in buffers], [b"fg", b"hi"])
+        common.send_buffers(sock, buffers)
+        self.assertEqual(sock.received, b"abcdefghi")
+        self.assertFalse(buffers)
+
+    def test_write_commands(self):
+        left, right = socket.socketpair()
+        with left, right:
+            commands = [Command(MessageType.TRANSFORM, b"small"), Command(MessageType.MESH, bytes(100000))]
+            writer = Socket(left)
+            common.write_buffers(writer, [b for c in commands for b in c.frame_buffers()])
+            received = common.read_all_messages(Socket(right), timeout=1.0)
+            while len(received) < len(commands):
+                received.extend(common.read_all_messages(Socket(right), timeout=1.0))
+            self.assertEqual([c.data for c in received], [c.data for c in commands])
+
+
+class TestFrameReader(unittest.TestCase):
+    def test_large_frame(self):
+        left, right = socket.socketpair()
+        with left, right:
+            large = Command(MessageType.MESH, bytes(range(256)) * 1000, coalescing_key="a|b")
+            small = Command(MessageType.TRANSFORM, b"small")
+            reader = common.FrameReader(Socket(right))
+            writer = threading.Thread(
+                target=common.write_buffers, args=(Socket(left), [*small.frame_buffers(), *large.frame_buffers()])
+            )
+            writer.start()
+            received = []
+            while len(received) < 2:
+                received.extend(reader.read(timeout=1.0))
+            writer.join()
+            self.assertFalse(reader.pending)
+            self.assertEqual(received[0].data, b"small")
+            # the large frame is received in its own buffer, not copied
+            self.assertIsInstance(received[1].data, memoryview)
+            self.assertEqual(received[1].coalescing_key, "a|b")
+            self.assertEqual(received[1].data, large.data)
+
+    def test_partial_frames(self):
+        left, right = socket.socketpair()
+        with left, right:
+            commands = [Command(MessageType.TRANSFORM, str(i).encode() * 100) for i in range(10)]
+            data = b"".join(c.to_byte_buffer() for c in commands)
+            right.setblocking(False)
+            reader = common.FrameReader(Socket(right))
+            received = []
+            for offset in range(0, len(data), 7):
+                left.sendall(data[offset : offset + 7])
+                while True:
+                    try:
+                        received.extend(reader.receive())
+                    except BlockingIOError:
+                        break
+            self.assertEqual([c.data for c in received], [c.data for c in commands])
+
+    def test_disconnected(self):
+        left, right = socket.socketpair()
+        with right:
+            reader = common.FrameReader(Socket(right))
+            left.close()
+            with self.assertRaises(common.ClientDisconnectedException):
+                reader.read(timeout=1.0)
+
+
+class TestArrayDecoders(unittest.TestCase):
+    def test_typed_array(self):
+        values = [0.5, -1.0, 2.25]
+        data = b"prefix" + common.int_to_bytes(len(values), 4) + struct.pack("3f", *values) + common.encode_int(7)
+        decoded, index = common.decode_typed_array(data, 6, "f")
+        self.assertEqual(decoded.typecode, "f")
+        self.assertEqual(list(decoded), values)
+        self.assertEqual(common.decode_int(data, index), (7, len(data)))
+        self.assertEqual(common.decode_float_array(data, 6), (values, index))
+
+    def test_struct_array(self):
+        vectors = [(1.0, 2.0, 3.0), (4.0, 5.0, 6.0)]
+        data = common.int_to_bytes(len(vectors), 4) + b"".join(struct.pack("3f", *v) for v in vectors)
+        self.assertEqual(common.decode_vector3_array(data, 0), (vectors, len(data)))
+        self.assertEqual(common.decode_array(data, 0, "3f", 3 * 4), (vectors, len(data)))
+        self.assertEqual(common.decode_struct_items(data, 4 + 3 * 4, "3f", 1), (vectors[1:], len(data)))
+        self.assertEqual(common.decode_struct_array(common.encode_int(0), 0, "3f"), ([], 4))
+
+
+class TestBufferWriterReader(unittest.TestCase):
+    class Vector(tuple):
+        x = property(lambda self: self[0])
+        y = property(lambda self: self[1])
+        z = property(lambda self: self[2])
+        w = property(lambda self: self[3])
+
+    def test_compatible(self):
+        vector = self.Vector((1.0, 2.0, 3.0, 4.0))
+        large = os.urandom(common.FRAME_COPY_THRESHOLD)
+        expected = b"".join(
+            [
+                common.encode_int(-3),
+                common.encode_bool(True),
+                common.encode_float(0.5),
+                common.encode_uint64(2 ** 40),
+                common.encode_string("nom é"),
+                common.encode_json({"a": 1}),
+                common.encode_string_array(["a", "bc"]),
+                common.encode_vector2(vector),
+                common.encode_vector3(vector),
+                common.encode_color((0.1, 0.2, 0.3)),
+                common.encode_quaternion(vector),
+                large,
+                struct.pack("1I3f", 3, 1.0, 2.0, 3.0),
+            ]
+        )
+
+        writer = common.BufferWriter(size_hint=16)
+        writer.write_int(-3)
+        writer.write_bool(True)
+        writer.write_float(0.5)
+        writer.write_uint64(2 ** 40)
+        writer.write_string("nom é")
+        writer.write_json({"a": 1})
+        writer.write_string_array(["a", "bc"])
+        writer.write_vector2(vector)
+        writer.write_vector3(vector)
+        writer.write_color((0.1, 0.2, 0.3))
+        writer.write_quaternion(vector)
+        writer.write_bytes(large)
+        writer.write_struct("1I3f", 3, 1.0, 2.0, 3.0)
+        self.assertEqual(len(writer), len(expected))
+        self.assertEqual(writer.getvalue(), expected)
+
+        reader = common.BufferReader(expected)
+        self.assertEqual(reader.read_int(), -3)
+        self.assertEqual(reader.read_bool(), True)
+        self.assertEqual(reader.read_float(), 0.5)
+        self.assertEqual(reader.read_uint64(), 2 ** 40)
+        self.assertEqual(reader.read_string(), "nom é")
+        self.assertEqual(reader.read_json(), {"a": 1})
+        self.assertEqual(reader.read_string_array(), ["a", "bc"])
+        self.assertEqual(reader.read_vector2(), (1.0, 2.0))
+        self.assertEqual(reader.read_vector3(), (1.0, 2.0, 3.0))
+        self.assertEqual(reader.read_color(), common.decode_color(common.encode_color((0.1, 0.2, 0.3)), 0)[0])
+        self.assertEqual(reader.read_quaternion(), (4.0, 1.0, 2.0, 3.0))
+        self.assertEqual(reader.read_bytes(len(large)), large)
+        self.assertEqual(reader.read_struct_array("f"), [(1.0,), (2.0,), (3.0,)])
+        self.assertEqual(reader.remaining, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
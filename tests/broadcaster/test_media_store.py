@@ -0,0 +1,98 @@
+import os
+import tempfile
+import unittest
+
+import mixer.broadcaster.common as common
+from mixer.broadcaster.common import Command, MessageType
+from mixer.broadcaster.media_store import (
+    MEDIA_BLOCK_SIZE,
+    MediaStore,
+    content_hash,
+    decode_media_block,
+    encode_media_block,
+    is_media_reference,
+)
+
+
+def media_blocks(path: str, data: bytes):
+    hash_ = content_hash(data)
+    return [
+        Command(
+            MessageType.BLENDER_DATA_MEDIA,
+            encode_media_block(path, hash_, offset, len(data), data[offset : offset + MEDIA_BLOCK_SIZE]),
+            coalescing_key="uuid",
+        )
+        for offset in range(0, len(data), MEDIA_BLOCK_SIZE)
+    ]
+
+
+class TestMediaStore(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.store = MediaStore(self._dir.name)
+        self.store.start()
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def test_store(self):
+        data = os.urandom(2 * MEDIA_BLOCK_SIZE + 10)
+        first, second, last = media_blocks("/images/a.png", data)
+        self.assertIsNone(self.store.add_block(first, "c0"))
+        self.assertIsNone(self.store.add_block(second, "c0"))
+        reference = self.store.add_block(last, "c0")
+        self.assertTrue(is_media_reference(reference))
+        self.assertEqual(reference.coalescing_key, "uuid")
+        self.assertEqual(self.store.hashes(), [content_hash(data)])
+        self.assertEqual(decode_media_block(reference.data)[:4], ("/images/a.png", content_hash(data), 0, len(data)))
+
+        # the blocks are read back from the blob
+        blocks = self.store.blocks(reference)
+        received = b""
+        while not blocks.done:
+            frame = b"".join(bytes(buffer) for buffer in blocks.next_chunk())
+            message_type = common.bytes_to_int(frame[12 : common.HEADER_SIZE])
+            block = common.make_command_from_frame(message_type, frame[common.HEADER_SIZE :], 0)
+            self.assertEqual(block.coalescing_key, "uuid")
+            self.assertFalse(is_media_reference(block))
+            received += block.data[decode_media_block(block.data)[4] :]
+        self.assertEqual(received, data)
+
+    def test_shared(self):
+        data = os.urandom(100)
+        (block,) = media_blocks("/images/a.png", data)
+        self.store.add_block(block, "c0")
+
+        # another path with the same content, and a reference sent by a client that knows the store has it
+        (other,) = media_blocks("/images/b.png", data)
+        self.assertTrue(is_media_reference(self.store.add_block(other, "c0")))
+        reference = Command(
+            MessageType.BLENDER_DATA_MEDIA, encode_media_block("/c.png", content_hash(data), 0, 100, b"")
+        )
+        self.assertTrue(is_media_reference(self.store.add_block(reference, "c0")))
+        self.assertEqual(len(self.store.hashes()), 1)
+
+    def test_concurrent_uploads(self):
+        data = os.urandom(2 * MEDIA_BLOCK_SIZE + 10)
+        blocks = media_blocks("/images/a.png", data)
+
+        # a second upload of the same content starts in the middle of the first one
+        self.assertIsNone(self.store.add_block(blocks[0], "c0"))
+        self.assertIsNone(self.store.add_block(blocks[0], "c1"))
+        self.assertIsNone(self.store.add_block(blocks[1], "c0"))
+        self.assertIsNone(self.store.add_block(blocks[1], "c1"))
+        self.assertTrue(is_media_reference(self.store.add_block(blocks[2], "c0")))
+        self.assertTrue(is_media_reference(self.store.add_block(blocks[2], "c1")))
+        self.assertEqual(self.store.hashes(), [content_hash(data)])
+        self.assertEqual(os.listdir(self._dir.name), [content_hash(data)])
+
+    def test_hash_mismatch(self):
+        (block,) = media_blocks("/images/a.png", os.urandom(100))
+        block.data = encode_media_block("/images/a.png", content_hash(b"other"), 0, 100, os.urandom(100))
+        self.assertIsNone(self.store.add_block(block, "c0"))
+        self.assertEqual(self.store.hashes(), [])
+        self.assertEqual(os.listdir(self._dir.name), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,231 @@
+import unittest
+
+import mixer.broadcaster.common as common
+from mixer.broadcaster.common import Command, MessageType
+from mixer.broadcaster.room_history import RoomHistory, dead_lifecycle_sequences
+
+
+def update(uuid: str, field_group: str, value: str) -> Command:
+    key = common.make_coalescing_key(uuid, field_group)
+    return Command(MessageType.BLENDER_DATA_UPDATE, common.encode_string(value), coalescing_key=key)
+
+
+def values(history: RoomHistory):
+    return [common.decode_string(command.data, 0)[0] for _, command in history.commands_since(0)]
+
+
+class TestCoalescingKey(unittest.TestCase):
+    def test_round_trip(self):
+        command = update("uuid", "location", "value")
+        buffer = command.to_byte_buffer()
+        self.assertEqual(len(buffer), command.byte_size())
+
+        message_type = common.bytes_to_int(buffer[12 : common.HEADER_SIZE])
+        self.assertTrue(message_type & common.COALESCING_KEY_FLAG)
+        decoded = common.make_command_from_frame(message_type, buffer[common.HEADER_SIZE :], command.id)
+        self.assertEqual(decoded.type, MessageType.BLENDER_DATA_UPDATE)
+        self.assertEqual(decoded.coalescing_key, command.coalescing_key)
+        self.assertEqual(decoded.data, command.data)
+        self.assertEqual(common.coalescing_key_entity(decoded.coalescing_key), "uuid")
+
+    def test_no_key(self):
+        command = Command(MessageType.BLENDER_DATA_UPDATE, b"data")
+        buffer = command.to_byte_buffer()
+        message_type = common.bytes_to_int(buffer[12 : common.HEADER_SIZE])
+        self.assertEqual(message_type, MessageType.BLENDER_DATA_UPDATE.value)
+        decoded = common.make_command_from_frame(message_type, buffer[common.HEADER_SIZE :], command.id)
+        self.assertIsNone(decoded.coalescing_key)
+        self.assertEqual(decoded.data, b"data")
+
+
+class TestRoomHistory(unittest.TestCase):
+    def test_latest_wins(self):
+        history = RoomHistory()
+        history.append(update("a", "location", "a0"))
+        history.append(update("b", "location", "b0"))
+        history.append(update("a", "rotation", "a1"))
+        history.append(update("a", "location", "a2"))
+
+        self.assertEqual(values(history), ["b0", "a1", "a2"])
+        self.assertEqual(history.command_count(), 3)
+        self.assertEqual(history.next_sequence, 4)
+        self.assertEqual(history.byte_size, sum(c.byte_size() for _, c in history.commands_since(0)))
+
+    def test_legacy_transform(self):
+        history = RoomHistory()
+
+        def transform(path, value):
+            return Command(MessageType.TRANSFORM, common.encode_string(path) + common.encode_string(value))
+
+        history.append(transform("/a", "0"))
+        history.append(transform("/b", "1"))
+        history.append(transform("/a", "2"))
+        self.assertEqual([common.decode_string(c.data, 0)[0] for _, c in history.commands_since(0)], ["/b", "/a"])
+
+    def test_legacy_optimized_consecutive(self):
+        history = RoomHistory()
+
+        def mesh(path):
+            return Command(MessageType.MESH, common.encode_string(path))
+
+        history.append(mesh("/a"))
+        history.append(mesh("/a"))
+        history.append(mesh("/b"))
+        history.append(mesh("/a"))
+        self.assertEqual(history.command_count(), 3)
+
+    def test_commands_since(self):
+        history = RoomHistory()
+        history.append(update("a", "", "a0"))
+        sequence = history.append(update("b", "", "b0"))
+        history.append(update("c", "", "c0"))
+        history.append(update("b", "", "b1"))
+
+        self.assertEqual([s for s, _ in history.commands_since(sequence)], [2, 3])
+
+    def test_stored_frames(self):
+        history = RoomHistory()
+        commands = [
+            update("a", "location", "a0"),
+            Command(MessageType.TRANSFORM, common.encode_string("/a") + bytes(range(256)) * 1000),
+            Command(MessageType.BLENDER_DATA_REMOVE, b""),
+        ]
+        for command in commands:
+            history.append(command)
+
+        stored = [command for _, command in history.commands_since(0)]
+        self.assertEqual(
+            [(c.type, c.id, c.coalescing_key, c.data) for c in stored],
+            [(c.type, c.id, c.coalescing_key, c.data) for c in commands],
+        )
+        self.assertEqual([b"".join(c.frame_buffers()) for c in stored], [c.to_byte_buffer() for c in commands])
+
+    def test_stored_data_not_copied(self):
+        history = RoomHistory()
+        plain = update("a", "location", "a0")
+        compressed = Command(MessageType.TRANSFORM, common.encode_string("/a") + bytes(1000))
+        compressed.compress()
+        self.assertTrue(compressed.compressed)
+        history.append(plain)
+        history.append(compressed)
+
+        (_, stored_plain), (_, stored_compressed) = history.commands_since(0)
+        arena = history._storage.arena
+        self.assertIs(stored_plain.data.obj, arena)
+        self.assertIs(stored_compressed._compressed.obj, arena)
+        self.assertEqual(stored_compressed.data, compressed.data)
+
+    def test_compaction(self):
+        history = RoomHistory()
+        for i in range(5000):
+            history.append(update("a", "location", str(i)))
+        iterator = history.commands_since(0)
+        history.append(update("b", "location", "b"))
+
+        self.assertEqual(values(history), ["4999", "b"])
+        self.assertLess(len(history._storage.types), 2000)
+        # an iteration started before the compaction may yield superseded commands but still reaches the end
+        self.assertEqual(common.decode_string(list(iterator)[-1][1].data, 0)[0], "b")
+
+
+class TestLifecycle(unittest.TestCase):
+    def setUp(self):
+        self.history = RoomHistory()
+
+    def append(self, message_type: MessageType, data: bytes, coalescing_key=None) -> int:
+        return self.history.append(Command(message_type, data, coalescing_key=coalescing_key))
+
+    def remaining(self):
+        self.history.remove_many(dead_lifecycle_sequences(self.history.commands_since(0)))
+        return [sequence for sequence, _ in self.history.commands_since(0)]
+
+    def test_blender_data_removed(self):
+        media = self.append(MessageType.BLENDER_DATA_MEDIA, b"media", "a")
+        self.append(MessageType.BLENDER_DATA_CREATE, b"create", "a")
+        other = self.append(MessageType.BLENDER_DATA_CREATE, b"create", "b")
+        self.append(MessageType.BLENDER_DATA_UPDATE, b"update", "a|location")
+        self.append(MessageType.BLENDER_DATA_UPDATE, b"update", "a")
+        self.append(MessageType.BLENDER_DATA_RENAME, common.encode_string_array(["a", "old", "new"]))
+        renames = self.append(
+            MessageType.BLENDER_DATA_RENAME, common.encode_string_array(["a", "x", "y", "b", "z", "t"])
+        )
+        self.append(MessageType.BLENDER_DATA_REMOVE, common.encode_string("a") + common.encode_string("debug"))
+
+        remaining = self.remaining()
+        self.assertEqual(remaining, [other, renames])
+        self.assertNotIn(media, remaining)
+        self.assertEqual(self.history.byte_size, sum(c.byte_size() for _, c in self.history.commands_since(0)))
+
+    def test_blender_data_recreated(self):
+        self.append(MessageType.BLENDER_DATA_CREATE, b"create", "a")
+        self.append(MessageType.BLENDER_DATA_REMOVE, common.encode_string("a") + common.encode_string("debug"))
+        create = self.append(MessageType.BLENDER_DATA_CREATE, b"create", "a")
+        update = self.append(MessageType.BLENDER_DATA_UPDATE, b"update", "a")
+        self.assertEqual(self.remaining(), [create, update])
+
+    def test_blender_data_created_elsewhere(self):
+        self.append(MessageType.BLENDER_DATA_UPDATE, b"update", "a")
+        remove = self.append(MessageType.BLENDER_DATA_REMOVE, common.encode_string("a") + common.encode_string("d"))
+        self.assertEqual(self.remaining(), [remove])
+
+    def test_vrtist_deleted(self):
+        def transform(path):
+            return common.encode_string(path) + b"matrix"
+
+        create = self.append(MessageType.ADD_OBJECT_TO_SCENE, common.encode_string("scene") + common.encode_string("a"))
+        self.append(MessageType.TRANSFORM, transform("/parent/a"))
+        self.append(MessageType.OBJECT_VISIBILITY, common.encode_string("a") + b"flags")
+        kept = self.append(MessageType.TRANSFORM, transform("/parent/b"))
+        rename = self.append(MessageType.RENAME, common.encode_string("/parent/a") + common.encode_string("/parent/c"))
+        self.append(MessageType.TRANSFORM, transform("/parent/c"))
+        self.append(MessageType.SEND_TO_TRASH, common.encode_string("/parent/c"))
+        delete = self.append(MessageType.DELETE, common.encode_string("/parent/c"))
+        trashed = self.append(MessageType.SEND_TO_TRASH, common.encode_string("/parent/b"))
+
+        self.assertEqual(self.remaining(), [create, kept, rename, delete, trashed])
+
+
+class TestStateOrder(unittest.TestCase):
+    def test_grouped_by_datablock(self):
+        history = RoomHistory()
+        commands = [
+            Command(MessageType.BLENDER_DATA_CREATE, b"0", coalescing_key="a"),
+            Command(MessageType.BLENDER_DATA_CREATE, b"1", coalescing_key="b"),
+            Command(MessageType.FRAME_START_END, b"2"),
+            Command(MessageType.BLENDER_DATA_UPDATE, b"3", coalescing_key="a|location"),
+            Command(MessageType.BLENDER_DATA_REMOVE, common.encode_string("b") + common.encode_string("debug")),
+            Command(MessageType.BLENDER_DATA_CREATE, b"5", coalescing_key="b"),
+            Command(MessageType.BLENDER_DATA_UPDATE, b"6", coalescing_key="b"),
+            Command(MessageType.BLENDER_DATA_UPDATE, b"7", coalescing_key="a"),
+        ]
+        for command in commands:
+            history.append(command)
+
+        ordered = [command for _, command in history.commands_at(history.state_sequences())]
+        self.assertEqual([c.data for c in ordered], [commands[i].data for i in [0, 3, 7, 1, 2, 4, 5, 6]])
+
+    def test_maintained_with_history(self):
+        history = RoomHistory()
+        remove_b = Command(MessageType.BLENDER_DATA_REMOVE, common.encode_string("b") + common.encode_string("debug"))
+        commands = [
+            Command(MessageType.BLENDER_DATA_CREATE, b"0", coalescing_key="a"),
+            Command(MessageType.BLENDER_DATA_CREATE, b"1", coalescing_key="b"),
+            Command(MessageType.BLENDER_DATA_UPDATE, b"2", coalescing_key="a|location"),
+            Command(MessageType.BLENDER_DATA_UPDATE, b"3", coalescing_key="b|location"),
+            Command(MessageType.BLENDER_DATA_UPDATE, b"4", coalescing_key="a|location"),
+            remove_b,
+        ]
+        for command in commands:
+            history.append(command)
+        self.assertEqual(history.state_sequences(), [0, 4, 1, 3, 5])
+
+        # the lifecycle of b is dropped with its group
+        history.remove_many(dead_lifecycle_sequences(history.commands_since(0)))
+        self.assertEqual(history.state_sequences(), [0, 4])
+        history.append(Command(MessageType.BLENDER_DATA_CREATE, b"6", coalescing_key="b"))
+        history.remove(0)
+        self.assertEqual(history.state_sequences(), [4, 6])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import os
+import tempfile
+import unittest
+
+import mixer.broadcaster.common as common
+from mixer.broadcaster.common import Command, MessageType, RoomAttributes
+from mixer.broadcaster.room_log import RoomLog, RoomLogWriter, read_log, recover_rooms
+
+
+class TestRoomLog(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.log_dir = self._dir.name
+
+    def tearDown(self):
+        self._dir.cleanup()
+
+    def write_room(self, name: str, commands, attributes) -> RoomLog:
+        writer = RoomLogWriter(self.log_dir)
+        writer.start()
+        log = RoomLog(writer, name, lambda: (len(commands), commands), lambda: 0)
+        for sequence, command in enumerate(commands):
+            log.append(sequence, command)
+        log.write_attributes({RoomAttributes.NAME: name, **attributes})
+        writer.stop()
+        return log
+
+    def test_recover(self):
+        commands = [
+            Command(MessageType.BLENDER_DATA_CREATE, b"create", coalescing_key="uuid"),
+            Command(MessageType.TRANSFORM, common.encode_string("/a") + bytes(100000)),
+        ]
+        log = self.write_room("a/room", commands, {RoomAttributes.KEEP_OPEN: True, RoomAttributes.JOINABLE: True})
+        self.assertEqual(log.durable, (2, sum(c.byte_size() for c in commands)))
+        self.write_room("closed", commands, {RoomAttributes.KEEP_OPEN: False, RoomAttributes.JOINABLE: True})
+
+        rooms = recover_rooms(self.log_dir)
+        self.assertEqual(len(rooms), 1)
+        attributes, recovered = rooms[0]
+        self.assertEqual(attributes[RoomAttributes.NAME], "a/room")
+        self.assertEqual(
+            [(c.type, c.coalescing_key, c.data) for c in recovered],
+            [(c.type, c.coalescing_key, c.data) for c in commands],
+        )
+        self.assertEqual(len(os.listdir(self.log_dir)), 2)
+
+    def test_truncated(self):
+        commands = [Command(MessageType.TRANSFORM, b"0"), Command(MessageType.TRANSFORM, b"1")]
+        log = self.write_room("room", commands, {})
+        size = os.path.getsize(log.path)
+        with open(log.path, "ab") as f:
+            f.write(Command(MessageType.TRANSFORM, b"2").to_byte_buffer()[:-1])
+
+        self.assertEqual([c.data for c in read_log(log.path)], [b"0", b"1"])
+        self.assertEqual(os.path.getsize(log.path), size)
+
+
+if __name__ == "__main__":
+    unittest.main()
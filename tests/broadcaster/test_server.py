@@ -1,10 +1,16 @@
+import os
+import socket
+import tempfile
 import unittest
 import threading
 import time
+from typing import Callable, List, Optional
 
 from mixer.broadcaster.apps.server import Server
 from mixer.broadcaster.client import Client
 import mixer.broadcaster.common as common
+from mixer.broadcaster import server_workers
+from mixer.broadcaster.media_store import MEDIA_BLOCK_SIZE, content_hash, encode_media_block, is_media_reference
 
 from tests.process import ServerProcess
 
@@ -179,6 +185,521 @@ class TestServer(unittest.TestCase):
         self.assertListEqual(d0.name_room, d1.name_room)
 
 
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("", 0))
+        return sock.getsockname()[1]
+
+
+def receive_until(
+    client: Client, predicate: Callable[[List[common.Command]], bool], timeout: float = 5.0
+) -> List[common.Command]:
+    """Accumulate the commands received by client until predicate is satisfied"""
+    received: List[common.Command] = []
+    start = time.monotonic()
+    while not predicate(received):
+        if time.monotonic() - start > timeout:
+            raise TimeoutError(f"Condition not satisfied after {timeout} seconds, received {received}")
+        received.extend(client.fetch_commands())
+    return received
+
+
+def has_type(message_type: common.MessageType) -> Callable[[List[common.Command]], bool]:
+    return lambda commands: any(c.type == message_type for c in commands)
+
+
+class ServerTestCase(unittest.TestCase):
+    """Runs a Server in a thread of the test process"""
+
+    room_command_type = common.MessageType.BLENDER_DATA_REMOVE
+    use_event_loop = False
+    workers = 0
+
+    def setUp(self):
+        self._clients: List[Client] = []
+        self.start_server()
+
+    def start_server(self, room_log_dir: Optional[str] = None, media_dir: Optional[str] = None):
+        self._server = Server()
+        self._server.use_event_loop = self.use_event_loop
+        self._server.workers = self.workers
+        self._server.room_log_dir = room_log_dir
+        self._server.media_dir = media_dir
+        self._port = free_port()
+        self._server_thread = threading.Thread(None, self._server.run, args=(self._port,))
+        self._server_thread.start()
+
+    def tearDown(self):
+        for client in self._clients:
+            if client.is_connected():
+                client.disconnect()
+        self._server.shutdown()
+        self._server_thread.join(timeout=5.0)
+
+    def restart_server(self, room_log_dir: Optional[str] = None, media_dir: Optional[str] = None):
+        """Replace the server by a new one, that restores the rooms logged in room_log_dir"""
+        self._server.shutdown()
+        self._server_thread.join(timeout=5.0)
+        self.start_server(room_log_dir, media_dir)
+
+    def make_temp_dir(self) -> str:
+        """Return a directory that is removed once tearDown has shut the server down"""
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        return temp_dir.name
+
+    def make_client(self, background_io: bool = False) -> Client:
+        client = Client("127.0.0.1", self._port, background_io)
+        start = time.monotonic()
+        while not client.is_connected() and time.monotonic() - start < 5.0:
+            time.sleep(0.05)
+            client.connect()
+        self.assertTrue(client.is_connected())
+        self._clients.append(client)
+        return client
+
+    def create_room(self, client: Client, room_name: str):
+        client.join_room(room_name, "blender", "mixer", False, True)
+        receive_until(client, has_type(common.MessageType.CONTENT))
+        client.send_command(common.Command(common.MessageType.CONTENT))
+
+
+class TestThreadedServer(ServerTestCase):
+    def test_broadcast_and_join(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c0.send_command(common.Command(self.room_command_type, common.encode_string("first")))
+
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        types = [c.type for c in received]
+        self.assertIn(common.MessageType.CLEAR_CONTENT, types)
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual(len(room_commands), 1)
+        self.assertEqual(common.decode_string(room_commands[0].data, 0)[0], "first")
+        self.assertLess(types.index(common.MessageType.CLEAR_CONTENT), types.index(self.room_command_type))
+        self.assertLess(types.index(self.room_command_type), types.index(common.MessageType.JOIN_ROOM))
+
+        c0.send_command(common.Command(self.room_command_type, common.encode_string("second")))
+        received = receive_until(c1, has_type(self.room_command_type))
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual(common.decode_string(room_commands[0].data, 0)[0], "second")
+
+    def test_join_while_broadcasting(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        for i in range(500):
+            c0.send_command(common.Command(self.room_command_type, common.encode_int(i)))
+
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        for i in range(500, 600):
+            c0.send_command(common.Command(self.room_command_type, common.encode_int(i)))
+
+        # the commands broadcast while the history is replayed follow it in order
+        def all_received(commands: List[common.Command]) -> bool:
+            count = len([c for c in commands if c.type == self.room_command_type])
+            return count == 600 and has_type(common.MessageType.JOIN_ROOM)(commands)
+
+        received = receive_until(c1, all_received)
+        self.assertEqual(
+            [common.decode_int(c.data, 0)[0] for c in received if c.type == self.room_command_type], list(range(600))
+        )
+
+        # the room members are told about the client once it joined
+        def in_room(_):
+            attributes = c0.clients_attributes.values()
+            return len([a for a in attributes if a.get(common.ClientAttributes.ROOM) == "room"]) == 2
+
+        receive_until(c0, in_room)
+
+    def test_join_state(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c0.send_command(common.Command(common.MessageType.BLENDER_DATA_CREATE, b"a", coalescing_key="a"))
+        c0.send_command(common.Command(common.MessageType.BLENDER_DATA_CREATE, b"b", coalescing_key="b"))
+        c0.send_command(common.Command(common.MessageType.BLENDER_DATA_UPDATE, b"a1", coalescing_key="a|x"))
+        receive_until(c0, lambda _: c0.rooms_attributes.get("room", {}).get(common.RoomAttributes.COMMAND_COUNT) == 3)
+
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True, common.JoinMode.STATE)
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        self.assertEqual([c.data for c in received if c.coalescing_key is not None], [b"a", b"a1", b"b"])
+
+        c2 = self.make_client()
+        c2.join_room("room", "blender", "mixer", False, True, common.JoinMode.HISTORY)
+        received = receive_until(c2, has_type(common.MessageType.JOIN_ROOM))
+        self.assertEqual([c.data for c in received if c.coalescing_key is not None], [b"a", b"b", b"a1"])
+
+    def test_compact_history(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        remove = common.encode_string("uuid") + common.encode_string("debug")
+        c0.send_command(common.Command(common.MessageType.BLENDER_DATA_CREATE, b"create", coalescing_key="uuid"))
+        c0.send_command(common.Command(common.MessageType.BLENDER_DATA_REMOVE, remove))
+        receive_until(c0, lambda _: c0.rooms_attributes.get("room", {}).get(common.RoomAttributes.COMMAND_COUNT) == 2)
+
+        room = self._server._rooms["room"]
+        room.compact_history()
+        self.assertEqual(room.command_count(), 0)
+        self.assertEqual(room.byte_size, 0)
+
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        self.assertNotIn(common.MessageType.BLENDER_DATA_CREATE, [c.type for c in received])
+
+    def test_restore_room(self):
+        log_dir = self.make_temp_dir()
+        self.restart_server(log_dir)
+
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c0.set_room_keep_open("room", True)
+        c0.send_command(common.Command(self.room_command_type, common.encode_string("first")))
+        receive_until(c0, lambda _: c0.rooms_attributes.get("room", {}).get(common.RoomAttributes.COMMAND_COUNT) == 1)
+        c0.disconnect()
+
+        self.restart_server(log_dir)
+
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual([common.decode_string(c.data, 0)[0] for c in room_commands], ["first"])
+
+    def test_join_from_log(self):
+        log_dir = self.make_temp_dir()
+        self.restart_server(log_dir)
+
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c0.send_command(common.Command(common.MessageType.BLENDER_DATA_UPDATE, b"a0", coalescing_key="a|x"))
+        c0.send_command(common.Command(common.MessageType.BLENDER_DATA_UPDATE, b"b0", coalescing_key="b|x"))
+        receive_until(c0, lambda _: c0.rooms_attributes.get("room", {}).get(common.RoomAttributes.COMMAND_COUNT) == 2)
+        room = self._server._rooms["room"]
+        start = time.monotonic()
+        while room.log.durable[0] < 2 and time.monotonic() - start < 5.0:
+            time.sleep(0.01)
+
+        # not durable yet, or durable after the join started
+        c0.send_command(common.Command(common.MessageType.BLENDER_DATA_UPDATE, b"a1", coalescing_key="a|x"))
+        receive_until(c0, lambda _: c0.rooms_attributes.get("room", {}).get(common.RoomAttributes.COMMAND_COUNT) == 2)
+
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        data = [c.data for c in received if c.type == common.MessageType.BLENDER_DATA_UPDATE]
+        # the log may contain the superseded command, but the latest one always comes last
+        self.assertIn(data, ([b"b0", b"a1"], [b"a0", b"b0", b"a1"]))
+
+    def test_join_from_history_when_log_is_larger(self):
+        log_dir = self.make_temp_dir()
+        self.restart_server(log_dir)
+
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        for i in range(10):
+            c0.send_command(common.Command(common.MessageType.BLENDER_DATA_UPDATE, b"a%d" % i, coalescing_key="a|x"))
+        receive_until(c0, lambda _: c0.rooms_attributes.get("room", {}).get(common.RoomAttributes.COMMAND_COUNT) == 1)
+        room = self._server._rooms["room"]
+        start = time.monotonic()
+        while room.log.durable[0] < 10 and time.monotonic() - start < 5.0:
+            time.sleep(0.01)
+        self.assertEqual(room.log.durable[0], 10)
+
+        # the log holds the 9 superseded commands, so the history is sent instead
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        data = [c.data for c in received if c.type == common.MessageType.BLENDER_DATA_UPDATE]
+        self.assertEqual(data, [b"a9"])
+
+    def test_large_command(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+
+        payload = bytes(range(256)) * 40000
+        c0.send_command(common.Command(self.room_command_type, payload))
+        received = receive_until(c1, has_type(self.room_command_type))
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual(room_commands[0].data, payload)
+
+    def test_batched_room_updates(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c1 = self.make_client()
+        for i in range(20):
+            c0.send_command(common.Command(self.room_command_type, common.encode_string(str(i))))
+
+        received = receive_until(
+            c1, lambda _: c1.rooms_attributes.get("room", {}).get(common.RoomAttributes.COMMAND_COUNT) == 20
+        )
+        room_updates = [c for c in received if c.type == common.MessageType.ROOM_UPDATE]
+        self.assertLess(len(room_updates), 20)
+
+    def test_room_scoped_client_attributes(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c1 = self.make_client()
+        c2 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        receive_until(c0, lambda _: c0.client_id is not None)
+
+        scenes = {"Scene": {common.ClientAttributes.USERSCENES_FRAME: 42}}
+        c0.set_client_attributes({common.ClientAttributes.USERSCENES: scenes})
+        c0.set_client_attributes({common.ClientAttributes.USERNAME: "c0"})
+
+        receive_until(c1, lambda _: common.ClientAttributes.USERSCENES in c1.clients_attributes.get(c0.client_id, {}))
+        receive_until(c2, lambda _: common.ClientAttributes.USERNAME in c2.clients_attributes.get(c0.client_id, {}))
+        self.assertNotIn(common.ClientAttributes.USERSCENES, c2.clients_attributes[c0.client_id])
+
+        # a joining client receives the room scoped attributes of the clients of the room
+        c2.join_room("room", "blender", "mixer", False, True)
+        receive_until(c2, lambda _: common.ClientAttributes.USERSCENES in c2.clients_attributes[c0.client_id])
+        self.assertEqual(c2.clients_attributes[c0.client_id][common.ClientAttributes.USERSCENES], scenes)
+
+    def test_resume(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True, resumable=True)
+        receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        c0.send_command(common.Command(self.room_command_type, common.encode_string("first")))
+        receive_until(c1, lambda _: c1.room_sequence == 1)
+        c1.send_command(common.Command(self.room_command_type, common.encode_string("own")))
+        receive_until(c1, lambda _: c1.room_sequence == 2)
+
+        c1.disconnect()
+        c0.send_command(common.Command(self.room_command_type, common.encode_string("missed")))
+        receive_until(c0, lambda _: c0.rooms_attributes.get("room", {}).get(common.RoomAttributes.COMMAND_COUNT) == 3)
+
+        c1.connect()
+        c1.resume_room()
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        types = [c.type for c in received]
+        self.assertIn(common.MessageType.RESUME, types)
+        self.assertNotIn(common.MessageType.CLEAR_CONTENT, types)
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual([common.decode_string(c.data, 0)[0] for c in room_commands], ["missed"])
+        self.assertEqual(c1.room_sequence, 3)
+
+    def test_compression(self):
+        c0 = self.make_client()
+        receive_until(c0, lambda _: c0.compression)
+        self.create_room(c0, "room")
+        c1 = self.make_client()
+        # a client that does not accept compressed frames
+        c1.send_command(common.Command(common.MessageType.CAPABILITIES, common.encode_string_array([])))
+        receive_until(c1, lambda _: not c1.compression)
+        c1.join_room("room", "blender", "mixer", False, True)
+        receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+
+        data = common.encode_string("compressible " * 100)
+        c0.send_command(common.Command(self.room_command_type, data))
+        received = receive_until(c1, has_type(self.room_command_type))
+        command = next(c for c in received if c.type == self.room_command_type)
+        self.assertFalse(command.compressed)
+        self.assertEqual(command.data, data)
+
+        c2 = self.make_client()
+        receive_until(c2, lambda _: c2.compression)
+        c2.join_room("room", "blender", "mixer", False, True)
+        received = receive_until(c2, has_type(common.MessageType.JOIN_ROOM))
+        command = next(c for c in received if c.type == self.room_command_type)
+        self.assertTrue(command.compressed)
+        self.assertEqual(command.data, data)
+
+    def test_batch(self):
+        c0 = self.make_client()
+        receive_until(c0, lambda _: c0.batch)
+        self.create_room(c0, "room")
+        for i in range(20):
+            c0.add_command(common.Command(self.room_command_type, common.encode_string(f"command {i}")))
+        c0.fetch_outgoing_commands()
+        receive_until(c0, lambda _: c0.rooms_attributes.get("room", {}).get(common.RoomAttributes.COMMAND_COUNT) == 20)
+
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual(
+            [common.decode_string(c.data, 0)[0] for c in room_commands], [f"command {i}" for i in range(20)]
+        )
+
+    def test_chunks(self):
+        c0 = self.make_client()
+        receive_until(c0, lambda _: c0.chunks)
+        c0.bulk_byte_budget = common.CHUNK_SIZE
+        self.create_room(c0, "room")
+        c1 = self.make_client()
+        receive_until(c1, lambda _: c1.chunks)
+        c1.join_room("room", "blender", "mixer", False, True)
+        receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+
+        large = common.Command(
+            self.room_command_type, common.encode_string("large") + os.urandom(3 * common.CHUNK_SIZE)
+        )
+        interactive = common.Command(common.MessageType.TRANSFORM, common.encode_string("/a"))
+        after = common.Command(self.room_command_type, common.encode_string("after"))
+        for command in (large, interactive, after):
+            c0.add_command(command)
+        c0.fetch_outgoing_commands()
+        self.assertEqual(c0.pending_commands, [after])
+
+        received: List[common.Command] = []
+        while len([c for c in received if c.type == self.room_command_type]) < 2:
+            c0.fetch_outgoing_commands()
+            received.extend(c1.fetch_commands())
+        types = [c.type for c in received if c.type.value > common.MessageType.COMMAND.value]
+        self.assertEqual(types, [common.MessageType.TRANSFORM, self.room_command_type, self.room_command_type])
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual(room_commands[0].data, large.data)
+        self.assertEqual(room_commands[1].data, after.data)
+
+    def test_command_stream(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+
+        produced = []
+
+        def blocks():
+            for i in range(4):
+                produced.append(i)
+                yield common.Command(self.room_command_type, common.encode_string(f"block {i}") + os.urandom(1000))
+
+        c0.bulk_byte_budget = 2000
+        c0.add_command_stream(blocks())
+        c0.add_command(common.Command(self.room_command_type, common.encode_string("after")))
+        c0.add_command(common.Command(common.MessageType.TRANSFORM, common.encode_string("/a")))
+        c0.fetch_outgoing_commands()
+        # the stream is produced as it is sent
+        self.assertEqual(produced, [0, 1])
+
+        received: List[common.Command] = []
+        while len([c for c in received if c.type.value > common.MessageType.COMMAND.value]) < 6:
+            c0.fetch_outgoing_commands()
+            received.extend(c1.fetch_commands())
+        names = [
+            common.decode_string(c.data, 0)[0] for c in received if c.type.value > common.MessageType.COMMAND.value
+        ]
+        self.assertEqual(names, ["/a", "block 0", "block 1", "block 2", "block 3", "after"])
+
+    def test_media_store(self):
+        media_dir = self.make_temp_dir()
+        self.restart_server(media_dir=media_dir)
+
+        data = os.urandom(3 * MEDIA_BLOCK_SIZE)
+        hash_ = content_hash(data)
+        blocks = [
+            encode_media_block("/a.png", hash_, offset, len(data), data[offset : offset + MEDIA_BLOCK_SIZE])
+            for offset in range(0, len(data), MEDIA_BLOCK_SIZE)
+        ]
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        for block in blocks:
+            c0.add_command(common.Command(common.MessageType.BLENDER_DATA_MEDIA, block, 0, "uuid"))
+        c0.fetch_outgoing_commands()
+        receive_until(c0, lambda _: hash_ in c0.server_media_hashes)
+        # the room keeps a reference to the stored media
+        receive_until(c0, lambda _: c0.rooms_attributes["room"].get(common.RoomAttributes.COMMAND_COUNT) == 1)
+        self.assertLess(c0.rooms_attributes["room"][common.RoomAttributes.BYTE_SIZE], MEDIA_BLOCK_SIZE)
+
+        def join(client: Client) -> List[common.Command]:
+            client.join_room("room", "blender", "mixer", False, True)
+            received = receive_until(client, has_type(common.MessageType.JOIN_ROOM))
+            return [c for c in received if c.type == common.MessageType.BLENDER_DATA_MEDIA]
+
+        # the blocks are sent to a client that does not have the media
+        self.assertEqual([c.data for c in join(self.make_client())], blocks)
+
+        # a reference is sent to a client that has the media in its cache
+        c2 = self.make_client()
+        c2.send_media_hashes([hash_])
+        media = join(c2)
+        self.assertEqual(len(media), 1)
+        self.assertTrue(is_media_reference(media[0]))
+
+    def test_resume_refused(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c0.send_command(common.Command(self.room_command_type, common.encode_string("first")))
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True, resumable=True)
+        receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+
+        c1.disconnect()
+        c1.room_token = "another room"
+        c1.connect()
+        c1.resume_room()
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        types = [c.type for c in received]
+        # joined again
+        self.assertLess(types.index(common.MessageType.RESUME), types.index(common.MessageType.CLEAR_CONTENT))
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual([common.decode_string(c.data, 0)[0] for c in room_commands], ["first"])
+
+    def test_disconnect(self):
+        c0 = self.make_client()
+        c1 = self.make_client()
+        self.create_room(c0, "room")
+        receive_until(c1, lambda _: "room" in c1.rooms_attributes)
+
+        c0.disconnect()
+        receive_until(c1, lambda _: "room" not in c1.rooms_attributes)
+
+    def test_background_io(self):
+        c0 = self.make_client(background_io=True)
+        self.create_room(c0, "room")
+        c1 = self.make_client(background_io=True)
+        c1.join_room("room", "blender", "mixer", False, True)
+        receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+
+        large = common.Command(
+            self.room_command_type, common.encode_string("large") + os.urandom(3 * common.CHUNK_SIZE)
+        )
+        c0.add_command(large)
+        c0.add_command(common.Command(self.room_command_type, common.encode_string("after")))
+        received = receive_until(c1, lambda r: len([c for c in r if c.type == self.room_command_type]) == 2)
+        self.assertEqual([c.data for c in received if c.type == self.room_command_type][0], large.data)
+
+        self._server.shutdown()
+        with self.assertRaises(common.ClientDisconnectedException):
+            receive_until(c1, lambda _: False)
+        self.assertFalse(c1.is_connected())
+
+    def test_background_io_resume(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c1 = self.make_client(background_io=True)
+        c1.join_room("room", "blender", "mixer", False, True, resumable=True)
+        receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+
+        # the commands added while disconnected are sent after RESUME, like without background_io
+        c1.disconnect()
+        c1.add_command(common.Command(self.room_command_type, common.encode_string("offline")))
+        c1.connect()
+        c1.resume_room()
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        self.assertIn(common.MessageType.RESUME, [c.type for c in received])
+
+        received = receive_until(c0, has_type(self.room_command_type))
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual(common.decode_string(room_commands[0].data, 0)[0], "offline")
+
+
+class TestEventLoopServer(TestThreadedServer):
+    use_event_loop = True
+
+
 class TestClient(unittest.TestCase):
     def setUp(self):
         pass
@@ -201,5 +722,92 @@ class TestClient(unittest.TestCase):
             self.assertTrue(not client.is_connected())
 
 
+@unittest.skipUnless(server_workers.is_supported(), "requires Unix sockets")
+class TestWorkersServer(ServerTestCase):
+    workers = 2
+
+    def test_rooms_on_workers(self):
+        names = ["room0", "room1", "room2", "room3"]
+        first = names[0]
+        second = next(
+            name for name in names if server_workers.room_worker(name, 2) != server_workers.room_worker(first, 2)
+        )
+
+        c0 = self.make_client()
+        self.create_room(c0, first)
+        c0.send_command(common.Command(self.room_command_type, common.encode_string("first")))
+        c1 = self.make_client()
+        self.create_room(c1, second)
+
+        lobby = self.make_client()
+        lobby.send_list_rooms()
+        receive_until(lobby, lambda _: {first, second} <= set(lobby.rooms_attributes))
+        receive_until(lobby, lambda _: len(lobby.clients_attributes) == 3)
+
+        c2 = self.make_client()
+        c2.join_room(first, "blender", "mixer", False, True)
+        received = receive_until(c2, has_type(common.MessageType.JOIN_ROOM))
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual([common.decode_string(c.data, 0)[0] for c in room_commands], ["first"])
+
+        c0.send_command(common.Command(self.room_command_type, common.encode_string("second")))
+        received = receive_until(c2, has_type(self.room_command_type))
+        self.assertEqual(common.decode_string(received[-1].data, 0)[0], "second")
+        receive_until(lobby, lambda _: lobby.rooms_attributes[first].get(common.RoomAttributes.JOINABLE))
+
+
+class TestRelayServer(ServerTestCase):
+    def setUp(self):
+        super().setUp()
+        self._main_server = self._server
+        self._main_port = self._port
+        self._main_thread = self._server_thread
+        self._server = Server()
+        self._server.upstream = ("127.0.0.1", self._main_port)
+        self._port = free_port()
+        self._server_thread = threading.Thread(None, self._server.run, args=(self._port,))
+        self._server_thread.start()
+
+    def tearDown(self):
+        super().tearDown()
+        self._main_server.shutdown()
+        self._main_thread.join(timeout=5.0)
+
+    def make_main_client(self) -> Client:
+        client = Client("127.0.0.1", self._main_port)
+        client.connect()
+        self._clients.append(client)
+        return client
+
+    def test_relay(self):
+        c0 = self.make_client()
+        self.create_room(c0, "room")
+        c0.send_command(common.Command(self.room_command_type, common.encode_string("relayed")))
+
+        main_client = self.make_main_client()
+        receive_until(main_client, lambda _: main_client.rooms_attributes.get("room", {}).get("joinable"))
+        main_client.join_room("room", "blender", "mixer", False, True)
+        received = receive_until(main_client, has_type(common.MessageType.JOIN_ROOM))
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual([common.decode_string(c.data, 0)[0] for c in room_commands], ["relayed"])
+
+        main_client.send_command(common.Command(self.room_command_type, common.encode_string("main")))
+        received = receive_until(c0, has_type(self.room_command_type))
+        self.assertEqual(common.decode_string(received[-1].data, 0)[0], "main")
+
+        # joins from the local copy of the room, the main server sees a single client of the relay
+        c1 = self.make_client()
+        c1.join_room("room", "blender", "mixer", False, True)
+        received = receive_until(c1, has_type(common.MessageType.JOIN_ROOM))
+        room_commands = [c for c in received if c.type == self.room_command_type]
+        self.assertEqual([common.decode_string(c.data, 0)[0] for c in room_commands], ["relayed", "main"])
+        self.assertEqual(self._main_server._rooms["room"].client_count(), 2)
+
+        c1.send_command(common.Command(self.room_command_type, common.encode_string("local")))
+        for client in (c0, main_client):
+            received = receive_until(client, has_type(self.room_command_type))
+            self.assertEqual(common.decode_string(received[-1].data, 0)[0], "local")
+
+
 if __name__ == "__main__":
     unittest.main()